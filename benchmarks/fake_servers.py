@@ -0,0 +1,333 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local stand-ins for an OpenAI-compatible LLM server and for plugin hosts.
+
+FakeLLMServer answers /v1/chat/completions with scripted, deterministic completions,
+streamed at a configurable rate. FakePluginHost serves N plugins, each with its
+ai-plugin.json manifest, an OpenAPI specification of realistic size and the API itself.
+Manifests and specifications carry an ETag and are revalidated with a 304.
+
+Both can be started from the command line, e.g. to try PluginsParty without any
+external service:
+
+    python benchmarks/fake_servers.py --plugins 5 --tokens-per-second 40
+    python src/pluginsparty.py --openai_api_base http://127.0.0.1:8766/v1 --openai_api_key fake
+"""
+
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+GREETING = "Hello! I am a scripted model. Ask me about plugin0 to see a plugin call."
+FINAL_ANSWER = """Here is what the plugin returned:
+
+<mrkdwn>
+## Results
+
+| Item | Value |
+|------|-------|
+{rows}
+
+```python
+for item in results:
+    print(item)
+```
+</mrkdwn>
+Anything else?"""
+
+
+def tokenize(text):
+    """
+    Split a text into pseudo tokens of about 4 characters, as a model would stream it.
+    """
+    return re.findall(r"\s*\S{1,4}|\s+", text)
+
+
+def scripted_completion(messages, trailing_text=""):
+    """
+    Return the completion of the scripted model for a conversation.
+
+    - a plugin response is answered with a markdown table,
+    - a prompt mentioning pluginN is answered with a command invoking pluginN, followed by
+      trailing_text (as models that go on talking after their command),
+    - anything else is answered with a greeting.
+    """
+    last = messages[-1]["content"] if messages else ""
+    if "<RESPONSE FROM" in last:
+        rows = "\n".join(f"| item {index} | {index * 7 % 13} |" for index in range(20))
+        return FINAL_ANSWER.format(rows=rows)
+    match = re.search(r"plugin(\d+)", last)
+    if match and messages[-1]["role"] == "user":
+        return f'Let me check. {{{{{{ plugin{match.group(1)}.searchItems({{"query": "benchmark", "limit": 5}}) }}}}}}' + trailing_text
+    return GREETING
+
+
+class _Server:
+    def __init__(self, handler, host, port):
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FakeLLMServer(_Server):
+    """
+    OpenAI-compatible chat completion server streaming scripted completions.
+
+    Args:
+        tokens_per_second (float): Streaming rate, 0 for no delay.
+        time_to_first_token (float): Delay (in seconds) before the first token.
+        trailing_text (str): Text streamed after plugin commands.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, tokens_per_second=0, time_to_first_token=0, trailing_text=""):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                server.requests += 1
+                completion = scripted_completion(body.get("messages", []), server.trailing_text)
+                if server.time_to_first_token:
+                    time.sleep(server.time_to_first_token)
+                if body.get("stream"):
+                    self._stream(completion)
+                else:
+                    self._send_json({
+                        "id": "chatcmpl-fake",
+                        "object": "chat.completion",
+                        "model": body.get("model"),
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": completion}, "finish_reason": "stop"}],
+                        "usage": {"completion_tokens": len(tokenize(completion))},
+                    })
+
+            def _send_json(self, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, completion):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                delay = 1 / server.tokens_per_second if server.tokens_per_second else 0
+                self.close_connection = True
+                try:
+                    for token in tokenize(completion):
+                        chunk = {"choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                        self.wfile.flush()
+                        if delay:
+                            time.sleep(delay)
+                    self.wfile.write(b"data: [DONE]\n\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client stopped reading the stream
+                    server.cancelled_streams += 1
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(Handler, host, port)
+        self.tokens_per_second = tokens_per_second
+        self.time_to_first_token = time_to_first_token
+        self.trailing_text = trailing_text
+        self.requests = 0
+        self.cancelled_streams = 0
+
+    @property
+    def api_base(self):
+        return f"{self.url}/v1"
+
+
+def build_openapi_spec(plugin_index, server_url, operations=12):
+    """
+    Build an OpenAPI specification of realistic size (parameters, schemas, examples, responses).
+    """
+    paths = {}
+    for operation_index in range(operations):
+        operation_id = "searchItems" if operation_index == 0 else f"operation{operation_index}"
+        paths[f"/plugin{plugin_index}/{operation_id}"] = {
+            "get": {
+                "operationId": operation_id,
+                "summary": f"Operation {operation_index} of plugin {plugin_index}, returning items matching a query.",
+                "description": "Longer description of the operation. " * 5,
+                "parameters": [
+                    {"name": "query", "in": "query", "required": True, "description": "The search query.", "schema": {"type": "string"}, "example": "benchmark"},
+                    {"name": "limit", "in": "query", "required": False, "description": "Maximum number of items.", "schema": {"type": "integer", "minimum": 1, "maximum": 100, "default": 10}},
+                    {"name": "sort", "in": "query", "required": False, "description": "Sort order.", "schema": {"type": "string", "enum": ["relevance", "date", "name"]}},
+                ],
+                "responses": {
+                    "200": {
+                        "description": "The matching items.",
+                        "content": {"application/json": {"schema": {"$ref": "#/components/schemas/ItemList"}, "example": {"items": [{"id": "1", "name": "item"}]}}},
+                    },
+                    "400": {"description": "Invalid query."},
+                },
+            }
+        }
+    return {
+        "openapi": "3.0.1",
+        "info": {"title": f"Plugin {plugin_index}", "version": "v1", "description": "A benchmark plugin. " * 10},
+        "servers": [{"url": server_url}],
+        "paths": paths,
+        "components": {
+            "schemas": {
+                "Item": {
+                    "type": "object",
+                    "required": ["id", "name"],
+                    "properties": {
+                        "id": {"type": "string", "description": "Identifier.", "example": "42"},
+                        "name": {"type": "string", "description": "Name.", "example": "item"},
+                        "tags": {"type": "array", "items": {"type": "string"}},
+                        "score": {"type": "number", "format": "float"},
+                    },
+                },
+                "ItemList": {"type": "object", "properties": {"items": {"type": "array", "items": {"$ref": "#/components/schemas/Item"}}}},
+            }
+        },
+    }
+
+
+class FakePluginHost(_Server):
+    """
+    Host serving N plugins at /plugin<i>/.well-known/ai-plugin.json.
+
+    Args:
+        plugins (int): Number of plugins served.
+        latency (float): Delay (in seconds) added to every response.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, plugins=10, latency=0):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests += 1
+                # Plugin stubs send their parameters as a JSON body, read it to keep the connection usable
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if server.latency:
+                    time.sleep(server.latency)
+                match = re.match(r"^/plugin(\d+)/(.*?)(?:\?.*)?$", self.path)
+                if not match or int(match.group(1)) >= server.plugins:
+                    self._send(404, "text/plain", b"not found")
+                    return
+                plugin_index, resource = int(match.group(1)), match.group(2)
+                if resource == ".well-known/ai-plugin.json":
+                    self._send_artifact("application/json", json.dumps(server.manifest(plugin_index)).encode("utf-8"))
+                elif resource == "openapi.yaml":
+                    self._send_artifact("application/yaml", server.spec(plugin_index).encode("utf-8"))
+                else:
+                    items = [{"id": str(index), "name": f"item {index}", "tags": ["a", "b"], "score": index / 10} for index in range(5)]
+                    self._send(200, "application/json", json.dumps({"items": items}).encode("utf-8"))
+
+            def _send_artifact(self, content_type, data):
+                # Artifacts carry an ETag, so that the plugin cache can revalidate them
+                etag = f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self._send(304, content_type, b"", etag)
+                else:
+                    self._send(200, content_type, data, etag)
+
+            def _send(self, status, content_type, data, etag=None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                if etag:
+                    self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(Handler, host, port)
+        self.plugins = plugins
+        self.latency = latency
+        self.requests = 0
+        self._specs = {}
+
+    def manifest_url(self, plugin_index):
+        return f"{self.url}/plugin{plugin_index}/.well-known/ai-plugin.json"
+
+    def manifest(self, plugin_index):
+        return {
+            "schema_version": "v1",
+            "name_for_human": f"Plugin {plugin_index}",
+            "name_for_model": f"plugin{plugin_index}",
+            "description_for_human": "A benchmark plugin.",
+            "description_for_model": f"Plugin {plugin_index} searches items. Use it when the user asks about plugin{plugin_index}.",
+            "auth": {"type": "none"},
+            "api": {"type": "openapi", "url": f"/plugin{plugin_index}/openapi.yaml"},
+        }
+
+    def spec(self, plugin_index):
+        if plugin_index not in self._specs:
+            self._specs[plugin_index] = yaml.safe_dump(build_openapi_spec(plugin_index, self.url), sort_keys=False)
+        return self._specs[plugin_index]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a fake LLM server and a fake plugin host.")
+    parser.add_argument("--llm-port", type=int, default=8766)
+    parser.add_argument("--plugin-port", type=int, default=8765)
+    parser.add_argument("--plugins", type=int, default=5, help="Number of plugins served.")
+    parser.add_argument("--tokens-per-second", type=float, default=40, help="Streaming rate of the fake LLM.")
+    parser.add_argument("--time-to-first-token", type=float, default=0.2, help="Delay before the first token.")
+    parser.add_argument("--plugin-latency", type=float, default=0.05, help="Delay added to plugin responses.")
+    parser.add_argument("--trailing-text", default="", help="Text streamed by the fake LLM after its plugin commands.")
+    cmdline_args = parser.parse_args()
+
+    llm = FakeLLMServer(port=cmdline_args.llm_port, tokens_per_second=cmdline_args.tokens_per_second, time_to_first_token=cmdline_args.time_to_first_token, trailing_text=cmdline_args.trailing_text).start()
+    host = FakePluginHost(port=cmdline_args.plugin_port, plugins=cmdline_args.plugins, latency=cmdline_args.plugin_latency).start()
+    print(f"Fake LLM: --openai_api_base {llm.api_base}")
+    print("Plugins (for plugins/default_plugins.json):")
+    print(json.dumps([host.manifest_url(index) for index in range(cmdline_args.plugins)], indent=1))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
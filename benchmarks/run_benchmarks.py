@@ -0,0 +1,393 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Deterministic benchmark suite.
+
+Every scenario runs against local stand-in servers (see fake_servers.py), so results
+only depend on the code and the machine:
+
+    startup_cold / startup_warm   registration of N plugins, without / with cached artifacts
+    turn_latency                  a headless turn: completion, plugin call, final completion
+    streaming_turn                a streamed turn through send_messages, rendering included
+    speculative_turn[mode]        a streamed answer with a plugin command followed by more text,
+                                  until the plugin response: without speculation (off), with
+                                  speculative dispatch (safe), and also stopping the stream (stop)
+    fanout[mode]                  a turn sent to a fast and a slow model: racing them (race) or
+                                  running both to completion (compare)
+    command_extraction            scan_commands throughput on a large message
+    stream_render                 MarkdownStreamRenderer throughput on a large answer
+    import_time                   import of pluginsparty in a new interpreter, as reported by
+                                  python -X importtime
+
+Results are saved as JSON (pytest-benchmark like layout). With --compare, the medians
+are compared with a previous run and the exit status is 1 if any scenario regressed by
+more than --max-regression. The exit status is also 1 if importing pluginsparty takes
+longer than --max-import-ms (MAX_IMPORT_MS by default, 0 to only check the modules), or
+if it imports any of the HEAVY_MODULES.
+
+    python benchmarks/run_benchmarks.py --output bench.json
+    python benchmarks/run_benchmarks.py --compare bench.json
+    python benchmarks/run_benchmarks.py --max-import-ms 200
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from rich.console import Console
+
+import command_scanner
+import context_window
+import llm_client
+import model_fanout
+import operation_table
+import plugin_cache
+import pluginsparty
+import register_plugin
+import response_cache
+import speculative_dispatch
+import stream_renderer
+from fake_servers import FakeLLMServer, FakePluginHost, tokenize
+
+# Modules only needed once a request is sent or something is rendered, importing
+# pluginsparty must not import them
+HEAVY_MODULES = ("openai", "aiohttp", "halo", "IPython", "rich.markdown", "yaml", "requests")
+# Import time budget (in milliseconds) of pluginsparty
+MAX_IMPORT_MS = 300
+
+
+def measure(function, rounds, setup=None):
+    """
+    Time function over several rounds, setup (untimed) being called before each round.
+
+    Returns:
+        dict: min, max, mean, median and stddev (in seconds) and the number of rounds.
+    """
+    timings = []
+    for _ in range(rounds):
+        if setup is not None:
+            setup()
+        started_at = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started_at)
+    return summarize(timings)
+
+
+def summarize(timings):
+    return {
+        "min": min(timings),
+        "max": max(timings),
+        "mean": statistics.mean(timings),
+        "median": statistics.median(timings),
+        "stddev": statistics.stdev(timings) if len(timings) > 1 else 0,
+        "rounds": len(timings),
+    }
+
+
+def reset_registry():
+    register_plugin.plugin_stubs.clear()
+    operation_table.clear()
+    plugin_cache._index = None
+    # A warm start is a new process: the cached artifacts are parsed again
+    register_plugin._parsed_artifacts.clear()
+    response_cache.clear()
+
+
+def bench_startup(host, plugins, rounds):
+    urls = [host.manifest_url(index) for index in range(plugins)]
+
+    def register():
+        instructions = pluginsparty.get_instructions_for_plugins(urls, "gpt-3.5-turbo")
+        assert len(instructions) == plugins, "some plugins failed to register"
+
+    def cold_setup():
+        shutil.rmtree(plugin_cache.PLUGINS_DIR, ignore_errors=True)
+        os.makedirs(plugin_cache.PLUGINS_DIR)
+        reset_registry()
+
+    cold = measure(register, rounds, setup=cold_setup)
+    warm = measure(register, rounds, setup=reset_registry)
+    extra = {"plugins": plugins, "plugin_latency": host.latency}
+    return [
+        {"name": f"startup_cold[{plugins}]", "stats": cold, "extra_info": extra},
+        {"name": f"startup_warm[{plugins}]", "stats": warm, "extra_info": extra},
+    ]
+
+
+def bench_turn_latency(instructions, rounds):
+    def turn():
+        record = pluginsparty.run_headless_conversation(instructions, "Search plugin0 for benchmark items")
+        assert record["error"] is None, record["error"]
+        assert record["commands"], "no command extracted"
+
+    return [{"name": "turn_latency", "stats": measure(turn, rounds, setup=response_cache.clear), "extra_info": {}}]
+
+
+def bench_streaming_turn(llm, rounds):
+    messages = [{"role": "user", "content": "<RESPONSE FROM plugin0> {} </RESPONSE>"}]
+
+    def turn():
+        with contextlib.redirect_stdout(io.StringIO()):
+            pluginsparty.send_messages(messages)
+
+    pluginsparty.CHAT_COMPLETION_ARGS["stream"] = True
+    try:
+        stats = measure(turn, rounds)
+    finally:
+        pluginsparty.CHAT_COMPLETION_ARGS["stream"] = False
+    return [{"name": "streaming_turn", "stats": stats, "extra_info": {"tokens_per_second": llm.tokens_per_second}}]
+
+
+def bench_speculative_turn(llm, rounds, tokens_per_second=200):
+    messages = [{"role": "user", "content": "Search plugin0 for benchmark items"}]
+    trailing_text = " I am now waiting for the plugin response, which should arrive shortly." * 4
+    results = []
+    for mode, speculative, stop in (("off", False, False), ("safe", True, False), ("stop", True, True)):
+        def turn():
+            dispatcher = None
+            if speculative:
+                dispatcher = speculative_dispatch.SpeculativeDispatcher(
+                    pluginsparty.invoke_plugin_stub, pluginsparty.get_operation_method
+                )
+            with contextlib.redirect_stdout(io.StringIO()):
+                content = pluginsparty.send_messages(
+                    messages,
+                    on_command=dispatcher.submit if dispatcher is not None else None,
+                    stop_on_command=stop,
+                )
+            commands = command_scanner.scan_commands(content)
+            assert commands, "no command extracted"
+            pluginsparty.invoke_plugin_stubs(commands, dispatcher)
+
+        # Every round waits for the plugin: its responses are not cached
+        pluginsparty.CHAT_COMPLETION_ARGS["stream"] = True
+        response_cache.ENABLED = False
+        llm.trailing_text, llm.tokens_per_second, previous_rate = trailing_text, tokens_per_second, llm.tokens_per_second
+        try:
+            stats = measure(turn, rounds)
+        finally:
+            pluginsparty.CHAT_COMPLETION_ARGS["stream"] = False
+            response_cache.ENABLED = True
+            llm.trailing_text, llm.tokens_per_second = "", previous_rate
+        results.append({
+            "name": f"speculative_turn[{mode}]",
+            "stats": stats,
+            "extra_info": {"tokens_per_second": tokens_per_second},
+        })
+    return results
+
+
+def bench_fanout(llm, rounds, fast_tokens_per_second=400, slow_tokens_per_second=50):
+    messages = [{"role": "user", "content": "Search plugin0 for benchmark items"}]
+    results = []
+    with FakeLLMServer(tokens_per_second=slow_tokens_per_second) as slow_llm:
+        targets = [("fast", llm.api_base), ("slow", slow_llm.api_base)]
+        fanout = model_fanout.ModelFanout(
+            pluginsparty.CHAT_COMPLETION_ARGS,
+            pluginsparty.get_checked_operation,
+            pluginsparty.invoke_plugin_stub,
+            pluginsparty.get_operation_method,
+            pluginsparty.build_plugin_response_message,
+        )
+        for mode in model_fanout.MODES:
+            def turn():
+                runs = fanout.run(messages, targets, mode)
+                assert all(run.error is None for run in runs), [run.error for run in runs]
+                assert mode != "race" or runs[0].winner, "the fast model did not win"
+
+            llm.tokens_per_second, previous_rate = fast_tokens_per_second, llm.tokens_per_second
+            try:
+                stats = measure(turn, rounds, setup=response_cache.clear)
+            finally:
+                llm.tokens_per_second = previous_rate
+            results.append({
+                "name": f"fanout[{mode}]",
+                "stats": stats,
+                "extra_info": {"tokens_per_second": [fast_tokens_per_second, slow_tokens_per_second]},
+            })
+    return results
+
+
+def bench_command_extraction(rounds):
+    filler = "The model keeps talking about the weather and other things. " * 30
+    command = '{{{ plugin0.searchItems({"query": "benchmark (1)", "limit": 5, "nested": {"a": [1, 2, 3]}}) }}}'
+    message = "\n".join(filler + command for _ in range(50))
+
+    def extract():
+        assert len(command_scanner.scan_commands(message)) == 50
+
+    stats = measure(extract, rounds)
+    return [{
+        "name": "command_extraction",
+        "stats": stats,
+        "extra_info": {"bytes": len(message), "mb_per_second": len(message) / stats["median"] / 1e6},
+    }]
+
+
+def bench_stream_render(rounds):
+    block = "Some plain text before the block. <mrkdwn>## Title\n\n" + "- a list item with **bold** text\n" * 20 + "</mrkdwn>\n"
+    answer = block * 40
+    deltas = tokenize(answer)
+
+    def render():
+        renderer = stream_renderer.MarkdownStreamRenderer(console=Console(file=io.StringIO(), width=100))
+        with contextlib.redirect_stdout(io.StringIO()):
+            for delta in deltas:
+                renderer.feed(delta)
+            renderer.close()
+
+    stats = measure(render, rounds)
+    return [{
+        "name": "stream_render",
+        "stats": stats,
+        "extra_info": {"deltas": len(deltas), "deltas_per_second": len(deltas) / stats["median"]},
+    }]
+
+
+def bench_import_time(rounds):
+    code = f"import sys, pluginsparty; print(' '.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))"
+    timings = []
+    heavy_modules = set()
+    for _ in range(rounds):
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=os.path.join(ROOT_DIR, "src"), capture_output=True, text=True, check=True,
+        )
+        heavy_modules.update(process.stdout.split())
+        # import time: self [us] | cumulative | imported package
+        for line in process.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) == 3 and fields[2].strip() == "pluginsparty":
+                timings.append(int(fields[1]) / 1e6)
+    return [{
+        "name": "import_time",
+        "stats": summarize(timings),
+        "extra_info": {"heavy_modules": sorted(heavy_modules)},
+    }]
+
+
+def check_import_time(results, max_import_ms):
+    for benchmark in results["benchmarks"]:
+        if benchmark["name"] != "import_time":
+            continue
+        import_ms = benchmark["stats"]["median"] * 1000
+        heavy_modules = benchmark["extra_info"]["heavy_modules"]
+        over_budget = bool(max_import_ms) and import_ms > max_import_ms
+        if max_import_ms:
+            print(f"{'import_time':28} {import_ms:10.2f}ms (budget {max_import_ms:.2f}ms)"
+                  f"{'  OVER BUDGET' if over_budget else ''}")
+        if heavy_modules:
+            print(f"{'import_time':28} heavy modules imported: {', '.join(heavy_modules)}")
+        return over_budget or bool(heavy_modules)
+    return False
+
+
+def compare(results, previous_path, max_regression):
+    with open(previous_path, "r", encoding="utf-8") as file:
+        previous = {benchmark["name"]: benchmark for benchmark in json.load(file)["benchmarks"]}
+    regressions = 0
+    for benchmark in results["benchmarks"]:
+        before = previous.get(benchmark["name"])
+        if before is None:
+            continue
+        ratio = benchmark["stats"]["median"] / before["stats"]["median"]
+        regressed = ratio > 1 + max_regression
+        regressions += regressed
+        print(f"{benchmark['name']:28} {before['stats']['median'] * 1000:10.2f}ms -> "
+              f"{benchmark['stats']['median'] * 1000:10.2f}ms  x{ratio:.2f}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main(args):
+    logging.basicConfig(level=logging.CRITICAL + 1)
+    work_dir = tempfile.mkdtemp(prefix="pluginsparty-bench-")
+    shutil.copytree(os.path.join(ROOT_DIR, "instructions"), os.path.join(work_dir, "instructions"))
+    os.makedirs(os.path.join(work_dir, "plugins"))
+    with open(os.path.join(work_dir, "plugins", "default_plugins.json"), "w", encoding="utf-8") as file:
+        json.dump([], file)
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+
+    results = {
+        "datetime": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "machine_info": {"python": platform.python_version(), "platform": platform.platform()},
+        "benchmarks": [],
+    }
+    try:
+        with FakePluginHost(plugins=max(args.plugins), latency=args.plugin_latency) as host, \
+                FakeLLMServer(tokens_per_second=args.tokens_per_second) as llm:
+            llm_client.API_BASES = [llm.api_base]
+            llm_client.API_KEY = "fake"
+            llm_client.configure()
+            pluginsparty.CHAT_COMPLETION_ARGS.update(model="gpt-3.5-turbo", stream=False, max_tokens=500)
+            context_window.BUDGET = None
+
+            for plugins in args.plugins:
+                results["benchmarks"] += bench_startup(host, plugins, args.rounds)
+
+            # The startup scenarios clear the plugins directory, plugin0 is registered again for the turns
+            reset_registry()
+            with open(os.path.join(plugin_cache.PLUGINS_DIR, "default_plugins.json"), "w", encoding="utf-8") as file:
+                json.dump([host.manifest_url(0)], file)
+            instructions = pluginsparty.build_instructions("gpt-3.5-turbo")
+            results["benchmarks"] += bench_turn_latency(instructions, args.rounds)
+            results["benchmarks"] += bench_streaming_turn(llm, args.rounds)
+            results["benchmarks"] += bench_speculative_turn(llm, args.rounds)
+            results["benchmarks"] += bench_fanout(llm, args.rounds)
+        results["benchmarks"] += bench_command_extraction(args.rounds * 10)
+        results["benchmarks"] += bench_stream_render(args.rounds)
+        results["benchmarks"] += bench_import_time(args.rounds)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for benchmark in results["benchmarks"]:
+        stats = benchmark["stats"]
+        print(f"{benchmark['name']:28} median {stats['median'] * 1000:10.2f}ms  "
+              f"min {stats['min'] * 1000:10.2f}ms  stddev {stats['stddev'] * 1000:8.2f}ms")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+    failed = check_import_time(results, args.max_import_ms)
+    if args.compare:
+        failed = compare(results, args.compare, args.max_regression) or failed
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the PluginsParty benchmark suite.")
+    parser.add_argument("--rounds", type=int, default=5, help="Number of rounds per scenario.")
+    parser.add_argument("--plugins", type=int, nargs="+", default=[1, 10, 30], help="Numbers of plugins registered by the startup scenarios.")
+    parser.add_argument("--plugin-latency", type=float, default=0.02, help="Latency (in seconds) of the fake plugin host.")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="Streaming rate of the fake LLM, 0 for no delay.")
+    parser.add_argument("--output", default=None, help="Save the results to this JSON file.")
+    parser.add_argument("--compare", default=None, help="Compare the results with a previous JSON file.")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="Tolerated slowdown ratio when comparing.")
+    parser.add_argument("--max-import-ms", type=float, default=MAX_IMPORT_MS, help="Import time budget (in milliseconds) of pluginsparty, 0 for no budget.")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,108 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Headless batch runner.
+
+Reads prompts from a JSONL file, runs one conversation per prompt on a worker pool
+and appends each result to an output JSONL file as soon as it is available.
+
+Each input line is either a JSON string (the prompt) or a JSON object:
+
+    {"id": "weather-paris", "prompt": "What's the weather in Paris?", "model": "gpt-4"}
+
+"id" and "model" are optional. Malformed lines are logged and skipped. The conversation
+itself is run by the function given to run_batch, which returns the result record to
+write: a conversation that fails gets a record holding its error, the others still run.
+"""
+
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from llm_client import RateLimiter
+
+logger = logging.getLogger('pluginspartylogger')
+
+
+def read_prompts(prompts_path):
+    """
+    Read the prompts of a JSONL file.
+
+    Malformed lines (invalid JSON, no "prompt" string) are logged and skipped.
+
+    Returns:
+        list: A list of {"id", "prompt", "model"} dictionaries.
+    """
+    prompts = []
+    with open(prompts_path, "r", encoding="utf-8") as file:
+        for line_number, line in enumerate(file, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError as anexception:
+                logger.warning("%s:%i: invalid JSON, skipping: %s", prompts_path, line_number, anexception)
+                continue
+            if isinstance(entry, str):
+                entry = {"prompt": entry}
+            if not isinstance(entry, dict) or not isinstance(entry.get("prompt"), str):
+                logger.warning('%s:%i: expected a string or an object with a "prompt" string, skipping', prompts_path, line_number)
+                continue
+            entry.setdefault("id", line_number)
+            entry.setdefault("model", None)
+            prompts.append(entry)
+    return prompts
+
+
+def run_batch(prompts_path, output_path, conversation, workers=4, requests_per_minute=None):
+    """
+    Run a conversation for each prompt of a JSONL file.
+
+    Args:
+        prompts_path (str): The input JSONL file.
+        output_path (str): The output JSONL file, results are appended as they complete.
+        conversation (callable): Called with (prompt, model, rate_limiter) for each prompt,
+            returns the result record (dict).
+        workers (int): The number of conversations run concurrently.
+        requests_per_minute (float): The maximum number of requests per minute and per model.
+
+    Returns:
+        int: The number of conversations that failed.
+    """
+    prompts = read_prompts(prompts_path)
+    rate_limiter = RateLimiter(requests_per_minute)
+    failures = 0
+    started_at = time.monotonic()
+
+    def run(entry):
+        try:
+            return dict({"id": entry["id"]}, **conversation(entry["prompt"], entry["model"], rate_limiter))
+        except Exception as anexception:
+            return {"id": entry["id"], "prompt": entry["prompt"], "model": entry["model"], "error": str(anexception)}
+
+    with open(output_path, "a", encoding="utf-8") as output, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run, entry) for entry in prompts]
+        for future in as_completed(futures):
+            record = future.result()
+            if record.get("error"):
+                failures += 1
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            logger.info("Prompt %s done (%s)", record["id"], "failed" if record.get("error") else "ok")
+
+    logger.info(
+        "%i prompts run in %.2fs, %i failed",
+        len(prompts), time.monotonic() - started_at, failures,
+    )
+    return failures
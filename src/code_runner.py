@@ -0,0 +1,286 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Execution of the code blocks run by the /! command.
+
+The code runs as a shell command in a worker thread, so the console stays responsive
+(Ctrl+C cancels the run). Its stdout and stderr are shown as they are produced, up to
+MAX_OUTPUT_CHARS characters; further output is read but not shown.
+
+The command runs in its own process group, with no standard input, and is killed with
+all its children after TIMEOUT seconds. Where the platform allows it, its CPU time and
+the size of the files it writes are limited too.
+
+Only a summary of the output is kept for the model: its beginning and its end, within
+MAX_OUTPUT_CHARS characters, with the exit status.
+"""
+
+import codecs
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: no resource limits there
+    resource = None
+
+logger = logging.getLogger('pluginspartylogger')
+
+# Wall-clock time (in seconds) after which the command is killed, None for no limit
+TIMEOUT = 60
+# Maximum number of characters of output shown, and sent to the model
+MAX_OUTPUT_CHARS = 8000
+# Maximum size (in bytes) of any file written by the command, None for no limit
+MAX_FILE_BYTES = 100 * 1024 * 1024
+READ_SIZE = 4096
+
+
+class ExecutionResult:
+    """
+    The outcome of a run.
+
+    Args:
+        returncode (int): The exit status, negative if killed by a signal, None if unknown.
+        output (str): The beginning and the end of the output, stdout and stderr interleaved.
+        omitted_chars (int): The number of characters of output left out.
+        timed_out (bool): Whether the command was killed after TIMEOUT seconds.
+        cancelled (bool): Whether the run was cancelled by the user.
+        duration (float): The wall-clock time of the run, in seconds.
+    """
+
+    def __init__(self, returncode, output, omitted_chars, timed_out, cancelled, duration):
+        self.returncode = returncode
+        self.output = output
+        self.omitted_chars = omitted_chars
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+        self.duration = duration
+
+    def summary(self):
+        """
+        Describe the run for the model: its status, then its output.
+        """
+        if self.timed_out:
+            status = f"Killed after {self.duration:.0f}s (timeout)."
+        elif self.cancelled:
+            status = "Cancelled by the user."
+        elif self.returncode == 0:
+            status = "Exit status 0."
+        else:
+            status = f"Command execution failed, exit status {self.returncode}."
+        if not self.output:
+            return f"{status} No output."
+        return f"{status} Output:\n{self.output}"
+
+
+class CodeRunner:
+    """
+    A shell command run in a worker thread.
+
+    Args:
+        command (str): The shell command.
+        on_output (callable): Called with (text, is_stderr) for each piece of output shown.
+        timeout (float): The wall-clock time limit, TIMEOUT by default.
+        max_output_chars (int): The output cap, MAX_OUTPUT_CHARS by default.
+    """
+
+    def __init__(self, command, on_output=None, timeout=None, max_output_chars=None):
+        self.command = command
+        self.on_output = on_output
+        self.timeout = TIMEOUT if timeout is None else timeout
+        self.max_output_chars = MAX_OUTPUT_CHARS if max_output_chars is None else max_output_chars
+        self.result = None
+        self._lock = threading.Lock()
+        self._head = []
+        self._head_chars = 0
+        self._tail = deque()
+        self._tail_chars = 0
+        self._omitted_chars = 0
+        self._shown_chars = 0
+        self._process = None
+        self._cancelled = threading.Event()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="code-runner", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def wait(self):
+        """
+        Wait for the end of the run, Ctrl+C cancelling it.
+
+        Returns:
+            ExecutionResult: The outcome of the run.
+        """
+        try:
+            # A timed wait lets KeyboardInterrupt through
+            while not self._done.wait(0.1):
+                pass
+        except KeyboardInterrupt:
+            self.cancel()
+            self._done.wait()
+        return self.result
+
+    def cancel(self):
+        self._cancelled.set()
+        self._kill()
+
+    def _kill(self):
+        process = self._process
+        if process is None or process.poll() is not None:
+            return
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except OSError as anexception:
+            logger.debug("Could not kill the command: %s", anexception)
+
+    def _limit_resources(self):
+        """
+        Set the resource limits of the started command. They are set from the parent with
+        prlimit(): a preexec_fn is not safe in a process running other threads.
+        """
+        if resource is None or not hasattr(resource, "prlimit"):
+            return
+        limits = []
+        if self.timeout:
+            limits.append((resource.RLIMIT_CPU, int(self.timeout) + 1))
+        if MAX_FILE_BYTES:
+            limits.append((resource.RLIMIT_FSIZE, MAX_FILE_BYTES))
+        for limit, value in limits:
+            try:
+                resource.prlimit(self._process.pid, limit, (value, value))
+            except (OSError, ValueError) as anexception:
+                logger.debug("Could not limit the resources of the command: %s", anexception)
+
+    def _add_output(self, text, is_stderr):
+        with self._lock:
+            if self.on_output is not None:
+                shown = text[:max(0, self.max_output_chars - self._shown_chars)]
+                if shown:
+                    self.on_output(shown, is_stderr)
+                if self._shown_chars <= self.max_output_chars < self._shown_chars + len(text):
+                    self.on_output(f"\n[output capped at {self.max_output_chars} characters, the rest is not shown]\n", True)
+            self._shown_chars += len(text)
+
+            # The first half of the cap is kept, then the last half
+            head_room = self.max_output_chars // 2 - self._head_chars
+            if head_room > 0:
+                self._head.append(text[:head_room])
+                self._head_chars += len(self._head[-1])
+                text = text[head_room:]
+            if not text:
+                return
+            self._tail.append(text)
+            self._tail_chars += len(text)
+            tail_size = self.max_output_chars - self.max_output_chars // 2
+            while self._tail_chars - len(self._tail[0]) >= tail_size:
+                self._omitted_chars += len(self._tail[0])
+                self._tail_chars -= len(self._tail.popleft())
+
+    def _read(self, pipe, is_stderr):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        with pipe:
+            while True:
+                data = os.read(pipe.fileno(), READ_SIZE)
+                text = decoder.decode(data, final=not data)
+                if text:
+                    self._add_output(text, is_stderr)
+                if not data:
+                    return
+
+    def _output(self):
+        # A reader still running (see _execute) may be adding output
+        with self._lock:
+            tail = "".join(self._tail)
+            omitted_chars = self._omitted_chars
+            head = "".join(self._head)
+        tail_size = self.max_output_chars - self.max_output_chars // 2
+        omitted_chars += max(0, len(tail) - tail_size)
+        tail = tail[len(tail) - tail_size:] if len(tail) > tail_size else tail
+        if omitted_chars:
+            return f"{head}\n[... {omitted_chars} characters omitted ...]\n{tail}", omitted_chars
+        return head + tail, 0
+
+    def _run(self):
+        try:
+            self._execute()
+        finally:
+            self._done.set()
+
+    def _execute(self):
+        started_at = time.monotonic()
+        timed_out = False
+        returncode = None
+        try:
+            self._process = subprocess.Popen(
+                self.command,
+                shell=True,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                # Its own process group: the command and its children are killed together
+                start_new_session=hasattr(os, "killpg"),
+            )
+        except OSError as anexception:
+            self._add_output(f"The command could not be started: {anexception}\n", True)
+        else:
+            self._limit_resources()
+            if self._cancelled.is_set():
+                # Cancelled while the process was being started, cancel() could not kill it
+                self._kill()
+            readers = [
+                threading.Thread(target=self._read, args=(self._process.stdout, False), daemon=True),
+                threading.Thread(target=self._read, args=(self._process.stderr, True), daemon=True),
+            ]
+            for reader in readers:
+                reader.start()
+            try:
+                returncode = self._process.wait(self.timeout or None)
+            except subprocess.TimeoutExpired:
+                timed_out = True
+                self._kill()
+                returncode = self._process.wait()
+            for reader in readers:
+                # A background child escaping the process group may keep a pipe open
+                reader.join(1)
+                if reader.is_alive():
+                    logger.warning("The command output is still open, the output may be incomplete")
+        output, omitted_chars = self._output()
+        self.result = ExecutionResult(
+            returncode, output, omitted_chars, timed_out, self._cancelled.is_set(), time.monotonic() - started_at
+        )
+
+
+def execute(command, timeout=None, max_output_chars=None):
+    """
+    Run a shell command, showing its output live on the console.
+
+    Returns:
+        ExecutionResult: The outcome of the run.
+    """
+    def show(text, is_stderr):
+        stream = sys.stderr if is_stderr else sys.stdout
+        stream.write(text)
+        stream.flush()
+
+    return CodeRunner(command, show, timeout, max_output_chars).start().wait()
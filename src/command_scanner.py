@@ -0,0 +1,243 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Single-pass scanner of plugin commands.
+
+Commands are enclosed in triple curly braces or triple square brackets and follow the
+format 'namespace.operation_id(parameters)', where parameters is a JSON object:
+
+    {{{ weather.getWeather({"city": "Paris"}) }}}
+    [[[ weather.getWeather({"city": "Paris"}) ]]]
+
+The text is scanned once from left to right with precompiled patterns. Arguments are
+decoded with JSONDecoder.raw_decode directly from the text, so parentheses or closing
+delimiters inside JSON strings are handled. CommandScanner runs on streamed deltas and
+reports each command as soon as its closing delimiter is received.
+"""
+
+import json
+import re
+
+DELIMITERS = {"{{{": "}}}", "[[[": "]]]"}
+
+_BLOCK_START = re.compile(r"\{\{\{|\[\[\[")
+_CALL_HEADER = re.compile(r"(?P<namespace>[\w_]+)\s*\.\s*(?P<operationid>[\w_]+)\s*\(\s*")
+_CALL_END = re.compile(r"\s*\)")
+_DECODER = json.JSONDecoder()
+
+
+class InvalidCommandFormatError(Exception):
+    """
+    Exception raised for errors in the input command format.
+
+    Attributes:
+        message (str): Explanation of the error.
+    """
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def parse_block(text, start):
+    """
+    Parse the command block opening at text[start].
+
+    Args:
+        text (str): The text containing the block.
+        start (int): The index of the opening delimiter.
+
+    Returns:
+        tuple: ((namespace, operation_id), parameters, end) where end is the index following
+        the closing delimiter, or None if the block is not terminated.
+
+    Raises:
+        InvalidCommandFormatError: If the block is terminated but the command is invalid.
+    """
+    opening = text[start:start + 3]
+    closing = DELIMITERS[opening]
+    content_start = start + 3
+
+    close_index = text.find(closing, content_start)
+    if close_index == -1:
+        return None
+
+    header = _CALL_HEADER.search(text, content_start, close_index)
+    if header is None:
+        error_msg = "Error: Invalid command format: The command is not well formed. Expected a JSON object as the parameter."
+        raise InvalidCommandFormatError(error_msg)
+
+    namespace, operation_id = header.group("namespace"), header.group("operationid")
+    try:
+        params, args_end = _DECODER.raw_decode(text, header.end())
+        call_end = _CALL_END.match(text, args_end)
+        if call_end is None:
+            raise ValueError("Expected ')' after the parameters")
+    except ValueError as anexception:
+        raw_params_end = text.rfind(")", header.end(), close_index)
+        raw_params = text[header.end():raw_params_end if raw_params_end != -1 else close_index].strip()
+        error_msg = f"Error: Invalid command format: The 'args' is not a valid JSON object. namespace: {namespace}, operation_id: {operation_id}, parameters: {raw_params}."
+        raise InvalidCommandFormatError(error_msg) from anexception
+
+    # The parameters may contain the closing delimiter, look for it after them
+    close_index = text.find(closing, call_end.end())
+    if close_index == -1:
+        return None
+    return (namespace, operation_id), params, close_index + len(closing)
+
+
+def scan_commands(text):
+    """
+    Return all the commands of a text, in order of appearance.
+
+    Args:
+        text (str): The text to scan.
+
+    Returns:
+        list: A list of ((namespace, operation_id), parameters) tuples.
+
+    Raises:
+        InvalidCommandFormatError: If the format of any of the commands is invalid.
+    """
+    commands = []
+    position = 0
+    while True:
+        match = _BLOCK_START.search(text, position)
+        if match is None:
+            return commands
+        block = parse_block(text, match.start())
+        if block is None:
+            return commands
+        command, params, position = block
+        commands.append((command, params))
+
+
+class CommandScanner:
+    """
+    Incremental scanner reporting commands while the text is streamed.
+
+    Usage:
+        scanner = CommandScanner()
+        for delta in deltas:
+            for command, params in scanner.feed(delta):
+                ...
+
+    Commands are reported once their closing delimiter is received. A block that cannot be
+    parsed holds the scan until the end of the text: scan_commands on the complete text
+    remains the reference to report errors.
+
+    Each delta is searched once, with the last characters of the previous one (a delimiter
+    may span two deltas). Deltas are kept as a list of chunks, joined when the text is read,
+    and an open block is only parsed when a delta brings a possible closing delimiter.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._length = 0
+        # The last characters received, a delimiter may start there
+        self._tail = ""
+        self._position = 0
+        self._commands_end = None
+        # Up to 3 non-blank characters following the last reported command
+        self._trailing = ""
+        # The open block: its start, its closing delimiter, its chunks and the index from which
+        # its closing delimiter is searched
+        self._block_start = None
+        self._closing = None
+        self._block_chunks = []
+        self._close_search = 0
+
+    @property
+    def text(self):
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    @property
+    def commands_end(self):
+        """
+        The index following the last reported command, None if no command was reported.
+        """
+        return self._commands_end
+
+    def has_trailing_text(self):
+        """
+        Return True if text other than commands follows the last reported command.
+
+        Whitespace, and the beginning of a new block, are not trailing text: the model may
+        still be sending other commands.
+        """
+        if self._commands_end is None or not self._trailing:
+            return False
+        tail = self._trailing
+        return not any(tail.startswith(opening) or opening.startswith(tail) for opening in DELIMITERS)
+
+    def _add_trailing(self, text):
+        if len(self._trailing) < 3:
+            self._trailing = (self._trailing + text).lstrip()[:3]
+
+    def feed(self, delta):
+        """
+        Scan a new delta of the text.
+
+        Returns:
+            list: The ((namespace, operation_id), parameters) tuples completed by this delta.
+        """
+        if not delta:
+            return []
+        # The searched region: the new delta and the characters before it a delimiter may start with
+        region = self._tail + delta
+        region_start = self._length - len(self._tail)
+        self._chunks.append(delta)
+        self._length += len(delta)
+        self._tail = region[-2:]
+        if self._block_start is not None:
+            self._block_chunks.append(delta)
+        if self._commands_end is not None:
+            self._add_trailing(region[max(0, self._commands_end - region_start):][-len(delta):])
+
+        commands = []
+        while True:
+            if self._block_start is None:
+                match = _BLOCK_START.search(region, max(0, self._position - region_start))
+                if match is None:
+                    # Keep the last characters, they may start a delimiter
+                    self._position = max(self._position, self._length - 2)
+                    return commands
+                self._block_start = region_start + match.start()
+                self._closing = DELIMITERS[match.group()]
+                self._block_chunks = [region[match.start():]]
+                self._close_search = self._block_start + 3
+
+            close_index = region.find(self._closing, max(0, self._close_search - region_start))
+            if close_index == -1:
+                # The closing delimiter may start with the last characters
+                self._close_search = max(self._close_search, self._length - 2)
+                return commands
+            # Another closing delimiter is needed if this one does not end the block
+            self._close_search = region_start + close_index + 1
+
+            if len(self._block_chunks) > 1:
+                self._block_chunks = ["".join(self._block_chunks)]
+            try:
+                block = parse_block(self._block_chunks[0], 0)
+            except InvalidCommandFormatError:
+                # The closing delimiter may be part of parameters not fully received yet:
+                # parse the block again once another one is received
+                block = None
+            if block is None:
+                continue
+            command, params, end = block
+            self._position = self._commands_end = self._block_start + end
+            self._trailing = ""
+            self._add_trailing(self._block_chunks[0][end:])
+            self._block_start = None
+            self._block_chunks = []
+            commands.append((command, params))
@@ -0,0 +1,232 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Validation of plugin command parameters.
+
+At registration, the parameters and the JSON request body of each operation are
+compiled (compile_operation) into a compact, JSON serializable validator stored in the
+request stub: $ref resolved, allOf merged, and only what validation needs kept (types,
+enums, required properties, items). Before any request, validate() checks the
+parameters of a command against it and reports every missing or mistyped field, so
+that the model gets a precise error without any request to the plugin.
+
+Parameters not described by the specification are accepted.
+"""
+
+import re
+
+from command_scanner import InvalidCommandFormatError
+from spec_compiler import collect_arguments, json_value, render_signature, resolve
+
+# Nesting depth up to which schemas are validated, deeper values are accepted as is
+MAX_VALIDATION_DEPTH = 4
+MAX_ENUM_VALUES_SHOWN = 8
+
+_PATH_PARAMETER = re.compile(r"\{([^{}]+)\}")
+
+_TYPE_CHECKS = {
+    "string": lambda value: isinstance(value, str),
+    "integer": lambda value: (
+        isinstance(value, int) and not isinstance(value, bool)
+        or isinstance(value, float) and value.is_integer()
+    ),
+    "number": lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+    "boolean": lambda value: isinstance(value, bool),
+    "array": lambda value: isinstance(value, list),
+    "object": lambda value: isinstance(value, dict),
+    "null": lambda value: value is None,
+}
+
+_JSON_TYPES = {str: "string", bool: "boolean", int: "integer", float: "number", list: "array", dict: "object"}
+
+
+class InvalidCommandParametersError(InvalidCommandFormatError):
+    """
+    Exception raised when the parameters of a command do not match the operation.
+    """
+
+
+def compile_schema(schema, openapi_spec, depth=0, seen=()):
+    """
+    Compile a JSON schema into its compact validator form.
+    """
+    schema, seen = resolve(schema, openapi_spec, seen)
+    compiled = {}
+
+    # allOf parts are merged, anyOf / oneOf alternatives are kept
+    for part in schema.get("allOf", []):
+        part = compile_schema(part, openapi_spec, depth, seen)
+        compiled.setdefault("properties", {}).update(part.pop("properties", {}))
+        compiled.setdefault("required", []).extend(part.pop("required", []))
+        compiled.update(part)
+    alternatives = schema.get("anyOf") or schema.get("oneOf")
+    if alternatives:
+        compiled["anyOf"] = [compile_schema(part, openapi_spec, depth, seen) for part in alternatives]
+
+    schema_type = schema.get("type")
+    if schema_type is None and "properties" in schema:
+        schema_type = "object"
+    if schema_type is not None:
+        compiled["type"] = schema_type
+    if "enum" in schema:
+        # Compared with the values the model sees: dates parsed by YAML are strings in the instructions
+        compiled["enum"] = [json_value(value) for value in schema["enum"]]
+    if schema.get("nullable"):
+        compiled["nullable"] = True
+
+    if depth < MAX_VALIDATION_DEPTH:
+        if "items" in schema:
+            compiled["items"] = compile_schema(schema["items"], openapi_spec, depth + 1, seen)
+        if "properties" in schema:
+            compiled.setdefault("properties", {}).update({
+                name: compile_schema(property_schema, openapi_spec, depth + 1, seen)
+                for name, property_schema in schema["properties"].items()
+            })
+        if schema.get("required"):
+            compiled.setdefault("required", []).extend(schema["required"])
+    return compiled
+
+
+def compile_operation(operation_id, path, operation, path_item, openapi_spec):
+    """
+    Compile the validator of an operation.
+
+    Returns:
+        dict: The validator: "signature" (the call rendered as in the instructions),
+        "path_parameters" (names used by the path template) and "arguments"
+        (name -> {"required", "schema"}).
+    """
+    arguments = {}
+    parameters = list(path_item.get("parameters", [])) + list(operation.get("parameters", []))
+    for parameter in parameters:
+        parameter, _ = resolve(parameter, openapi_spec)
+        name = parameter.get("name")
+        if not name:
+            continue
+        if parameter.get("in") == "body":
+            # Swagger 2 body parameter: its properties are the arguments
+            arguments.update(_body_arguments(parameter.get("schema", {}), openapi_spec))
+            continue
+        arguments[name] = {
+            "required": bool(parameter.get("required")) or parameter.get("in") == "path",
+            "schema": compile_schema(parameter.get("schema", parameter), openapi_spec, 1),
+        }
+
+    request_body, _ = resolve(operation.get("requestBody", {}), openapi_spec)
+    content = request_body.get("content", {})
+    media = content.get("application/json") or next(iter(content.values()), {})
+    if media.get("schema"):
+        arguments.update(_body_arguments(media["schema"], openapi_spec))
+
+    return {
+        "signature": render_signature(operation_id, collect_arguments(operation, path_item, openapi_spec)),
+        "path_parameters": _PATH_PARAMETER.findall(path),
+        "arguments": arguments,
+    }
+
+
+def _body_arguments(schema, openapi_spec):
+    compiled = compile_schema(schema, openapi_spec)
+    properties = compiled.get("properties")
+    if not properties:
+        return {"body": {"required": True, "schema": compiled}}
+    required = set(compiled.get("required", []))
+    return {
+        name: {"required": name in required, "schema": property_schema}
+        for name, property_schema in properties.items()
+    }
+
+
+def _describe(value):
+    text = repr(value) if isinstance(value, str) else str(value)
+    if len(text) > 40:
+        text = text[:37] + "..."
+    return f"{_JSON_TYPES.get(type(value), type(value).__name__)} ({text})"
+
+
+def _check(value, schema, location, errors):
+    if value is None and schema.get("nullable"):
+        return errors
+    if "anyOf" in schema:
+        if not any(not _check(value, alternative, location, []) for alternative in schema["anyOf"]):
+            errors.append(f'"{location}" does not match any of the allowed schemas, got {_describe(value)}')
+            return errors
+
+    schema_type = schema.get("type")
+    if schema_type is not None:
+        if isinstance(schema_type, str):
+            check = _TYPE_CHECKS.get(schema_type)
+            valid = check is None or check(value)
+        else:
+            valid = any(_TYPE_CHECKS.get(name, lambda value: True)(value) for name in schema_type)
+        if not valid:
+            expected = schema_type if isinstance(schema_type, str) else " or ".join(schema_type)
+            errors.append(f'"{location}" must be {expected}, got {_describe(value)}')
+            return errors
+
+    if "enum" in schema and value not in schema["enum"]:
+        allowed = ", ".join(repr(choice) for choice in schema["enum"][:MAX_ENUM_VALUES_SHOWN])
+        if len(schema["enum"]) > MAX_ENUM_VALUES_SHOWN:
+            allowed += ", ..."
+        errors.append(f'"{location}" must be one of {allowed}, got {_describe(value)}')
+        return errors
+
+    if isinstance(value, dict):
+        for name in schema.get("required", []):
+            if name not in value:
+                errors.append(f'missing required field "{location}.{name}"')
+        for name, property_schema in schema.get("properties", {}).items():
+            if name in value:
+                _check(value[name], property_schema, f"{location}.{name}", errors)
+    elif isinstance(value, list) and "items" in schema:
+        for index, item in enumerate(value):
+            _check(item, schema["items"], f"{location}[{index}]", errors)
+    return errors
+
+
+def validate(validator, parameters):
+    """
+    Check the parameters of a command.
+
+    Args:
+        validator (dict): The validator of the operation, as returned by compile_operation.
+        parameters: The parameters of the command.
+
+    Returns:
+        list: The error messages, empty if the parameters are valid.
+    """
+    if not isinstance(parameters, dict):
+        return [f"the parameters must be a JSON object, got {_describe(parameters)}"]
+    errors = []
+    arguments = validator.get("arguments", {})
+    for name, argument in arguments.items():
+        if name not in parameters:
+            if argument["required"]:
+                errors.append(f'missing required parameter "{name}"')
+            continue
+        _check(parameters[name], argument["schema"], name, errors)
+    for name in validator.get("path_parameters", []):
+        if name not in parameters and name not in arguments:
+            errors.append(f'missing path parameter "{name}"')
+    return errors
+
+
+def check_command(plugin_name, operation_id, validator, parameters):
+    """
+    Raise InvalidCommandParametersError if the parameters of a command are invalid.
+    """
+    errors = validate(validator, parameters)
+    if errors:
+        raise InvalidCommandParametersError(
+            f"Error: Invalid parameters for {plugin_name}.{operation_id}: {'; '.join(errors)}. "
+            f"Expected: {plugin_name}.{validator.get('signature', operation_id)}"
+        )
@@ -0,0 +1,164 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Token-budgeted conversation window.
+
+The whole conversation is kept in MESSAGES, but only a window fitting the token
+budget of the model is sent. Pinned messages (the instructions sent at startup and
+the plugin instructions) are always sent; the oldest other messages are dropped first
+and replaced by a short note telling the model that part of the conversation was removed.
+
+Tokens are counted with tiktoken when it is installed, or estimated from the text
+length otherwise. Counts are cached per message content, so they are computed once.
+"""
+
+import functools
+import logging
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger('pluginspartylogger')
+
+# Context window sizes (in tokens), matched against the beginning of the model name
+MODEL_CONTEXT_SIZES = {
+    "gpt-4-32k": 32768,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-3.5-turbo": 4096,
+    "vicuna": 2048,
+    "stablevicuna": 2048,
+}
+DEFAULT_CONTEXT_SIZE = 2048
+
+# Token budget of the messages sent to the model, None for no limit
+BUDGET = None
+
+# Tokens added by the chat format for each message
+TOKENS_PER_MESSAGE = 4
+TRUNCATION_NOTE = "({count} earlier messages of the conversation were removed to fit the context window.)"
+TRUNCATION_ROLE = "system"
+
+_pinned = set()
+
+
+def context_size_for_model(model_name):
+    """
+    Return the context window size (in tokens) of a model.
+    """
+    for prefix, size in MODEL_CONTEXT_SIZES.items():
+        if model_name.startswith(prefix):
+            return size
+    return DEFAULT_CONTEXT_SIZE
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as anexception:
+        logger.debug("tiktoken unavailable (%s), estimating token counts", anexception)
+        return None
+
+
+@functools.lru_cache(maxsize=8192)
+def count_text_tokens(text):
+    """
+    Return the number of tokens of a text.
+    """
+    encoding = _get_encoding()
+    if encoding is None:
+        # Roughly 4 characters per token for English text
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message):
+    """
+    Return the number of tokens of a message, including the chat format overhead.
+    """
+    return TOKENS_PER_MESSAGE + count_text_tokens(message.get("content") or "")
+
+
+def pin(*messages):
+    """
+    Mark messages as always sent, whatever the budget.
+    """
+    _pinned.update(id(message) for message in messages)
+
+
+def unpin_all():
+    _pinned.clear()
+
+
+def is_pinned(message):
+    return id(message) in _pinned
+
+
+def fit(messages, budget=None):
+    """
+    Return the messages to send so that they fit the token budget.
+
+    Pinned messages and the last message are always kept. The other messages are kept from
+    the most recent one, as long as they fit, and the dropped ones are replaced by a single note.
+
+    Args:
+        messages (list): The whole conversation.
+        budget (int): The token budget. Defaults to BUDGET.
+
+    Returns:
+        list: The messages to send, in the conversation order.
+    """
+    if budget is None:
+        budget = BUDGET
+    if budget is None or not messages:
+        return messages
+
+    counts = [count_message_tokens(message) for message in messages]
+    if sum(counts) <= budget:
+        return messages
+
+    last_index = len(messages) - 1
+    keep = [is_pinned(message) for message in messages]
+    keep[last_index] = True
+    used = sum(count for count, kept in zip(counts, keep) if kept)
+    # Reserve room for the truncation note
+    used += TOKENS_PER_MESSAGE + count_text_tokens(TRUNCATION_NOTE.format(count=len(messages)))
+
+    for index in range(last_index - 1, -1, -1):
+        if keep[index]:
+            continue
+        if used + counts[index] > budget:
+            break
+        keep[index] = True
+        used += counts[index]
+
+    if used > budget:
+        logger.warning("Pinned messages alone exceed the context budget (%i tokens)", budget)
+
+    dropped = keep.count(False)
+    window = []
+    note_pending = False
+    for message, kept in zip(messages, keep):
+        if not kept:
+            note_pending = True
+        elif note_pending and dropped:
+            window.append({"role": TRUNCATION_ROLE, "content": TRUNCATION_NOTE.format(count=dropped)})
+            note_pending = dropped = 0
+        if kept:
+            window.append(message)
+    logger.debug("Context window: %i of %i messages sent", len(window), len(messages))
+    return window
@@ -0,0 +1,299 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Client of the model API.
+
+Every chat completion goes through create() (or acreate() from a coroutine), which adds
+to openai.ChatCompletion:
+- a keep-alive connection pool of POOL_SIZE connections shared by all the threads,
+- connect and read timeouts,
+- retries of rate limited (429), overloaded (5xx) and failed requests, with a jittered
+  exponential backoff honouring the Retry-After header,
+- a client-side rate limit per model (token bucket),
+- round-robin over several API bases (e.g. several local Vicuna servers): each request
+  goes to the next one, and a request that could not reach an API base is retried right
+  away on the next one. A request giving its own api_base is always sent there.
+
+A caller of create() can get hold of the HTTP response of a streamed completion as soon
+as its headers are received (on_response), to stop the stream from another thread with
+abort_response().
+
+Call configure() once the settings are set. The openai package, slow to import, is only
+imported by the first request, or in the background by preload().
+"""
+
+import email.utils
+import itertools
+import logging
+import random
+import socket
+import threading
+import time
+
+import tracing
+
+logger = logging.getLogger('pluginspartylogger')
+
+# API bases used in turn, openai.api_base if empty
+API_BASES = []
+# API key, openai.api_key (OPENAI_API_KEY) if None
+API_KEY = None
+# Timeouts (in seconds) to connect to the API and between two received bytes
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 120
+# Number of keep-alive connections kept per API base
+POOL_SIZE = 10
+# Number of retries of a failed request
+MAX_RETRIES = 4
+# Backoff (in seconds) before the first retry, doubled for each retry, and its maximum
+BACKOFF_BASE = 1
+BACKOFF_MAX = 30
+# Maximum number of requests per minute and per model, None for no limit
+REQUESTS_PER_MINUTE = None
+
+# Names of the openai.error exceptions retried, and of those meaning the API base could
+# not be reached (the next one is then tried without delay)
+RETRYABLE_ERRORS = ("RateLimitError", "ServiceUnavailableError", "APIConnectionError", "Timeout", "TryAgain")
+FAILOVER_ERRORS = ("APIConnectionError", "Timeout")
+
+_api_base_counter = itertools.count()
+_rate_limiter = None
+_openai = None
+_openai_lock = threading.Lock()
+# The on_response callback of the request sent by each thread
+_local = threading.local()
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the number of requests sent per minute to each model.
+
+    Args:
+        requests_per_minute (float): The sustained rate, None or 0 for no limit.
+        burst (int): The number of requests that can be sent at once after an idle period.
+    """
+
+    def __init__(self, requests_per_minute, burst=1):
+        self.rate = requests_per_minute / 60 if requests_per_minute else 0
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, model):
+        """
+        Take a token from the bucket of the model.
+
+        Returns:
+            float: The time (in seconds) to wait before sending the request.
+        """
+        if not self.rate:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            tokens, updated_at = self._buckets.get(model, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate) - 1
+            # A negative balance queues the request behind the ones already waiting
+            self._buckets[model] = (tokens, now)
+        return -tokens / self.rate if tokens < 0 else 0
+
+    def wait(self, model):
+        """
+        Block until a request can be sent to the model.
+        """
+        delay = self.reserve(model)
+        if delay:
+            time.sleep(delay)
+
+
+def _response_hook(response, *args, **kwargs):
+    # Run by requests, in the thread sending the request
+    on_response = getattr(_local, "on_response", None)
+    if on_response is not None:
+        on_response(response)
+
+
+def abort_response(response):
+    """
+    Abort the HTTP response of a streamed completion, from any thread.
+
+    Its socket is shut down: the thread reading the stream wakes up right away, the stream
+    ending or failing. That thread still has to close the response.
+    """
+    connection = getattr(response.raw, "_connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is None:
+        # The response owns the socket of a connection closed after it (http.client)
+        sock = getattr(getattr(getattr(getattr(response.raw, "_fp", None), "fp", None), "raw", None), "_sock", None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError as anexception:
+        logger.debug("Could not abort the model response: %s", anexception)
+
+
+def _setup_openai(openai):
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    if API_BASES:
+        openai.api_base = API_BASES[0]
+    if API_KEY:
+        openai.api_key = API_KEY
+    session = requests.Session()
+    session.hooks["response"].append(_response_hook)
+    # Retries are handled by create(), with a backoff
+    adapter = HTTPAdapter(pool_connections=max(1, len(API_BASES)), pool_maxsize=POOL_SIZE, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    openai.requestssession = session
+
+
+def get_openai():
+    """
+    Return the openai module, importing and setting it up on first use.
+    """
+    global _openai
+    if _openai is None:
+        with _openai_lock:
+            if _openai is None:
+                import openai
+                _setup_openai(openai)
+                _openai = openai
+    return _openai
+
+
+def preload():
+    """
+    Import openai in the background, while the startup goes on.
+    """
+    threading.Thread(target=get_openai, name="preload-openai", daemon=True).start()
+
+
+def configure():
+    """
+    Apply the settings: API bases and key, connection pool and rate limiter.
+    """
+    global _rate_limiter
+    _rate_limiter = RateLimiter(REQUESTS_PER_MINUTE)
+    if _openai is not None:
+        with _openai_lock:
+            _setup_openai(_openai)
+
+
+def _next_api_base():
+    if not API_BASES:
+        return None
+    return API_BASES[next(_api_base_counter) % len(API_BASES)]
+
+
+def _retry_after(error):
+    value = (getattr(error, "headers", None) or {}).get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_error(error, names):
+    return any(isinstance(error, getattr(_openai.error, name)) for name in names)
+
+
+def _is_retryable(error):
+    if _is_error(error, RETRYABLE_ERRORS):
+        return True
+    return isinstance(error, _openai.error.APIError) and (error.http_status or 500) >= 500
+
+
+def _retry_delay(error, attempt):
+    """
+    Return the delay before retrying a failed request, or None if it should not be retried.
+    """
+    if attempt >= MAX_RETRIES or not _is_retryable(error):
+        return None
+    if _is_error(error, FAILOVER_ERRORS) and attempt < len(API_BASES) - 1:
+        return 0
+    retry_after = _retry_after(error)
+    if retry_after is not None:
+        return min(retry_after, BACKOFF_MAX)
+    # Full jitter, so that clients rate limited together do not retry together
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def _request_args(completion_args):
+    request_args = dict(completion_args, request_timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    # A request may target its own API base (e.g. a local model), otherwise the bases are used in turn
+    if not request_args.get("api_base"):
+        request_args["api_base"] = _next_api_base()
+    return request_args
+
+
+def create(on_response=None, **completion_args):
+    """
+    Create a chat completion, see openai.ChatCompletion.create.
+
+    Args:
+        on_response (callable): Called with the HTTP response (requests.Response) of each
+            attempt, once its headers are received.
+    """
+    openai = get_openai()
+    for attempt in itertools.count():
+        if _rate_limiter is not None:
+            _rate_limiter.wait(completion_args.get("model"))
+        request_args = _request_args(completion_args)
+        _local.on_response = on_response
+        try:
+            return openai.ChatCompletion.create(**request_args)
+        except openai.error.OpenAIError as anexception:
+            delay = _retry_delay(anexception, attempt)
+            if delay is None:
+                raise
+            logger.warning(
+                "Model request to %s failed (%s), retrying in %.1fs",
+                request_args["api_base"] or openai.api_base, anexception, delay,
+            )
+            tracing.current().add("retries")
+            time.sleep(delay)
+        finally:
+            _local.on_response = None
+
+
+async def acreate(**completion_args):
+    """
+    Create a chat completion from a coroutine, see openai.ChatCompletion.acreate.
+    """
+    import asyncio
+
+    openai = get_openai()
+    for attempt in itertools.count():
+        if _rate_limiter is not None:
+            delay = _rate_limiter.reserve(completion_args.get("model"))
+            if delay:
+                await asyncio.sleep(delay)
+        request_args = _request_args(completion_args)
+        try:
+            return await openai.ChatCompletion.acreate(**request_args)
+        except openai.error.OpenAIError as anexception:
+            delay = _retry_delay(anexception, attempt)
+            if delay is None:
+                raise
+            logger.warning(
+                "Model request to %s failed (%s), retrying in %.1fs",
+                request_args["api_base"] or openai.api_base, anexception, delay,
+            )
+            await asyncio.sleep(delay)
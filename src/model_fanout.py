@@ -0,0 +1,369 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Fan-out of a prompt to several models.
+
+The same conversation (instructions and plugin preamble included) is sent to every
+target, a model optionally served by its own API base ("vicuna-13b@http://localhost:8000/v1").
+Each target runs its turn on its own thread, its answers streamed:
+
+- "race": the first target whose answer holds a valid plugin command (checked while the
+  answer is streamed) or is complete without any command wins. The HTTP responses of the
+  other targets are closed right away (or as soon as their headers are received), and
+  only the winner invokes the plugins and gets its final answer.
+- "compare": every target runs the whole turn (answer, plugin calls, final answer), and
+  the runs are reported side by side. Operations with side effects (methods other than
+  speculative_dispatch.SAFE_METHODS) are only invoked by the first target, whose turn is
+  the one kept, unless COMPARE_UNSAFE_CALLS is set.
+
+Each run records its time to first token, total time, streamed tokens (one per delta)
+and plugin calls, valid and successful.
+"""
+
+import json
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import context_window
+import llm_client
+import plugin_router
+import speculative_dispatch
+import tracing
+from command_scanner import CommandScanner, InvalidCommandFormatError, scan_commands
+
+logger = logging.getLogger('pluginspartylogger')
+
+MODES = ("race", "compare")
+MODE = "race"
+# (model, api base or None) pairs, no fan-out if empty
+TARGETS = []
+# JSONL file the runs are appended to, None to not save them
+OUTPUT_FILE = None
+# Whether every target invokes unsafe operations (POST...) in compare mode, not only the first one
+COMPARE_UNSAFE_CALLS = False
+
+
+def parse_targets(text):
+    """
+    Parse a comma-separated list of targets, each a model name optionally followed by
+    @ and its API base.
+
+    Returns:
+        list: (model, api base or None) pairs.
+    """
+    targets = []
+    for target in text.split(","):
+        model, _, api_base = target.strip().partition("@")
+        if model:
+            targets.append((model, api_base or None))
+    return targets
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class ModelRun:
+    """
+    The turn of a single target.
+
+    Args:
+        model (str): The model.
+        api_base (str): The API base the model is served by, None for the default ones.
+        messages (list): The conversation, extended with the messages of the turn.
+    """
+
+    def __init__(self, model, api_base, messages):
+        self.model = model
+        self.api_base = api_base
+        self.messages = messages
+        self.answer = None
+        self.final_answer = None
+        self.commands = 0
+        self.valid_commands = 0
+        self.successful_calls = 0
+        self.ttft = None
+        self.total = None
+        self.tokens = 0
+        self.error = None
+        self.winner = False
+        self.cancelled = threading.Event()
+        # The HTTP response of the completion being streamed
+        self.http_response = None
+
+    @property
+    def label(self):
+        return f"{self.model}@{self.api_base}" if self.api_base else self.model
+
+    @property
+    def plugin_success_rate(self):
+        """
+        The share of the commands of the answer that were valid and successfully invoked, or None.
+        """
+        return self.successful_calls / self.commands if self.commands else None
+
+    def cancel(self):
+        """
+        Stop the run: its HTTP response is aborted, the thread reading it wakes up.
+        """
+        self.cancelled.set()
+        response = self.http_response
+        if response is not None:
+            llm_client.abort_response(response)
+
+    def to_record(self):
+        return {
+            "model": self.model,
+            "api_base": self.api_base,
+            "answer": self.answer,
+            "final_answer": self.final_answer,
+            "commands": self.commands,
+            "valid_commands": self.valid_commands,
+            "successful_calls": self.successful_calls,
+            "plugin_success_rate": self.plugin_success_rate,
+            "ttft_seconds": self.ttft,
+            "total_seconds": self.total,
+            "tokens": self.tokens,
+            "tokens_per_second": self.tokens / self.total if self.total else None,
+            "winner": self.winner,
+            "cancelled": self.cancelled.is_set() and not self.winner,
+            "error": self.error,
+        }
+
+
+class ModelFanout:
+    """
+    Run a turn on several targets.
+
+    Args:
+        completion_args (dict): The chat completion arguments (temperature...), not modified.
+        validate (callable): Called with (plugin_operation, parameters), raises
+            InvalidCommandFormatError if the command is not valid.
+        invoke (callable): Called with (plugin_operation, parameters), returns the response.
+        get_method (callable): Called with plugin_operation, returns the HTTP method of the
+            operation, or None if it is unknown.
+        build_response_message (callable): Called with (commands, responses), returns the message
+            sending the responses back to the model.
+        invoke_plugins (bool): Whether plugin commands are invoked.
+    """
+
+    def __init__(self, completion_args, validate, invoke, get_method, build_response_message, invoke_plugins=True):
+        self.completion_args = dict(completion_args)
+        self.validate = validate
+        self.invoke = invoke
+        self.get_method = get_method
+        self.build_response_message = build_response_message
+        self.invoke_plugins = invoke_plugins
+
+    def run(self, messages, targets=None, mode=None):
+        """
+        Send a conversation, ending with the prompt, to every target.
+
+        Args:
+            messages (list): The conversation, not modified.
+            targets (list): (model, api base) pairs, TARGETS by default.
+            mode (str): One of MODES, MODE by default.
+
+        Returns:
+            list: The ModelRun of each target, in the order of the targets. In race mode,
+            the winner (if any) has its winner attribute set, and the result is returned as
+            soon as its turn is over: the other runs may still be stopping.
+        """
+        targets = TARGETS if targets is None else targets
+        mode = MODE if mode is None else mode
+        runs = [ModelRun(model, api_base, list(messages)) for model, api_base in targets]
+        race_lock = threading.Lock()
+
+        def decide(run):
+            # The first run to decide wins the race, the others are stopped
+            with race_lock:
+                if any(other.winner for other in runs):
+                    return
+                run.winner = True
+                for other in runs:
+                    if other is not run:
+                        other.cancel()
+            logger.info("%s won the race", run.label)
+
+        executor = ThreadPoolExecutor(max_workers=len(runs), thread_name_prefix="fanout")
+        try:
+            pending = {
+                executor.submit(
+                    self._run_turn,
+                    run,
+                    decide if mode == "race" else None,
+                    # In compare mode, side effects happen once, in the turn that is kept
+                    mode == "race" or index == 0 or COMPARE_UNSAFE_CALLS,
+                )
+                for index, run in enumerate(runs)
+            }
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                # A cancelled stream only stops at its next delta, the winner does not wait for it
+                if any(future.result().winner for future in done):
+                    break
+        finally:
+            executor.shutdown(wait=False)
+        return runs
+
+    def _complete(self, run, started_at, on_command=None):
+        def on_response(response):
+            run.http_response = response
+            # Cancelled while waiting for the headers
+            if run.cancelled.is_set():
+                llm_client.abort_response(response)
+
+        completion_args = dict(
+            self.completion_args,
+            model=run.model,
+            messages=context_window.fit(plugin_router.route(run.messages)),
+            stream=True,
+        )
+        if run.api_base:
+            completion_args["api_base"] = run.api_base
+        scanner = CommandScanner()
+        try:
+            # Aborting the HTTP response (see ModelRun.cancel) drops the connection, the model stops generating
+            for chunk in llm_client.create(on_response=on_response, **completion_args):
+                if run.cancelled.is_set():
+                    break
+                delta = chunk["choices"][0]["delta"]
+                if "content" not in delta:
+                    continue
+                if run.ttft is None:
+                    run.ttft = time.monotonic() - started_at
+                run.tokens += 1
+                for plugin_operation, parameters in scanner.feed(delta["content"]):
+                    if on_command is not None:
+                        on_command(plugin_operation, parameters)
+        except Exception:
+            # An aborted response ends the stream with an error, or not at all
+            if not run.cancelled.is_set():
+                raise
+        finally:
+            if run.http_response is not None:
+                run.http_response.close()
+                run.http_response = None
+        if run.cancelled.is_set():
+            raise _Cancelled()
+        run.messages.append({"role": "assistant", "content": scanner.text})
+        return scanner.text
+
+    def _run_turn(self, run, decide=None, invoke_unsafe=True):
+        started_at = time.monotonic()
+
+        def on_command(plugin_operation, parameters):
+            if run.winner:
+                return
+            try:
+                self.validate(plugin_operation, parameters)
+            except InvalidCommandFormatError as anexception:
+                logger.debug("%s: invalid command %s: %s", run.label, plugin_operation, anexception)
+                return
+            decide(run)
+
+        with tracing.span("model_run", model=run.model) as trace:
+            try:
+                run.answer = run.final_answer = self._complete(
+                    run, started_at, on_command if decide is not None else None
+                )
+                commands = scan_commands(run.answer)
+                if decide is not None and not commands:
+                    # A complete answer without any command
+                    decide(run)
+                if decide is None or run.winner:
+                    self._invoke_commands(run, commands, started_at, invoke_unsafe)
+            except _Cancelled:
+                logger.debug("%s: cancelled", run.label)
+            except Exception as anexception:
+                logger.info("%s: turn failed: %s", run.label, anexception)
+                run.error = str(anexception)
+            run.total = time.monotonic() - started_at
+            if trace.enabled:
+                trace.set("tokens", run.tokens)
+                if run.ttft is not None:
+                    trace.set("ttft_seconds", run.ttft)
+                trace.set("commands", run.commands)
+        return run
+
+    def _invoke_commands(self, run, commands, started_at, invoke_unsafe=True):
+        run.commands = len(commands)
+        if not commands or not self.invoke_plugins:
+            return
+        responses = []
+        for plugin_operation, parameters in commands:
+            try:
+                self.validate(plugin_operation, parameters)
+                run.valid_commands += 1
+                method = self.get_method(plugin_operation)
+                if not invoke_unsafe and not speculative_dispatch.is_safe_method(method):
+                    logger.info("%s: not invoking %s %s in compare mode", run.label, method, plugin_operation)
+                    responses.append(f"Error: {method} operation not invoked, only the first model invokes operations with side effects")
+                    continue
+                response = self.invoke(plugin_operation, parameters)
+            except Exception as anexception:
+                responses.append(f"Error: Plugin invocation failed: {anexception}")
+                continue
+            if not str(response).lstrip().startswith("Error"):
+                run.successful_calls += 1
+            responses.append(response)
+        if not run.valid_commands:
+            raise InvalidCommandFormatError(responses[0])
+        run.messages.append(self.build_response_message(commands, responses))
+        run.final_answer = self._complete(run, started_at)
+
+
+def save_runs(prompt, runs, mode=None):
+    """
+    Append the runs of a prompt to OUTPUT_FILE, one JSON object per line.
+    """
+    if OUTPUT_FILE is None:
+        return
+    with open(OUTPUT_FILE, "a", encoding="utf-8") as file:
+        for run in runs:
+            file.write(json.dumps(dict(run.to_record(), prompt=prompt, mode=mode or MODE), default=str) + "\n")
+
+
+def print_comparison(runs, console):
+    """
+    Print the runs side by side, as a table.
+    """
+    from rich.table import Table
+
+    def seconds(value):
+        return f"{value:.2f}s" if value is not None else "-"
+
+    table = Table(title="Models")
+    for column in ("Model", "TTFT", "Total", "Tokens", "Tokens/s", "Plugin calls", "Result"):
+        table.add_column(column, justify="left" if column in ("Model", "Result") else "right")
+    for run in runs:
+        record = run.to_record()
+        if run.error:
+            result = "error"
+        elif run.winner:
+            result = "won"
+        elif record["cancelled"]:
+            result = "cancelled"
+        else:
+            result = "ok"
+        table.add_row(
+            run.label,
+            seconds(run.ttft),
+            seconds(run.total),
+            str(run.tokens),
+            f"{record['tokens_per_second']:.1f}" if record["tokens_per_second"] else "-",
+            f"{run.successful_calls}/{run.commands}" if run.commands else "-",
+            result,
+        )
+    console.print(table)
@@ -0,0 +1,218 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Precompiled table of plugin operations.
+
+When a plugin is registered, each operation of its request stubs is compiled into an
+Operation: interned names, the full URL template split into literal and parameter
+parts, and the request headers with the bearer token already read from
+plugins/<name>/bearer.secret. Invoking a command is then a dictionary lookup, without
+any file access.
+
+The table can be saved in a compact binary file (marshal) and loaded back with a single
+read of the memory-mapped file, e.g. along with the preamble snapshot. Bearer tokens are
+not saved: they are read again, once per plugin, when the table is loaded.
+"""
+
+import logging
+import marshal
+import mmap
+import os
+import string
+import sys
+import threading
+
+import plugin_cache
+
+logger = logging.getLogger('pluginspartylogger')
+
+# Bump when the layout of the saved table changes
+TABLE_VERSION = 1
+MAGIC = b"PPOT"
+_HEADER = MAGIC + TABLE_VERSION.to_bytes(2, "little")
+
+_formatter = string.Formatter()
+_lock = threading.Lock()
+# (plugin name, operation id) -> Operation
+_operations = {}
+# plugin name -> operation ids, in order
+_plugins = {}
+
+
+class Operation:
+    """
+    A compiled plugin operation.
+
+    Args:
+        plugin_name (str): The name of the plugin.
+        operation_id (str): The id of the operation.
+        method (str): The HTTP method.
+        url_parts (tuple): (literal, parameter name or None) pairs making the URL.
+        headers (dict): The request headers, not to be modified.
+        validator (dict): The validator of the parameters (see command_validator), or None.
+    """
+
+    __slots__ = ("plugin_name", "operation_id", "method", "url_parts", "headers", "validator")
+
+    def __init__(self, plugin_name, operation_id, method, url_parts, headers, validator):
+        self.plugin_name = plugin_name
+        self.operation_id = operation_id
+        self.method = method
+        self.url_parts = url_parts
+        self.headers = headers
+        self.validator = validator
+
+    def url(self, parameters):
+        """
+        Build the URL of a request, path parameters being taken from the command parameters.
+
+        Raises:
+            KeyError: If a path parameter is missing.
+        """
+        if len(self.url_parts) == 1 and self.url_parts[0][1] is None:
+            return self.url_parts[0][0]
+        return "".join(
+            literal if name is None else f"{literal}{parameters[name]}"
+            for literal, name in self.url_parts
+        )
+
+
+def compile_url(api_url, path):
+    """
+    Split the URL template of an operation into (literal, parameter name or None) pairs.
+    """
+    parts = [
+        (literal, sys.intern(name) if name is not None else None)
+        for literal, name, _, _ in _formatter.parse(path)
+    ]
+    base = (api_url or "").rstrip("/")
+    if parts:
+        parts[0] = (base + parts[0][0], parts[0][1])
+    else:
+        parts = [(base, None)]
+    return tuple(parts)
+
+
+def read_headers(plugin_name):
+    """
+    Build the request headers of a plugin, with its bearer token if any.
+    """
+    headers = {"Content-Type": "application/json"}
+    bearer_file = os.path.join(plugin_cache.PLUGINS_DIR, plugin_name, "bearer.secret")
+    if os.path.exists(bearer_file):
+        with open(bearer_file, "r", encoding="utf-8") as myfile:
+            headers["Authorization"] = f"Bearer {myfile.read().strip()}"
+    return headers
+
+
+def _add(headers_by_plugin, rows):
+    with _lock:
+        for plugin_name in headers_by_plugin:
+            for operation_id in _plugins.pop(plugin_name, []):
+                _operations.pop((plugin_name, operation_id), None)
+            _plugins[sys.intern(plugin_name)] = []
+        for plugin_name, operation_id, method, url_parts, validator in rows:
+            plugin_name = sys.intern(plugin_name)
+            operation_id = sys.intern(operation_id)
+            _operations[(plugin_name, operation_id)] = Operation(
+                plugin_name, operation_id, sys.intern(method), url_parts, headers_by_plugin[plugin_name], validator
+            )
+            _plugins[plugin_name].append(operation_id)
+
+
+def add_plugin(plugin_name, stub):
+    """
+    Compile the request stub of a plugin into the table, replacing its previous operations.
+    """
+    api_url = stub.get("api", {}).get("url")
+    rows = [
+        (plugin_name, operation_id, operation_stub["method"], compile_url(api_url, operation_stub["path"]),
+         operation_stub.get("validator"))
+        for operation_id, operation_stub in stub.get("operations", {}).items()
+    ]
+    _add({plugin_name: read_headers(plugin_name)}, rows)
+
+
+def clear():
+    with _lock:
+        _operations.clear()
+        _plugins.clear()
+
+
+def get(plugin_name, operation_id):
+    """
+    Return the compiled operation, or None if the plugin or the operation is unknown.
+    """
+    return _operations.get((plugin_name, operation_id))
+
+
+def get_plugin_names():
+    return list(_plugins)
+
+
+def get_operation_ids(plugin_name):
+    """
+    Return the operation ids of a plugin, or None if the plugin is unknown.
+    """
+    return _plugins.get(plugin_name)
+
+
+def save(path):
+    """
+    Save the table (without the headers) to a file.
+
+    Returns:
+        bool: True if the table was saved, False if it holds values that cannot be saved.
+    """
+    with _lock:
+        rows = [
+            (operation.plugin_name, operation.operation_id, operation.method, operation.url_parts, operation.validator)
+            for operation in _operations.values()
+        ]
+        plugin_names = list(_plugins)
+    try:
+        data = marshal.dumps((plugin_names, rows))
+    except ValueError as anexception:
+        # e.g. dates in enums of a YAML specification
+        logger.warning("The operation table cannot be saved: %s", anexception)
+        return False
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(_HEADER)
+        file.write(data)
+    os.replace(tmp_path, path)
+    return True
+
+
+def load(path):
+    """
+    Load a table saved by save(), replacing the operations of the plugins it holds.
+
+    Returns:
+        bool: True if the table was loaded, False if the file is missing or unreadable.
+    """
+    try:
+        with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:len(_HEADER)] != _HEADER:
+                logger.warning("Ignoring operation table %s: unknown format", path)
+                return False
+            with memoryview(mapped) as view:
+                plugin_names, rows = marshal.loads(view[len(_HEADER):])
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError, EOFError, TypeError) as anexception:
+        logger.warning("Ignoring unreadable operation table %s: %s", path, anexception)
+        return False
+
+    # Bearer tokens are read once per plugin, here
+    _add({plugin_name: read_headers(plugin_name) for plugin_name in plugin_names}, rows)
+    return True
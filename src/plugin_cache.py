@@ -0,0 +1,236 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Offline-first cache of plugin manifests and OpenAPI specifications.
+
+Artifacts are stored in plugins/<name_for_model>/ (ai-plugin.json and openapi.yaml)
+together with a cache.json file holding, for each artifact, its source URL, the
+ETag / Last-Modified validators returned by the server and the time it was last
+fetched or revalidated.
+
+An artifact younger than CACHE_TTL seconds is served straight from disk. An older
+one is revalidated with a conditional request (If-None-Match / If-Modified-Since);
+a stale copy is still served if the server cannot be reached. In OFFLINE mode no
+request is ever made.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('pluginspartylogger')
+
+PLUGINS_DIR = "plugins"
+CACHE_FILE = "cache.json"
+ARTIFACTS = {
+    "manifest": "ai-plugin.json",
+    "openapi": "openapi.yaml",
+}
+
+# Time (in seconds) during which a cached artifact is served without revalidation
+CACHE_TTL = 24 * 3600
+# Never access the network, serve everything from the cache
+OFFLINE = False
+# Timeout (in seconds) applied to the requests made by the cache
+FETCH_TIMEOUT = 30
+
+# Served from disk without any request
+SOURCE_CACHE = "cache"
+# Served from disk after a 304 Not Modified answer
+SOURCE_REVALIDATED = "revalidated"
+# Served from disk because revalidation failed
+SOURCE_STALE = "stale"
+# Downloaded
+SOURCE_NETWORK = "network"
+
+_lock = threading.Lock()
+# manifest URL -> plugin directory, built lazily from the cache.json files
+_index = None
+
+
+class PluginCacheMissError(Exception):
+    """
+    Exception raised when an artifact is needed in offline mode but is not cached.
+    """
+
+
+def _read_metadata(plugin_dir):
+    try:
+        with open(os.path.join(plugin_dir, CACHE_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_file(path, content):
+    # Write then rename, so an interrupted write never leaves a truncated file behind
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _build_index():
+    index = {}
+    if not os.path.isdir(PLUGINS_DIR):
+        return index
+    for entry in os.scandir(PLUGINS_DIR):
+        if not entry.is_dir():
+            continue
+        manifest_url = _read_metadata(entry.path).get("manifest", {}).get("url")
+        if manifest_url:
+            index[manifest_url] = entry.path
+    return index
+
+
+def lookup_plugin_dir(manifest_url):
+    """
+    Return the cache directory of the plugin whose manifest was fetched from manifest_url,
+    or None if this manifest has never been cached.
+    """
+    global _index
+    with _lock:
+        if _index is None:
+            _index = _build_index()
+        return _index.get(manifest_url)
+
+
+def fingerprint(manifest_url):
+    """
+    Return a hash of the cached artifacts of a plugin, provided they can all be served
+    from the cache without any request (see fetch()).
+
+    Args:
+        manifest_url (str): The URL of the plugin manifest.
+
+    Returns:
+        str: The hex digest of the artifacts URLs and contents, or None if the plugin is not
+        cached or if any of its artifacts would need to be revalidated.
+    """
+    plugin_dir = lookup_plugin_dir(manifest_url)
+    if plugin_dir is None:
+        return None
+    all_metadata = _read_metadata(plugin_dir)
+    if all_metadata.get("manifest", {}).get("url") != manifest_url:
+        return None
+
+    digest = hashlib.sha256()
+    for artifact, filename in ARTIFACTS.items():
+        metadata = all_metadata.get(artifact)
+        if not metadata or not (OFFLINE or time.time() - metadata.get("fetched_at", 0) < CACHE_TTL):
+            return None
+        try:
+            with open(os.path.join(plugin_dir, filename), "rb") as f:
+                content = f.read()
+        except OSError:
+            return None
+        digest.update(metadata.get("url", "").encode("utf-8") + b"\0")
+        digest.update(content + b"\0")
+    return digest.hexdigest()
+
+
+def fetch(url, artifact, plugin_dir=None):
+    """
+    Get an artifact, from the cache when possible.
+
+    Args:
+        url (str): The URL of the artifact.
+        artifact (str): The artifact kind, a key of ARTIFACTS.
+        plugin_dir (str): The plugin cache directory. When None, it is looked up from the
+            manifest URL (only possible for manifests).
+
+    Returns:
+        tuple: (content, metadata, source) where content is the artifact text (None if the
+        server answered with an error), metadata the cache entry to pass to save() and source
+        one of SOURCE_CACHE, SOURCE_REVALIDATED, SOURCE_STALE or SOURCE_NETWORK. A request
+        was made for every source but SOURCE_CACHE.
+
+    Raises:
+        PluginCacheMissError: In offline mode, if the artifact is not cached.
+    """
+    if plugin_dir is None and artifact == "manifest":
+        plugin_dir = lookup_plugin_dir(url)
+
+    metadata = _read_metadata(plugin_dir).get(artifact) if plugin_dir else None
+    path = os.path.join(plugin_dir, ARTIFACTS[artifact]) if plugin_dir else None
+    cached = bool(metadata) and metadata.get("url") == url and os.path.exists(path)
+
+    def read_cached():
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    if cached and (OFFLINE or time.time() - metadata.get("fetched_at", 0) < CACHE_TTL):
+        logger.debug("Serving %s from cache", url)
+        return read_cached(), metadata, SOURCE_CACHE
+
+    if OFFLINE:
+        raise PluginCacheMissError(f"Offline mode: {url} is not cached")
+
+    headers = {}
+    if cached:
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+
+    # Imported here: plugins served from the cache or a snapshot need no HTTP client
+    import requests
+
+    try:
+        response = requests.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+    except requests.RequestException as anexception:
+        if not cached:
+            raise
+        logger.warning("Could not revalidate %s (%s), serving stale copy", url, anexception)
+        return read_cached(), metadata, SOURCE_STALE
+
+    if cached and response.status_code == 304:
+        logger.debug("%s not modified", url)
+        metadata = dict(metadata, fetched_at=time.time())
+        return read_cached(), metadata, SOURCE_REVALIDATED
+
+    if response.status_code != 200:
+        if cached:
+            logger.warning("Error fetching %s: %i, serving stale copy", url, response.status_code)
+            return read_cached(), metadata, SOURCE_STALE
+        logger.error("Error fetching %s: %i", url, response.status_code)
+        return None, None, SOURCE_NETWORK
+
+    metadata = {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "fetched_at": time.time(),
+    }
+    return response.text, metadata, SOURCE_NETWORK
+
+
+def save(plugin_dir, artifact, content, metadata, source):
+    """
+    Persist an artifact returned by fetch() into the plugin cache directory.
+
+    Nothing is written for artifacts served from the cache without a successful request.
+    """
+    if source in (SOURCE_CACHE, SOURCE_STALE):
+        return
+    os.makedirs(plugin_dir, exist_ok=True)
+    with _lock:
+        if source == SOURCE_NETWORK:
+            _write_file(os.path.join(plugin_dir, ARTIFACTS[artifact]), content)
+        all_metadata = _read_metadata(plugin_dir)
+        all_metadata[artifact] = metadata
+        _write_file(os.path.join(plugin_dir, CACHE_FILE), json.dumps(all_metadata, indent=2))
+        if artifact == "manifest" and _index is not None:
+            _index[metadata["url"]] = plugin_dir
@@ -0,0 +1,131 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pooled HTTP client used to invoke plugin operations.
+
+One keep-alive session is kept per plugin host, so chained calls to the same plugin
+reuse an already established TCP/TLS connection. Idempotent requests are retried with
+exponential backoff on connection errors and on 429/5xx answers.
+
+Response bodies can be streamed (stream=True) and read with read_body(), which stops
+after MAX_RESPONSE_BYTES: a huge response is never held in memory.
+"""
+
+import logging
+import threading
+from urllib.parse import urlparse
+
+logger = logging.getLogger('pluginspartylogger')
+
+# Time (in seconds) allowed to establish a connection to a plugin host
+CONNECT_TIMEOUT = 5
+# Time (in seconds) allowed between two bytes received from a plugin host
+READ_TIMEOUT = 30
+# Maximum number of connections kept alive per plugin host
+POOL_SIZE = 4
+# Maximum number of retries of an idempotent request
+MAX_RETRIES = 2
+# Backoff factor between retries: 0.5s, 1s, 2s...
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Maximum number of bytes read from a response body, the rest is dropped
+MAX_RESPONSE_BYTES = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def _create_session():
+    # Imported with the first plugin request: requests and urllib3 are slow to import
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(url):
+    """
+    Return the keep-alive session dedicated to the host of the given URL, creating it if needed.
+    """
+    parsed_url = urlparse(url)
+    host = (parsed_url.scheme, parsed_url.netloc)
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            logger.debug("Opening HTTP session for %s://%s", *host)
+            session = _sessions[host] = _create_session()
+        return session
+
+
+def request(method, url, **kwargs):
+    """
+    Send a request through the pooled session of the URL host.
+
+    Accepts the same arguments as requests.request. When no timeout is given, the
+    CONNECT_TIMEOUT and READ_TIMEOUT settings are applied.
+    """
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return get_session(url).request(method, url, **kwargs)
+
+
+def read_body(response, max_bytes=None):
+    """
+    Read the body of a streamed response, up to max_bytes (MAX_RESPONSE_BYTES by default).
+
+    The response is closed: its connection goes back to the pool if the body was read
+    entirely, it is dropped otherwise.
+
+    Returns:
+        tuple: (body, truncated) where body is the bytes read and truncated tells if the
+        body was longer than max_bytes.
+    """
+    max_bytes = MAX_RESPONSE_BYTES if max_bytes is None else max_bytes
+    chunks = []
+    size = 0
+    truncated = False
+    try:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            if size + len(chunk) > max_bytes:
+                chunks.append(chunk[:max_bytes - size])
+                truncated = True
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+    finally:
+        response.close()
+    if truncated:
+        logger.info("Response of %s truncated to %i bytes", response.url, max_bytes)
+    return b"".join(chunks), truncated
+
+
+def close():
+    """
+    Close all the pooled sessions.
+    """
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -0,0 +1,187 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local plugin routing.
+
+The instructions of each registered plugin (its description_for_model and the summary
+of its operations) are indexed with BM25. For each request, the last QUERY_MESSAGES
+messages of the conversation are used as the query and only the instructions of the
+TOP_K best matching plugins are sent, so the prompt size does not grow with the number
+of registered plugins. The other instructions stay in the conversation and can be
+selected on a later turn.
+
+Routing is disabled when TOP_K is None: every plugin instruction is then sent.
+"""
+
+import logging
+import math
+import re
+import threading
+from collections import Counter
+
+import context_window
+
+logger = logging.getLogger('pluginspartylogger')
+
+# Number of plugins whose instructions are sent with each request, None to send them all
+TOP_K = None
+# Number of recent messages (user prompts, answers, plugin responses) making the query
+QUERY_MESSAGES = 4
+# Plugins scoring less than this fraction of the best score are not sent, so that words
+# shared by all the plugin instructions do not fill the top k
+MIN_RELATIVE_SCORE = 0.1
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+
+_WORD = re.compile(r"\w+")
+# Parts of identifiers, splitting camelCase, snake_case and digits (getWeather -> get, weather)
+_PART = re.compile(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+")
+
+
+def tokenize(text):
+    """
+    Split a text into lowercase terms, identifiers giving both the whole word and its parts.
+    """
+    terms = []
+    for word in _WORD.findall(text):
+        terms.append(word.lower())
+        parts = _PART.findall(word)
+        if len(parts) > 1:
+            terms.extend(part.lower() for part in parts)
+    return terms
+
+
+class BM25Index:
+    """
+    Incremental BM25 index of short documents.
+    """
+
+    def __init__(self, k1=K1, b=B):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}
+        self._lengths = {}
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def add(self, doc_id, text):
+        """
+        Index a document, replacing any document with the same id.
+        """
+        self.remove(doc_id)
+        terms = Counter(tokenize(text))
+        for term, frequency in terms.items():
+            self._postings.setdefault(term, {})[doc_id] = frequency
+        length = sum(terms.values())
+        self._lengths[doc_id] = length
+        self._total_length += length
+
+    def remove(self, doc_id):
+        length = self._lengths.pop(doc_id, None)
+        if length is None:
+            return
+        self._total_length -= length
+        for term in list(self._postings):
+            postings = self._postings[term]
+            if postings.pop(doc_id, None) is not None and not postings:
+                del self._postings[term]
+
+    def search(self, query, top_k):
+        """
+        Return the ids of the top_k documents matching the query, best first.
+
+        Returns:
+            list: (doc_id, score) tuples, documents with a null score are not returned.
+        """
+        if not self._lengths:
+            return []
+        documents = len(self._lengths)
+        average_length = self._total_length / documents
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (documents - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings.items():
+                normalization = self.k1 * (1 - self.b + self.b * self._lengths[doc_id] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0) + idf * frequency * (self.k1 + 1) / (frequency + normalization)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:top_k]
+
+
+_lock = threading.Lock()
+_index = BM25Index()
+# plugin name -> instruction message, and id(instruction message) -> plugin name
+_plugin_messages = {}
+_message_plugins = {}
+
+
+def add(plugin_name, message):
+    """
+    Index the instruction message of a plugin.
+    """
+    with _lock:
+        previous = _plugin_messages.get(plugin_name)
+        if previous is not None:
+            _message_plugins.pop(id(previous), None)
+        _plugin_messages[plugin_name] = message
+        _message_plugins[id(message)] = plugin_name
+        _index.add(plugin_name, message["content"])
+
+
+def get_plugin_name(message):
+    """
+    Return the name of the plugin a message holds the instructions of, or None.
+    """
+    return _message_plugins.get(id(message))
+
+
+def select(query, top_k=None):
+    """
+    Return the names of the plugins best matching a query.
+    """
+    with _lock:
+        ranked = _index.search(query, top_k or TOP_K)
+    if not ranked:
+        return []
+    best_score = ranked[0][1]
+    return [plugin_name for plugin_name, score in ranked if score >= best_score * MIN_RELATIVE_SCORE]
+
+
+def route(messages):
+    """
+    Keep only the instructions of the plugins relevant to the recent messages.
+
+    Args:
+        messages (list): The conversation.
+
+    Returns:
+        list: The conversation without the instructions of the other plugins, or the
+        conversation itself if routing is disabled.
+    """
+    if TOP_K is None or not _plugin_messages:
+        return messages
+    # The instructions are pinned, the query is made of the conversation itself
+    recent = [message for message in messages if not context_window.is_pinned(message)]
+    query = " ".join(message["content"] for message in recent[-QUERY_MESSAGES:])
+    selected = set(select(query))
+    logger.debug("Plugins routed: %s", ", ".join(sorted(selected)) or "none")
+    routed = []
+    for message in messages:
+        plugin_name = _message_plugins.get(id(message))
+        if plugin_name is None or plugin_name in selected:
+            routed.append(message)
+    return routed
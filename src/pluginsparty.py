@@ -18,46 +18,46 @@ Pluginsparty
 # from fastchat.client import openai_api_client
 
 import argparse
+import contextlib
 import json
 import logging
 import os
 import re
-import subprocess
+import sys
+import threading
+import time
 import warnings
-
-import openai
-import requests
-from halo import Halo
-from rich.console import Console
-from rich.markdown import Markdown
-
-import register_plugin
-from register_plugin import get_plugins_stubs, register_plugin
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import batch_runner
+import code_runner
+import context_window
+import llm_client
+import model_fanout
+import operation_table
+from command_scanner import CommandScanner, InvalidCommandFormatError, scan_commands
+from command_validator import InvalidCommandParametersError, check_command
+import plugin_cache
+import plugin_http
+import plugin_router
+import preamble_snapshot
+import response_cache
+import response_condenser
+import session_store
+import spec_compiler
+import speculative_dispatch
+import tracing
+from stream_renderer import MarkdownStreamRenderer, get_console
+from register_plugin import (
+    add_plugin,
+    get_manifest_url,
+    get_plugin_template_path,
+    get_registration_stats,
+    prepare_plugin,
+)
 
 LOGGER = logging.getLogger("pluginspartyLOGGER")
 
-def initialize_logger(log_level):
-    """
-    Initialize a LOGGER with the given log level.
-
-    This function sets up a global LOGGER with the specified log level and a predefined log format.
-    The log level is expected to be a string that corresponds to one of the standard logging levels
-    ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"). If the provided log level is not valid,
-    the logging module's `getLevelName` function will return an integer, and basicConfig will 
-    raise a ValueError.
-
-    Args:
-        log_level (str): The desired log level as a string.
-
-    Returns:
-        None
-    """
-    global LOGGER
-    numeric_log_level = logging.getLevelName(log_level.upper())
-    logging.basicConfig(level=numeric_log_level, format=LOG_FORMAT)
-    LOGGER = logging.getLogger("pluginpartyLOGGER")
-
-
 # Initialize the global variable chat_completion_args with default values
 CHAT_COMPLETION_ARGS = {
     "model": "gpt-3.5-turbo-0301",
@@ -73,8 +73,35 @@ INSTRUCTION_ROLE = "system"
 MESSAGES = []
 
 
-PLUGIN_INSTRUCTIONS = {}
-SPINNER = Halo(text="", spinner="dot1")
+# Maximum number of plugins registered concurrently at startup
+PLUGIN_REGISTRATION_CONCURRENCY = 8
+# Maximum wall-clock time (in seconds) allowed for a single plugin registration
+PLUGIN_REGISTRATION_TIMEOUT = 30
+# How the greeting is obtained once the instructions are set: "model" waits for it,
+# "defer" requests it in the background, "skip" never requests it
+GREETING_MODES = ["model", "defer", "skip"]
+# Set once the user submitted the first prompt, a deferred greeting is then no longer shown
+FIRST_PROMPT_SUBMITTED = threading.Event()
+# Stop reading the answer once it goes on with text after its plugin commands
+STOP_STREAM_ON_COMMAND = False
+# Created on first use, see get_spinner
+SPINNER = None
+# The log the conversation is saved to, see session_store
+SESSION = None
+
+
+def get_spinner():
+    """
+    Return the spinner shown while waiting for the model.
+
+    halo (and the IPython detection it runs) is only imported once a spinner is needed.
+    """
+    global SPINNER
+    if SPINNER is None:
+        from halo import Halo
+
+        SPINNER = Halo(text="", spinner="dot1")
+    return SPINNER
 
 
 def get_instructions_for_plugin(plugin_url, model_name):
@@ -91,21 +118,65 @@ def get_instructions_for_plugin(plugin_url, model_name):
     Returns:
     dict: A dictionary containing the role and content of the instructions, or None if an exception is raised.
     """
+    prepared = prepare_plugin_instructions(plugin_url, model_name)
+    if prepared is None:
+        return None
+    return add_plugin_instructions(prepared)
+
+
+def prepare_plugin_instructions(plugin_url, model_name, user_input=contextlib.nullcontext):
+    """
+    Fetch and render a plugin without adding it, see `get_instructions_for_plugin`.
+
+    Args:
+        plugin_url (str): The URL of the plugin.
+        model_name (str): The name of the model.
+        user_input (callable): Returns a context manager wrapping the time spent waiting for the user.
+
+    Returns:
+        tuple: The plugin name, request stub, instruction and registration stats, to be passed to
+        `add_plugin_instructions`, or None if an exception is raised.
+    """
     try:
-        _, _, instructions_str = register_plugin(plugin_url, model_name)
+        with tracing.span("register_plugin", url=plugin_url) as trace:
+            plugin_name, stub, instructions_str, stats = prepare_plugin(plugin_url, model_name, user_input)
+            if trace.enabled:
+                trace.set("plugin", plugin_name)
+                trace.attributes.update(stats)
         # Call create_model_instructions to get instructions for each plugin
-        return {"role": INSTRUCTION_ROLE, "content": instructions_str}
+        instruction = {"role": INSTRUCTION_ROLE, "content": instructions_str}
+        return plugin_name, stub, instruction, stats
     except Exception as anexception:
         print("Error processing plugin at %s: %s", plugin_url ,anexception)
         return None
 
 
+def add_plugin_instructions(prepared):
+    """
+    Add a plugin prepared by `prepare_plugin_instructions`: its operations become invocable and
+    its instruction is indexed by the plugin router.
+
+    Returns:
+        dict: The instruction.
+    """
+    plugin_name, stub, instruction, stats = prepared
+    add_plugin(plugin_name, stub, stats)
+    plugin_router.add(plugin_name, instruction)
+    return instruction
+
+
 def get_instructions_for_plugins(plugins, model_name):
     """
     Get the instructions for multiple plugins.
 
-    This function iterates over the provided list of plugins, calling `get_instructions_for_plugin` 
-    for each one, and appends the returned instructions to a list.
+    This function registers the provided plugins concurrently on a bounded worker pool 
+    (see PLUGIN_REGISTRATION_CONCURRENCY), so startup time grows with the slowest plugin 
+    rather than with the sum of all of them. A plugin whose registration takes longer than 
+    PLUGIN_REGISTRATION_TIMEOUT seconds, not counting the time spent waiting for the user to 
+    enter a bearer token, is skipped. Plugins are only added once their registration is over, 
+    from this thread: a skipped plugin is never added, even if its registration ends later. 
+    The returned instructions always follow the order of the provided list, whatever the 
+    completion order, so prompts stay reproducible.
 
     Args:
         plugins (list): A list of plugin URLs.
@@ -114,23 +185,108 @@ def get_instructions_for_plugins(plugins, model_name):
     Returns:
         list: A list of dictionaries, each containing the role and content of the instructions for a single plugin.
     """
+    if not plugins:
+        return []
+
+    started_at = {}
+    # Registrations waiting for the user, their deadline is suspended
+    waiting_for_user = set()
+
+    def register(index, plugin_url):
+        @contextlib.contextmanager
+        def user_input():
+            waiting_since = time.monotonic()
+            waiting_for_user.add(index)
+            try:
+                yield
+            finally:
+                started_at[index] += time.monotonic() - waiting_since
+                waiting_for_user.discard(index)
+
+        started_at[index] = time.monotonic()
+        return prepare_plugin_instructions(plugin_url, model_name, user_input)
+
+    workers = max(1, min(PLUGIN_REGISTRATION_CONCURRENCY, len(plugins)))
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="register")
+    futures = [
+        executor.submit(register, index, plugin_url)
+        for index, plugin_url in enumerate(plugins)
+    ]
+    pending = set(range(len(futures)))
+    timed_out = set()
+
+    try:
+        while pending:
+            now = time.monotonic()
+            # Wake up either on the next completion or on the closest registration deadline
+            deadlines = [
+                started_at[index] + PLUGIN_REGISTRATION_TIMEOUT - now
+                for index in pending
+                if index in started_at and index not in waiting_for_user
+            ]
+            timeout = max(0, min(deadlines, default=PLUGIN_REGISTRATION_TIMEOUT))
+            wait([futures[index] for index in pending], timeout=timeout, return_when=FIRST_COMPLETED)
+
+            now = time.monotonic()
+            for index in list(pending):
+                if futures[index].done():
+                    pending.discard(index)
+                elif (
+                    index in started_at
+                    and index not in waiting_for_user
+                    and now - started_at[index] > PLUGIN_REGISTRATION_TIMEOUT
+                ):
+                    LOGGER.warning(
+                        "Registration of plugin %s timed out after %ss - skipping",
+                        plugins[index],
+                        PLUGIN_REGISTRATION_TIMEOUT,
+                    )
+                    pending.discard(index)
+                    timed_out.add(index)
+    finally:
+        # A running registration cannot be stopped, it is left to end in the background
+        executor.shutdown(wait=False, cancel_futures=True)
 
     instructions = []
-    for plugin_url in plugins:
-        instruction = get_instructions_for_plugin(plugin_url, model_name)
-        if instruction is not None:
-            instructions.append(instruction)
+    for index, future in enumerate(futures):
+        if index in timed_out:
+            continue
+        prepared = future.result()
+        if prepared is not None:
+            instructions.append(add_plugin_instructions(prepared))
     return instructions
 
 
+def extract_commands(message):
+    """
+    Extract all the commands and their parameters from a message content.
+
+    This function extracts, in order of appearance, every command enclosed in triple curly 
+    braces or triple square brackets. Each command is expected to follow the format 
+    'namespace.operation_id(parameters)', where parameters should be a valid JSON object.
+    The content is scanned in a single pass (see `command_scanner`).
+
+    Args:
+        message (dict): A dictionary containing message information, specifically the "content".
+
+    Returns:
+        list: A list of (command, parameters) tuples. The command is itself a tuple 
+        containing namespace and operation_id. The list is empty if no command is found.
+
+    Raises:
+        InvalidCommandFormatError: If the format of any of the commands is invalid.
+    """
+    with tracing.span("extract_command") as trace:
+        commands = scan_commands(message.get("content"))
+        trace.set("commands", len(commands))
+    return commands
+
+
 def extract_command(message):
     """
-    Extract the command and parameters from a message content.
+    Extract the first command and its parameters from a message content.
 
-    This function extracts commands that are enclosed in triple curly braces 
-    or triple square brackets. It expects the command to follow the format 
-    'namespace.operation_id(parameters)', where parameters should be a valid 
-    JSON object. 
+    See `extract_commands` for the supported command formats.
 
     Args:
         message (dict): A dictionary containing message information, specifically the "content".
@@ -142,59 +298,65 @@ def extract_command(message):
     Raises:
         InvalidCommandFormatError: If the command format is invalid.
     """
-    content = message.get("content")
+    commands = extract_commands(message)
+    if commands:
+        return commands[0]
+    return None, None
 
-    triple_curly_pattern = (
-        r"(?s).*?(?:(?:```\s*))?\{\{\{(?P<content>.*?)\}\}\}(?:(?:\s*```))?.*"
-    )
-    triple_brackets = (
-        r"(?s).*?(?:(?:```\s*))?\[\[\[(?P<content>.*?)\}\}\}(?:(?:\s*```))?.*"
-    )
-    simplified_pattern = r"(?P<namespace>[\w_]+)\s*\.\s*(?P<operationid>[\w_]+)\s*\(\s*(?P<args>.*?)\s*\)"
-    triple_square_pattern = (
-        r"(?s).*?(?:(?:```\s*))?\[\[\[(?P<content>.*?)\]\]\](?:(?:\s*```))?.*"
-    )
 
-    regex_flags = re.IGNORECASE | re.DOTALL
+def get_operation_method(plugin_operation):
+    """
+    Get the HTTP method of a plugin operation.
 
-    triple_curly_match = re.search(triple_curly_pattern, content, regex_flags)
-    pluginsparty_pattern_match = re.search(triple_square_pattern, content, regex_flags)
+    Args:
+        plugin_operation (tuple): A tuple containing the plugin name and operation ID.
 
-    if triple_curly_match or pluginsparty_pattern_match:
-        if triple_curly_match:
-            group_content = triple_curly_match.group("content")
-        if pluginsparty_pattern_match:
-            group_content = pluginsparty_pattern_match.group("content")
+    Returns:
+        str: The HTTP method of the operation, or None if the plugin or the operation is unknown.
+    """
+    operation = operation_table.get(*plugin_operation)
+    if operation is None:
+        return None
+    return operation.method
 
-        match = re.search(simplified_pattern, group_content, regex_flags)
 
-        if match:
-            namespace, operation_id, params = (
-                match.group("namespace"),
-                match.group("operationid"),
-                match.group("args"),
-            )
-            try:
-                params = json.loads(params)
-            except (ValueError, json.JSONDecodeError) as anexception:
-                error_msg = f"Error: Invalid command format: The 'args' is not a valid JSON object. namespace: {namespace}, operation_id: {operation_id}, parameters: {params}."
-                raise InvalidCommandFormatError(error_msg) from anexception
-            return (namespace, operation_id), params
-        
-        error_msg = "Error: Invalid command format: The command is not well formed. Expected a JSON object as the parameter."
-        raise InvalidCommandFormatError(error_msg)
-    return None, None
+def get_checked_operation(plugin_operation, parameters):
+    """
+    Get the compiled operation of a plugin command, after checking the command.
 
+    Args:
+        plugin_operation (tuple): A tuple containing the plugin name and operation ID.
+        parameters (dict): A dictionary of parameters for the operation.
 
-class InvalidCommandFormatError(Exception):
-    """
-    Exception raised for errors in the input command format.
+    Returns:
+        operation_table.Operation: The operation.
 
-    Attributes:
-        message (str): Explanation of the error.
+    Raises:
+        InvalidCommandParametersError: If the plugin or the operation does not exist, or if the 
+        parameters do not match the operation.
     """
-    def __init__(self, message):
-        super().__init__(message)
+    plugin_name, operation_id = plugin_operation
+
+    # Single lookup in the table of compiled operations
+    operation = operation_table.get(plugin_name, operation_id)
+    if operation is None:
+        operation_ids = operation_table.get_operation_ids(plugin_name)
+        if operation_ids is None:
+            LOGGER.info("Error: invoke_plug_stub Plugin '%s' not found", plugin_name)
+            raise InvalidCommandParametersError(
+                f"Error: Unknown plugin {plugin_name}. Available plugins: {', '.join(operation_table.get_plugin_names())}"
+            )
+        LOGGER.info("Error: invoke_plug_stub  Operation '%s' not found", operation_id)
+        raise InvalidCommandParametersError(
+            f"Error: Unknown operation {plugin_name}.{operation_id}. "
+            f"Available operations: {', '.join(operation_ids)}"
+        )
+
+    # Malformed or mistyped calls are rejected before any request
+    if operation.validator is not None:
+        check_command(plugin_name, operation_id, operation.validator, parameters)
+    return operation
+
 
 def invoke_plugin_stub(plugin_operation, parameters):
     """
@@ -204,9 +366,9 @@ def invoke_plugin_stub(plugin_operation, parameters):
     The plugin operation is defined as a tuple containing the plugin name and operation ID. 
     The parameters for the operation are provided as a dictionary.
 
-    The function retrieves the necessary operation details from a collection of plugin stubs 
-    (assumed to be a JSON object). It then constructs and sends an API request, returning the 
-    response text if the request is successful, or an error message otherwise.
+    The function retrieves the operation compiled at registration (see `operation_table`): its URL 
+    template and its headers, bearer token included. It then constructs and sends an API request, 
+    returning the response text if the request is successful, or an error message otherwise.
 
     Args:
         plugin_operation (tuple): A tuple containing the plugin name and operation ID.
@@ -214,64 +376,157 @@ def invoke_plugin_stub(plugin_operation, parameters):
 
     Returns:
         str: The response text if the request is successful, or an error message otherwise.
+
+    Raises:
+        InvalidCommandParametersError: If the plugin or the operation does not exist, or if the 
+        parameters do not match the operation. No request is made then.
     """
     plugin_name, operation_id = plugin_operation
+    operation = get_checked_operation(plugin_operation, parameters)
+    method = operation.method
+
+    with tracing.span("invoke_plugin_stub", plugin=plugin_name, operation=operation_id) as trace:
+        # Identical calls to safe operations are answered from the response cache
+        cached_response = response_cache.lookup(plugin_name, operation_id, method, parameters, operation.headers)
+        if cached_response is not None:
+            LOGGER.debug("Using cached response for %s.%s", plugin_name, operation_id)
+            trace.set("cached", True)
+            return cached_response
+
+        # URL template and headers (bearer token included) are resolved at registration
+        url = operation.url(parameters)
+        headers = operation.headers
+
+        # Make the API request through the keep-alive session of the plugin host
+        LOGGER.debug("%s", method)
+        LOGGER.debug("%s", url)
+        LOGGER.debug("%s", headers)
+        LOGGER.debug("%s", parameters)
+
+        # The body is streamed, and not read beyond plugin_http.MAX_RESPONSE_BYTES
+        response = plugin_http.request(method, url, json=parameters, headers=headers, stream=True)
+        body, truncated = plugin_http.read_body(response)
+        if trace.enabled:
+            trace.set("status", response.status_code)
+            trace.set("bytes_out", len(response.request.body or b""))
+            trace.set("bytes_in", len(body))
+            trace.set("truncated", truncated)
+            retries = getattr(response.raw, "retries", None)
+            trace.set("retries", len(retries.history) if retries is not None else 0)
+
+        # Check if the response is successful
+        if response.ok:
+            text = body.decode(response.encoding or "utf-8", errors="replace")
+            if text.strip():
+                if truncated:
+                    # Not cached, the next identical call may get the whole response
+                    return text + response_condenser.truncation_note(len(body))
+                response_cache.store(
+                    plugin_name,
+                    operation_id,
+                    method,
+                    parameters,
+                    text,
+                    response.headers.get("Cache-Control"),
+                    headers,
+                )
+                return text
+            else:
+                content = "Error: Response body is empty"
+                return content
+        else:
+            errormsg = f"""
+            Error: API request failed with status code {response.status_code}
+            Response headers: {response.headers}
+            Response content: {body} 
+            """
+            print(errormsg)
+            return errormsg
 
-    # Get the plugins stubs (assuming it's a JSON object)
-    plugins_stubs = get_plugins_stubs()
 
-    # Get the stubs for the plugin from the dictionary
-    stubs = plugins_stubs.get(plugin_name)
-    if not stubs:
-        LOGGER.info("Error: invoke_plug_stub Plugin '%s' not found", plugin_name)
-        return None
+async def invoke_plugin_stubs_async(commands):
+    """
+    Invoke several plugin operations concurrently.
 
-    # Find the operation in the stubs using the .get() method with a default value
-    operation_stub = stubs.get("operations", {}).get(operation_id)
-    if not operation_stub:
-        LOGGER.info("Error: invoke_plug_stub  Operation '%d' not found", operation_id)
-        return None
+    Each operation is run through `invoke_plugin_stub` on the event loop executor, so the calls
+    share the pooled keep-alive sessions of their plugin hosts and the total time is the time 
+    of the slowest call.
 
-    # Construct the URL for the API request
-    path = operation_stub["path"]
-    method = operation_stub["method"]
-    api_url = stubs.get("api", {}).get("url")
-    url = api_url.rstrip("/") + path.format(**parameters)
-
-    # Define the headers for the request
-    headers = {"Content-Type": "application/json"}
-
-    # Load the bearer token from the file, if it exists
-    plugin_dir = os.path.join("plugins", plugin_name)
-    bearer_file = os.path.join(plugin_dir, "bearer.secret")
-    if os.path.exists(bearer_file):
-        with open(bearer_file, "r", encoding="utf-8") as myfile:
-            bearer_token = myfile.read().strip()
-        headers["Authorization"] = f"Bearer {bearer_token}"
-
-    # Make the API request using the requests library
-    LOGGER.debug("%s", method)
-    LOGGER.debug("%s", url)
-    LOGGER.debug("%s", headers)
-    LOGGER.debug("%s", parameters)
-
-    response = requests.request(method, url, json=parameters, headers=headers, timeout=10)
-
-    # Check if the response is successful
-    if response.ok:
-        if response.text.strip():
-            return response.text
-        else:
-            content = "Error: Response body is empty"
-            return content
+    Args:
+        commands (list): A list of (plugin_operation, parameters) tuples, as returned by `extract_commands`.
+
+    Returns:
+        list: The responses, in the order of the commands. A failed call is reported as the 
+        exception it raised.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    calls = [
+        loop.run_in_executor(None, invoke_plugin_stub, plugin_operation, parameters)
+        for plugin_operation, parameters in commands
+    ]
+    return await asyncio.gather(*calls, return_exceptions=True)
+
+
+def invoke_plugin_stubs(commands, dispatcher=None):
+    """
+    Invoke several plugin operations concurrently and wait for all the responses.
+
+    A failed call is reported in its response as an error message. If all the calls fail, 
+    the first exception is raised instead, so the caller can ask the model to fix its commands.
+
+    Args:
+        commands (list): A list of (plugin_operation, parameters) tuples, as returned by `extract_commands`.
+        dispatcher (speculative_dispatch.SpeculativeDispatcher): The dispatcher the commands were 
+            submitted to while the answer was streamed. Default is None.
+
+    Returns:
+        list: The responses, in the order of the commands.
+    """
+    if dispatcher is not None:
+        # Commands already dispatched while streaming are only waited for
+        responses = dispatcher.collect(commands)
+    elif len(commands) == 1:
+        return [invoke_plugin_stub(*commands[0])]
+    else:
+        import asyncio
+
+        responses = asyncio.run(invoke_plugin_stubs_async(commands))
+    errors = [response for response in responses if isinstance(response, Exception)]
+    if len(errors) == len(responses):
+        raise errors[0]
+    return [
+        f"Error: Plugin invocation failed: {response}" if isinstance(response, Exception) else response
+        for response in responses
+    ]
+
+
+def build_plugin_response_message(commands, responses):
+    """
+    Build the message sending the responses of one or several plugin operations to the model.
+
+    Long responses are condensed (see `response_condenser`), the full responses can be displayed 
+    with the /response command.
+
+    Args:
+        commands (list): A list of (plugin_operation, parameters) tuples.
+        responses (list): The responses, in the order of the commands.
+
+    Returns:
+        dict: The message, with role "user".
+    """
+    responses = [response_condenser.condense_response(response) for response in responses]
+    if len(commands) == 1:
+        plugin_operation, _ = commands[0]
+        content = f"<RESPONSE FROM {plugin_operation}> {responses[0]} </RESPONSE> Answer my initial question given the plugin response. You can use the results to initiate another plugin call if needed."
     else:
-        errormsg = f"""
-        Error: API request failed with status code {response.status_code}
-        Response headers: {response.headers}
-        Response content: {response.content} 
-        """
-        print(errormsg)
-        return errormsg
+        content = "\n".join(
+            f"<RESPONSE FROM {plugin_operation}> {response} </RESPONSE>"
+            for (plugin_operation, _), response in zip(commands, responses)
+        )
+        content += " Answer my initial question given the plugin responses. You can use the results to initiate other plugin calls if needed."
+    return {"role": "user", "content": content}
 
 
 def is_markdown(text):
@@ -325,14 +580,15 @@ def print_markdown(text):
         text (str): The text to be printed, which may contain Markdown syntax.
     """
     if is_markdown(text):
+        from rich.markdown import Markdown
+
         mymd = Markdown(text)
-        console = Console()
-        console.print(mymd)
+        get_console().print(mymd)
     else:
         print(text)
 
 
-def send_messages(messages, spin=False):
+def send_messages(messages, spin=False, on_command=None, stop_on_command=False):
     """
     Send a series of messages and print the response from a model invoked through OpenAI's API
 
@@ -343,67 +599,117 @@ def send_messages(messages, spin=False):
     Args:
         messages (list): The list of messages to be sent to the model.
         spin (bool): Whether to show a spinner while waiting for the response. Default is False.
+        on_command (callable): Called with (plugin_operation, parameters) as soon as a complete 
+            plugin command is received while streaming. Default is None.
+        stop_on_command (bool): Whether to stop streaming once the answer goes on with text after 
+            its plugin commands. The answer then ends with the last command. Default is False.
 
     Returns:
         str: The raw content of the response from the model.
     """
 
-    console = Console()
-
-    CHAT_COMPLETION_ARGS["messages"] = messages
-    if spin and not CHAT_COMPLETION_ARGS["stream"]:
-        SPINNER.start()
-    response = openai.ChatCompletion.create(**CHAT_COMPLETION_ARGS)
-
-    if spin and not CHAT_COMPLETION_ARGS["stream"]:
-        SPINNER.stop()
+    # Only the part of the conversation fitting the model context budget is sent
+    CHAT_COMPLETION_ARGS["messages"] = context_window.fit(plugin_router.route(messages))
+    with tracing.span("send_messages", model=CHAT_COMPLETION_ARGS["model"], stream=CHAT_COMPLETION_ARGS["stream"]) as trace:
+        if trace.enabled:
+            trace.set("messages", len(CHAT_COMPLETION_ARGS["messages"]))
+            trace.set("bytes_out", sum(len(message["content"]) for message in CHAT_COMPLETION_ARGS["messages"]))
+        started_at = time.perf_counter()
+
+        if spin and not CHAT_COMPLETION_ARGS["stream"]:
+            get_spinner().start()
+        response = llm_client.create(**CHAT_COMPLETION_ARGS)
+
+        if spin and not CHAT_COMPLETION_ARGS["stream"]:
+            get_spinner().stop()
+
+        rawcontent = ""
+
+        if not CHAT_COMPLETION_ARGS["stream"]:
+            rawcontent = response["choices"][0]["message"]["content"]
+            if trace.enabled:
+                trace.set("ttft_seconds", time.perf_counter() - started_at)
+                trace.set("bytes_in", len(rawcontent))
+                tokens = response.get("usage", {}).get("completion_tokens")
+                if tokens:
+                    trace.set("tokens", tokens)
+            with tracing.span("render"):
+                print_markdown(rawcontent)
+            return rawcontent
+
+        # Each delta is scanned once, markdown blocks are rendered progressively
+        # and plugin commands are detected as soon as their closing delimiter is received
+        renderer = MarkdownStreamRenderer()
+        scanner = CommandScanner()
+        first_token_at = None
+        tokens = 0
+        render_seconds = 0
+        for message in response:
+            choice = message["choices"][0]["delta"]
+            if "content" in choice:
+                content = choice["content"]
+                for plugin_operation, parameters in scanner.feed(content):
+                    LOGGER.debug("Plugin command received while streaming: %s", plugin_operation)
+                    if on_command is not None:
+                        on_command(plugin_operation, parameters)
+                stop = stop_on_command and scanner.has_trailing_text()
+                if stop:
+                    # Only render the part of the delta up to the end of the last command
+                    content = content[:len(content) - (len(scanner.text) - scanner.commands_end)]
+                if trace.enabled:
+                    # Streamed deltas carry about one token each
+                    tokens += 1
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    render_started_at = time.perf_counter()
+                    renderer.feed(content)
+                    render_seconds += time.perf_counter() - render_started_at
+                else:
+                    renderer.feed(content)
+                if stop:
+                    LOGGER.debug("Plugin command(s) received, not reading the rest of the answer")
+                    # Closing the stream drops the connection, the model stops generating
+                    response.close()
+                    trace.set("stopped_on_command", True)
+                    break
+        renderer.close()
+
+        rawcontent = scanner.text
+        if stop_on_command and scanner.has_trailing_text():
+            rawcontent = rawcontent[:scanner.commands_end]
+        if trace.enabled:
+            finished_at = time.perf_counter()
+            trace.set("bytes_in", len(rawcontent))
+            trace.set("tokens", tokens)
+            trace.set("render_seconds", render_seconds)
+            if first_token_at is not None:
+                trace.set("ttft_seconds", first_token_at - started_at)
+                if finished_at > first_token_at:
+                    trace.set("tokens_per_second", tokens / (finished_at - first_token_at))
+        return rawcontent
 
-    buffer = ""
-    markdown_buffer = ""
-    in_markdown = False
-    rawcontent = ""
 
-    if not CHAT_COMPLETION_ARGS["stream"]:
-        rawcontent = response["choices"][0]["message"]["content"]
-        print_markdown(rawcontent)
-        return rawcontent
+def get_instructions_path(model_name):
+    """
+    Get the path of the instruction file for the given model.
 
-    for message in response:
-        choice = message["choices"][0]["delta"]
-        if "content" in choice:
-            content = choice["content"]
-            buffer += content
-            rawcontent += content
-            while buffer:
-                if not in_markdown:
-                    if "<mrkdwn".startswith(buffer):
-                        break
-                    elif buffer.startswith("<mrkdwn>"):
-                        buffer = buffer[len("<mrkdwn>") :]
-                        in_markdown = True
-                    else:
-                        print(buffer, end="")
-                        buffer = ""
-                else:
-                    if "</mrkdwn".startswith(buffer):
-                        break
-                    if buffer.startswith("</mrkdwn>"):
-                        buffer = buffer[len("</mrkdwn>") :]
-                        md = Markdown(markdown_buffer)
-                        console.print(md, end="")
-                        markdown_buffer = ""
-                        in_markdown = False
-                    else:
-                        markdown_buffer += buffer[0]
-                        buffer = buffer[1:]
+    Args:
+        model_name (str): The name of the model for which instructions are needed.
 
-    if buffer:
-        print(buffer, end="")
+    Returns:
+        str: The path of the model instruction file if it exists, of the default instruction file otherwise.
+    """
+    instructions_path = f"instructions/{model_name}.txt"
+    default_instructions_path = "instructions/default.txt"
 
-    if markdown_buffer:
-        mymd = Markdown(markdown_buffer)
-        console.print(mymd, end="")
-    return rawcontent
+    if not os.path.exists(instructions_path):
+        LOGGER.debug(
+            "No specific model instructions text file found for %s. Using default.",
+            model_name,
+        )
+        return default_instructions_path
+    LOGGER.debug("Loding instructions for %s.", model_name)
+    return instructions_path
 
 
 def read_instructions(model_name):
@@ -420,17 +726,7 @@ def read_instructions(model_name):
     Returns:
         list: A list of instructions where each instruction is a dictionary with "role" and "content".
     """
-    instructions_path = f"instructions/{model_name}.txt"
-    default_instructions_path = "instructions/default.txt"
-
-    if not os.path.exists(instructions_path):
-        LOGGER.debug(
-            "No specific model instructions text file found for %s. Using default.",
-            model_name,
-        )
-        instructions_path = default_instructions_path
-    else:
-        LOGGER.debug("Loding instructions for %s.", model_name)
+    instructions_path = get_instructions_path(model_name)
 
     instructions = []
     with open(instructions_path, "r") as file:
@@ -482,6 +778,72 @@ def find_last_code_block(messages):
 
     return None
 
+def print_messages_page(page=None):
+    """
+    Print a page of the conversation, read back from the session log if it is saved.
+
+    Args:
+        page (int): The number of the page, starting at 1. Default is the last page.
+    """
+    count = SESSION.count if SESSION is not None else len(MESSAGES)
+    pages = max(1, -(-count // session_store.PAGE_SIZE))
+    page = pages if page is None else page
+    if not 1 <= page <= pages:
+        print(f"Invalid page. There are {pages} pages.")
+        return
+    start = (page - 1) * session_store.PAGE_SIZE
+    stop = min(count, start + session_store.PAGE_SIZE)
+    for message in SESSION.read(start, stop) if SESSION is not None else MESSAGES[start:stop]:
+        print(message)
+    print(f"Messages {start + 1}-{stop} of {count}, page {page}/{pages}. Usage: /m [page]")
+
+
+def run_fanout_turn(prompt, invoke_plugins=True):
+    """
+    Send a prompt to every model of the fan-out (see `model_fanout`) and show the results.
+
+    In race mode, the turn of the winner is shown and kept in the conversation. In compare mode,
+    the final answer of each model is shown and the turn of the first model is kept. A table then
+    compares the models: time to first token, total time, tokens and plugin calls.
+
+    Args:
+        prompt (str): The user prompt.
+        invoke_plugins (bool): Whether plugin commands are invoked. Default is True.
+    """
+    fanout = model_fanout.ModelFanout(
+        CHAT_COMPLETION_ARGS,
+        get_checked_operation,
+        invoke_plugin_stub,
+        get_operation_method,
+        build_plugin_response_message,
+        invoke_plugins,
+    )
+    with tracing.span("turn", fanout=model_fanout.MODE):
+        runs = fanout.run(MESSAGES + [{"role": "user", "content": prompt}])
+
+    console = get_console()
+    if model_fanout.MODE == "race":
+        kept = next((run for run in runs if run.winner), None)
+        if kept is None:
+            print("No model gave a valid answer.")
+        else:
+            console.rule(kept.label)
+            print_markdown(kept.answer)
+            if kept.final_answer is not kept.answer:
+                print_markdown(kept.final_answer)
+    else:
+        kept = runs[0] if runs[0].error is None else None
+        for run in runs:
+            console.rule(run.label)
+            print_markdown(run.final_answer if run.error is None else f"Error: {run.error}")
+    model_fanout.print_comparison(runs, console)
+    model_fanout.save_runs(prompt, runs)
+
+    if kept is not None:
+        # The prompt and the messages of the kept turn
+        MESSAGES.extend(kept.messages[len(MESSAGES):])
+
+
 def get_user_input(prompt):
     """
     Gets user input from the console with shell-like line editing capabilities.
@@ -529,17 +891,21 @@ def start_dialog(args):
     streaming = not args.disable_streaming
 
     while True:
+        if SESSION is not None:
+            # Save the previous turn
+            SESSION.sync(MESSAGES)
         if spin and not streaming:
-            SPINNER.stop()
+            get_spinner().stop()
         if first_prompt == "":
             user_input = get_user_input("\n]")
         else:
             user_input = first_prompt
             print("]" + user_input)
             first_prompt = ""
+        FIRST_PROMPT_SUBMITTED.set()
 
         if spin and not streaming:
-            SPINNER.start()
+            get_spinner().start()
 
         if user_input.lower() == "exit":
             break
@@ -547,9 +913,27 @@ def start_dialog(args):
             user_input = "Create a hello world python program and publish it using the gist plugin. Figure out missing parameters by yourserlf."
             print(user_input)
 
-        if user_input == "/m":
-            for message in MESSAGES:
-                print(message)
+        if user_input == "/m" or user_input.startswith("/m "):
+            # A page of the conversation, the last one by default
+            parts = user_input.split()
+            if len(parts) == 2 and not parts[1].isdigit():
+                print("Invalid input. Usage: /m [page]")
+                continue
+            print_messages_page(int(parts[1]) if len(parts) == 2 else None)
+            continue
+
+        if user_input == "/cache":
+            print(response_cache.get_stats())
+            continue
+
+        if user_input == "/response" or user_input.startswith("/response "):
+            # Full version of a condensed plugin response, the last one by default
+            parts = user_input.split()
+            if len(parts) == 2 and not parts[1].lstrip("#").isdigit():
+                print("Invalid input. Usage: /response [number]")
+                continue
+            full_response = response_condenser.get(int(parts[1].lstrip("#")) if len(parts) == 2 else None)
+            print(full_response if full_response is not None else "No such plugin response.")
             continue
 
         if user_input.startswith("/register"):
@@ -558,7 +942,12 @@ def start_dialog(args):
             if len(parts) == 2:
                 # Extract the URL and invoke the register_plugin function
                 url = parts[1]
-                MESSAGES.append(get_instructions_for_plugin(url, args.model))
+                instruction = get_instructions_for_plugin(url, args.model)
+                if instruction is not None:
+                    MESSAGES.append(instruction)
+                    context_window.pin(instruction)
+                    if SESSION is not None:
+                        SESSION.save_operations()
             else:
                 print("Invalid input. Usage: /register <url>")
             continue
@@ -572,86 +961,112 @@ def start_dialog(args):
                 MESSAGES.append({"role": "assistant", "content": confirmation_message})
 
                 # Ask for user confirmation and append the user's input with role "user"
+                if spin and not streaming:
+                    get_spinner().stop()
                 confirmation = input(confirmation_message)
                 MESSAGES.append({"role": "user", "content": confirmation})
 
                 if confirmation.lower() == "y":
-                    # Execute the code as a system command and capture the output
-                    result = subprocess.run(code_to_execute, shell=True, capture_output=True, text=True, check=False)
-                    if result.returncode == 0:
-                        # Command executed successfully
-                        output_message = result.stdout
-                    else:
-                        # Command execution failed
-                        output_message = (
-                            f"Command execution failed. Error:\n{result.stderr}"
-                        )
-
-                    # Add the output message to the MESSAGES list with role INSTRUCTIONROLE
+                    # Execute the code as a system command, its output being shown as it is produced
+                    with tracing.span("code_execution") as trace:
+                        result = code_runner.execute(code_to_execute)
+                        trace.set("returncode", result.returncode)
+                        trace.set("timed_out", result.timed_out)
+                    if result.cancelled:
+                        print("\nExecution cancelled.")
+                        continue
+
+                    # Add the summary of the execution to the MESSAGES list with role INSTRUCTIONROLE
                     MESSAGES.append(
                         {
                             "role": "user",
-                            "content": f"<RESPONSE FROM shell> {output_message} </RESPONSE> Interprete the results or silently correct the command if you get an error.",
+                            "content": f"<RESPONSE FROM shell> {result.summary()} </RESPONSE> Interprete the results or silently correct the command if you get an error.",
                         }
                     )
-                    print(output_message)
-                    send_messages(MESSAGES, spin)
-
-                    # Send the message using send_messages function
+                    print()
+                    # A single request: the answer is kept, a corrected command can then be run with /! again
                     rawcontent = send_messages(MESSAGES, spin)
+                    MESSAGES.append({"role": "assistant", "content": rawcontent})
             else:
                 print("No code block found in the assistant's MESSAGES.")
             continue
 
-        MESSAGES.append({"role": "user", "content": user_input})
-        rawcontent = send_messages(MESSAGES, spin)
-        MESSAGES.append({"role": "assistant", "content": rawcontent})
+        if model_fanout.TARGETS:
+            # The prompt is sent to several models at once
+            run_fanout_turn(user_input, invoke_plugins=not args.disable_plugin_invocation)
+            if spin and not streaming:
+                get_spinner().stop()
+            if cli_mode:
+                return
+            continue
 
-        # Print the assistant's response to diagnose the issue
-        # print("\nAssistant's response:", rawcontent)
+        with tracing.span("turn") as trace:
+            MESSAGES.append({"role": "user", "content": user_input})
+            # Plugin commands are dispatched as soon as they are streamed
+            dispatcher = None
+            if streaming and not args.disable_plugin_invocation and speculative_dispatch.MODE != "off":
+                dispatcher = speculative_dispatch.SpeculativeDispatcher(invoke_plugin_stub, get_operation_method)
+            rawcontent = send_messages(
+                MESSAGES,
+                spin,
+                on_command=dispatcher.submit if dispatcher is not None else None,
+                stop_on_command=STOP_STREAM_ON_COMMAND and not args.disable_plugin_invocation,
+            )
+            MESSAGES.append({"role": "assistant", "content": rawcontent})
 
-        exception_count = 0
-        max_exceptions = 3
+            # Print the assistant's response to diagnose the issue
+            # print("\nAssistant's response:", rawcontent)
 
-        retry = True
+            exception_count = 0
+            max_exceptions = 3
 
-        while retry:
-            try:
-                plugin_operation, params = extract_command(MESSAGES[-1])
-                if plugin_operation and not args.disable_plugin_invocation:
-                    LOGGER.info("Invoking plugin operation %s",plugin_operation)
-                    response = invoke_plugin_stub(
-                        plugin_operation, params
-                    )  # Update the function call
-                    if print_raw_plugins_output:
-                        print("```\n" + response + "\n```")
-                    message = {
-                        "role": "user",
-                        "content": f"<RESPONSE FROM {plugin_operation}> {response} </RESPONSE> Answer my initial question given the plugin response. You can use the results to initiate another plugin call if needed.",
-                    }
-                    MESSAGES.append(message)
-                    LOGGER.debug("response")
-                    LOGGER.debug("Sending plugin response (SUCCESS) to model")
-                    send_messages(MESSAGES, spin)
-                retry = False
-            except Exception as anexception:
-                if exception_count < max_exceptions:
-                    LOGGER.info("Plugin invocation failed: %s", str(anexception))
-                    errormessage = "Invalid Plugin function call. Check the parameter is a well-formed JSON Object."
-                    MESSAGES.append(
-                        {
-                            "role": "user",
-                            "content": f"<RESPONSE FROM plugin> {errormessage} </RESPONSE> analyse the error and try to correct the command. Make sure it respects the format and that the syntax is valid. (ex: matching opening and closing brackets and parenthesis are mandatory)",
-                        }
-                    )
-                    LOGGER.debug("Sending plugin response (FAILURE) to model")
-                    send_messages(MESSAGES, spin)
-                    exception_count += 1
-                else:
-                    LOGGER.info(
-                        "Reached maximum number of allowed exceptions - aborting"
-                    )
+            retry = True
+
+            while retry:
+                try:
+                    commands = extract_commands(MESSAGES[-1])
+                    if commands and not args.disable_plugin_invocation:
+                        LOGGER.info(
+                            "Invoking plugin operation(s) %s",
+                            ", ".join(str(plugin_operation) for plugin_operation, _ in commands),
+                        )
+                        # Independent commands are invoked concurrently, their responses are sent back in a single message
+                        responses = invoke_plugin_stubs(commands, dispatcher)
+                        if print_raw_plugins_output:
+                            for response in responses:
+                                print("```\n" + response + "\n```")
+                        MESSAGES.append(build_plugin_response_message(commands, responses))
+                        LOGGER.debug("response")
+                        LOGGER.debug("Sending plugin response (SUCCESS) to model")
+                        send_messages(MESSAGES, spin)
                     retry = False
+                except Exception as anexception:
+                    if dispatcher is not None:
+                        # Commands dispatched while streaming the previous answer are not used
+                        dispatcher.discard()
+                        dispatcher = None
+                    if exception_count < max_exceptions:
+                        LOGGER.info("Plugin invocation failed: %s", str(anexception))
+                        if isinstance(anexception, InvalidCommandFormatError):
+                            # Precise error (unknown operation, missing or mistyped parameter...)
+                            errormessage = str(anexception)
+                        else:
+                            errormessage = "Invalid Plugin function call. Check the parameter is a well-formed JSON Object."
+                        MESSAGES.append(
+                            {
+                                "role": "user",
+                                "content": f"<RESPONSE FROM plugin> {errormessage} </RESPONSE> analyse the error and try to correct the command. Make sure it respects the format and that the syntax is valid. (ex: matching opening and closing brackets and parenthesis are mandatory)",
+                            }
+                        )
+                        LOGGER.debug("Sending plugin response (FAILURE) to model")
+                        send_messages(MESSAGES, spin)
+                        exception_count += 1
+                    else:
+                        LOGGER.info(
+                            "Reached maximum number of allowed exceptions - aborting"
+                        )
+                        retry = False
+            trace.set("retries", exception_count)
         if cli_mode:
             return
 
@@ -684,32 +1099,243 @@ def load_plugins():
         return {}
 
 
-def set_instructions(instructionsmodel):
+def build_instructions(instructionsmodel):
     """
-    This function sets the instructions for a given instructions model. 
-    It reads instructions, fetches instructions for plugins, sends MESSAGES 
-    and then returns the raw content of the MESSAGES sent.
+    Build the instructions for a given instructions model.
+
+    The instructions are made of the generic intro, the model instructions, the instructions of 
+    each plugin listed in plugins/default_plugins.json (registering them) and the generic outro.
+
+    The result is saved as a snapshot (see `preamble_snapshot`). As long as the instruction files, 
+    the settings and the cached plugin artifacts are unchanged, the next start loads the instructions 
+    and the plugin operations from the snapshot without registering the plugins again.
 
     Args:
         instructionsmodel (str): The name or identifier of the instructions model to be used.
 
     Returns:
-        str: The raw content of the sent MESSAGES.
+        list: The instruction messages.
     """
+    plugins = load_plugins()
+    instruction_files = [
+        get_instructions_path("for_all_intro"),
+        get_instructions_path(instructionsmodel),
+        get_instructions_path("for_all_outro"),
+        # The template the instructions of each plugin are rendered with
+        get_plugin_template_path(instructionsmodel),
+    ]
+    manifest_urls = [get_manifest_url(plugin_url) for plugin_url in plugins]
+    settings = {
+        "instruction_role": INSTRUCTION_ROLE,
+        "spec_verbosity": spec_compiler.VERBOSITY,
+        "model": CHAT_COMPLETION_ARGS["model"],
+    }
+
+    snapshot_key = None
+    if preamble_snapshot.ENABLED:
+        snapshot_key = preamble_snapshot.compute_key(instructionsmodel, instruction_files, manifest_urls, settings)
+    snapshot = preamble_snapshot.load(snapshot_key)
+    if snapshot is not None:
+        LOGGER.info("Instructions loaded from snapshot %s", snapshot_key)
+        get_registration_stats().update(snapshot["registration_stats"])
+        instructions = snapshot["instructions"]
+        for plugin_name, index in snapshot["plugin_instructions"].items():
+            plugin_router.add(plugin_name, instructions[index])
+        context_window.pin(*instructions)
+        return instructions
 
-    MESSAGES.extend(read_instructions("for_all_intro"))
-    MESSAGES.extend(read_instructions(instructionsmodel))
+    instructions = []
+    instructions.extend(read_instructions("for_all_intro"))
+    instructions.extend(read_instructions(instructionsmodel))
 
-    # Call the get_instructions_for_plugins function and append each instruction to the MESSAGES list
-    plugins = load_plugins()
+    # Call the get_instructions_for_plugins function and append each instruction to the list
     LOGGER.debug("fetching instruction for :%s",plugins)
     plugin_instructions = get_instructions_for_plugins(plugins, instructionsmodel)
     LOGGER.debug("instructions :%s", plugin_instructions)
-    # for instruction in plugin_instructions:
-    MESSAGES.extend(plugin_instructions)
-    MESSAGES.extend(read_instructions("for_all_outro"))
+    instructions.extend(plugin_instructions)
+    instructions.extend(read_instructions("for_all_outro"))
+    # The instructions are always sent, whatever the context budget
+    context_window.pin(*instructions)
+
+    if preamble_snapshot.ENABLED and len(plugin_instructions) == len(plugins):
+        # Every plugin is now in the cache, unless it could not be registered
+        snapshot_key = preamble_snapshot.compute_key(instructionsmodel, instruction_files, manifest_urls, settings)
+        plugin_instructions = {
+            plugin_router.get_plugin_name(instruction): index
+            for index, instruction in enumerate(instructions)
+            if plugin_router.get_plugin_name(instruction) is not None
+        }
+        preamble_snapshot.save(snapshot_key, instructions, plugin_instructions, get_registration_stats())
+    return instructions
+
+
+def send_deferred_greeting():
+    """
+    Request the greeting in the background, so the user can type the first prompt right away.
+
+    The greeting is printed when it arrives, unless the first prompt has been submitted in the meantime.
+
+    Returns:
+        threading.Thread: The thread requesting the greeting.
+    """
+    completion_args = dict(CHAT_COMPLETION_ARGS, messages=context_window.fit(plugin_router.route(MESSAGES)), stream=False)
+
+    def greet():
+        try:
+            response = llm_client.create(**completion_args)
+        except Exception as anexception:
+            LOGGER.warning("Deferred greeting failed: %s", anexception)
+            return
+        if not FIRST_PROMPT_SUBMITTED.is_set():
+            print_markdown(response["choices"][0]["message"]["content"])
+            print("\n]", end="", flush=True)
+
+    thread = threading.Thread(target=greet, name="greeting", daemon=True)
+    thread.start()
+    return thread
+
+
+def set_instructions(instructionsmodel, greeting="model"):
+    """
+    This function sets the instructions for a given instructions model. 
+    It builds the instructions, sends MESSAGES 
+    and then returns the raw content of the model answer.
+
+    Args:
+        instructionsmodel (str): The name or identifier of the instructions model to be used.
+        greeting (str): One of GREETING_MODES. With "defer" or "skip", no request is made before 
+            the first prompt (see `send_deferred_greeting`). Default is "model".
+
+    Returns:
+        str: The raw content of the model answer, or None if the greeting is deferred or skipped.
+    """
+
+    MESSAGES.extend(build_instructions(instructionsmodel))
     LOGGER.debug(MESSAGES)
+    if greeting == "skip":
+        return None
+    if greeting == "defer":
+        send_deferred_greeting()
+        return None
     rawcontent = send_messages(MESSAGES)
+    return rawcontent
+
+
+def start_session(model, instructions_model):
+    """
+    Start saving the conversation, instructions included, to a new session log.
+    """
+    global SESSION
+    SESSION = session_store.SessionStore.create(model=model, instructions_model=instructions_model)
+    SESSION.sync(MESSAGES)
+    SESSION.save_operations()
+    LOGGER.info("Conversation saved as session %s", SESSION.session_id)
+
+
+def resume_session(session_id):
+    """
+    Restore a saved session: its conversation, instructions and registered plugins.
+
+    No plugin is registered and no request is sent to the model.
+
+    Args:
+        session_id (str): The id of the session, or "last" for the last updated session.
+
+    Returns:
+        bool: True if the session was restored, False if it does not exist or cannot be read.
+    """
+    global SESSION
+    if session_id == "last":
+        session_id = session_store.latest_session_id()
+        if session_id is None:
+            LOGGER.error("No session to resume in %s", session_store.SESSIONS_DIR)
+            return False
+    store, messages = session_store.SessionStore.open(session_id)
+    if store is None:
+        LOGGER.error("Session %s cannot be resumed", session_id)
+        return False
+    MESSAGES.extend(messages)
+    # With --disable-session-store, the resumed conversation is not saved any further
+    SESSION = store if session_store.ENABLED else None
+    LOGGER.info("Session %s resumed (%i messages)", session_id, len(messages))
+    return True
+
+
+def run_headless_conversation(instructions, prompt, model=None, rate_limiter=None):
+    """
+    Run a single conversation turn without any console output.
+
+    The prompt is sent after the instructions. If the answer contains plugin commands, they are 
+    invoked and their responses sent back to the model to get the final answer.
+
+    Args:
+        instructions (list): The instruction messages, as returned by `build_instructions`.
+        prompt (str): The user prompt.
+        model (str): The model to use. Defaults to the --model argument.
+        rate_limiter (llm_client.RateLimiter): Called before each request to the model. Default is None.
+
+    Returns:
+        dict: The prompt, model, first answer, commands, plugin responses, final answer and 
+        timings (in seconds) of the conversation.
+    """
+    completion_args = dict(CHAT_COMPLETION_ARGS, stream=False)
+    if model:
+        completion_args["model"] = model
+    messages = list(instructions)
+    messages.append({"role": "user", "content": prompt})
+    record = {
+        "prompt": prompt,
+        "model": completion_args["model"],
+        "answer": None,
+        "commands": [],
+        "plugin_responses": [],
+        "final_answer": None,
+        "timings": {},
+        "error": None,
+    }
+
+    def ask():
+        if rate_limiter is not None:
+            rate_limiter.wait(completion_args["model"])
+        completion_args["messages"] = context_window.fit(plugin_router.route(messages))
+        with tracing.span("send_messages", model=completion_args["model"], stream=False) as trace:
+            response = llm_client.create(**completion_args)
+            content = response["choices"][0]["message"]["content"]
+            if trace.enabled:
+                trace.set("bytes_out", sum(len(message["content"]) for message in completion_args["messages"]))
+                trace.set("bytes_in", len(content))
+                tokens = response.get("usage", {}).get("completion_tokens")
+                if tokens:
+                    trace.set("tokens", tokens)
+        messages.append({"role": "assistant", "content": content})
+        return content
+
+    started_at = time.monotonic()
+    with tracing.span("turn", headless=True):
+        try:
+            record["answer"] = record["final_answer"] = ask()
+            record["timings"]["answer"] = time.monotonic() - started_at
+
+            commands = extract_commands(messages[-1])
+            record["commands"] = [
+                {"plugin": plugin_name, "operation": operation_id, "parameters": parameters}
+                for (plugin_name, operation_id), parameters in commands
+            ]
+            if commands:
+                plugin_started_at = time.monotonic()
+                responses = invoke_plugin_stubs(commands)
+                record["plugin_responses"] = responses
+                record["timings"]["plugins"] = time.monotonic() - plugin_started_at
+
+                messages.append(build_plugin_response_message(commands, responses))
+                final_started_at = time.monotonic()
+                record["final_answer"] = ask()
+                record["timings"]["final_answer"] = time.monotonic() - final_started_at
+        except Exception as anexception:
+            LOGGER.info("Headless conversation failed: %s", anexception)
+            record["error"] = str(anexception)
+    record["timings"]["total"] = time.monotonic() - started_at
+    return record
 
 
 def main(args):
@@ -731,10 +1357,15 @@ def main(args):
 
     global LOG_FORMAT
     global INSTRUCTION_ROLE
+    global PLUGIN_REGISTRATION_CONCURRENCY
+    global PLUGIN_REGISTRATION_TIMEOUT
+    global STOP_STREAM_ON_COMMAND
 
-    # Update the OpenAI API base if a value is provided
+    # Update the OpenAI API base if a value is provided, several comma-separated bases are used in turn
     if args.openai_api_base:
-        openai.api_base = args.openai_api_base
+        llm_client.API_BASES = [api_base.strip() for api_base in args.openai_api_base.split(",") if api_base.strip()]
+    if args.openai_api_key:
+        llm_client.API_KEY = args.openai_api_key
         # openai_api_client.set_baseurl(args.openai_api_base)
 
     if args.log_level.upper() == "SILENT":
@@ -752,12 +1383,53 @@ def main(args):
     CHAT_COMPLETION_ARGS["stream"] = not args.disable_streaming
     CHAT_COMPLETION_ARGS["max_tokens"] = 500
 
+    # Keep room for the completion in the model context window
+    if args.context_budget is not None:
+        context_window.BUDGET = args.context_budget
+    else:
+        context_window.BUDGET = (
+            context_window.context_size_for_model(args.model) - CHAT_COMPLETION_ARGS["max_tokens"]
+        )
+
     # if streaming make sure to go to line before logging.
 
     if not args.disable_streaming:
         LOG_FORMAT = "\n" + LOG_FORMAT
 
     INSTRUCTION_ROLE = args.instruction_role
+    context_window.TRUNCATION_ROLE = INSTRUCTION_ROLE
+
+    PLUGIN_REGISTRATION_CONCURRENCY = args.plugin_concurrency
+    PLUGIN_REGISTRATION_TIMEOUT = args.plugin_timeout
+    plugin_cache.FETCH_TIMEOUT = args.plugin_timeout
+    plugin_cache.CACHE_TTL = args.plugin_cache_ttl
+    plugin_cache.OFFLINE = args.offline
+    spec_compiler.VERBOSITY = args.spec_verbosity
+    plugin_http.CONNECT_TIMEOUT = args.plugin_connect_timeout
+    plugin_http.READ_TIMEOUT = args.plugin_read_timeout
+    plugin_http.POOL_SIZE = args.plugin_pool_size
+    plugin_http.MAX_RETRIES = args.plugin_retries
+    response_cache.ENABLED = not args.disable_response_cache
+    preamble_snapshot.ENABLED = not args.disable_preamble_snapshot
+    plugin_router.TOP_K = args.plugin_routing_top_k
+    llm_client.CONNECT_TIMEOUT = args.llm_connect_timeout
+    llm_client.READ_TIMEOUT = args.llm_read_timeout
+    llm_client.POOL_SIZE = args.llm_pool_size
+    llm_client.MAX_RETRIES = args.llm_retries
+    llm_client.REQUESTS_PER_MINUTE = args.llm_rate_limit
+    llm_client.configure()
+    # openai is imported in the background while the plugins are registered
+    llm_client.preload()
+    speculative_dispatch.MODE = args.speculative_dispatch
+    STOP_STREAM_ON_COMMAND = args.stop_stream_on_command
+    plugin_http.MAX_RESPONSE_BYTES = args.plugin_response_max_bytes
+    response_condenser.MAX_CHARS = args.plugin_response_max_chars or None
+    response_cache.DEFAULT_TTL = args.response_cache_ttl
+    response_cache.MAX_ENTRIES = args.response_cache_size
+    for plugin_ttl in args.response_cache_plugin_ttl:
+        plugin_name, _, ttl = plugin_ttl.partition("=")
+        response_cache.PLUGIN_TTLS[plugin_name] = float(ttl)
+    tracing.configure(args.trace_file, args.metrics_file, args.metrics_port)
 
     # Don't set streaming to false or api will fail if not supported...
 
@@ -766,14 +1438,73 @@ def main(args):
             "Using a Vicuna model and instruction role different than 'user' is not recommended."
         )
 
-    if args.model_instructions == "model":
-        LOGGER.info("Sending instructions to model")
-        set_instructions(args.model)
+    instructions_model = args.model if args.model_instructions == "model" else args.model_instructions
+
+    if args.batch:
+        # Plugins are registered once, then every prompt reuses the same instructions
+        instructions = build_instructions(instructions_model)
+        failures = batch_runner.run_batch(
+            args.batch,
+            args.batch_output,
+            lambda prompt, model, rate_limiter: run_headless_conversation(
+                instructions, prompt, model, rate_limiter
+            ),
+            workers=args.batch_workers,
+            requests_per_minute=args.batch_rate_limit,
+        )
+        sys.exit(1 if failures else 0)
+
+    if args.serve:
+        # Imported here: aiohttp is only needed by the HTTP server
+        import server
+
+        # Plugins are registered once, their instructions and stubs are shared by all the sessions
+        if args.session_concurrency is not None:
+            server.SESSION_CONCURRENCY = args.session_concurrency
+        if args.max_concurrent_turns is not None:
+            server.MAX_CONCURRENT_TURNS = args.max_concurrent_turns
+        if args.max_sessions is not None:
+            server.MAX_SESSIONS = args.max_sessions
+        instructions = build_instructions(instructions_model)
+        server.run_server(
+            server.PluginsPartyServer(
+                instructions,
+                CHAT_COMPLETION_ARGS,
+                invoke_plugin_stubs,
+                build_plugin_response_message,
+                invoke_plugins=not args.disable_plugin_invocation,
+            ),
+            host=args.serve_host,
+            port=args.serve,
+        )
+        return
+
+    session_store.ENABLED = not args.disable_session_store
+    model_fanout.TARGETS = model_fanout.parse_targets(args.models) if args.models else []
+    model_fanout.MODE = args.fanout
+    model_fanout.OUTPUT_FILE = args.fanout_output
+    model_fanout.COMPARE_UNSAFE_CALLS = args.fanout_unsafe_calls
+    code_runner.TIMEOUT = args.code_timeout or None
+    code_runner.MAX_OUTPUT_CHARS = args.code_max_output_chars
+    if args.resume:
+        if not resume_session(args.resume):
+            sys.exit(1)
     else:
-        LOGGER.info("Sending instructions to model (%s)",args.model)
-        set_instructions(args.model_instructions)
+        if args.model_instructions == "model":
+            LOGGER.info("Sending instructions to model")
+            set_instructions(args.model, args.greeting)
+        else:
+            LOGGER.info("Sending instructions to model (%s)",args.model)
+            set_instructions(args.model_instructions, args.greeting)
+        if session_store.ENABLED:
+            start_session(args.model, instructions_model)
 
-    start_dialog(args)
+    try:
+        start_dialog(args)
+    finally:
+        # However the dialog ends (exit, single prompt, interruption), the last turn is saved
+        if SESSION is not None:
+            SESSION.sync(MESSAGES)
     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -826,6 +1557,92 @@ if __name__ == "__main__":
         help="Print raw plugins response to console.",
     )
 
+    parser.add_argument(
+        "--context-budget",
+        type=int,
+        default=None,
+        help="Maximum number of tokens of the conversation sent to the model. Defaults to the model context size minus the completion size.",
+    )
+    parser.add_argument(
+        "--plugin-concurrency",
+        type=int,
+        default=PLUGIN_REGISTRATION_CONCURRENCY,
+        help="Maximum number of plugins registered concurrently at startup.",
+    )
+    parser.add_argument(
+        "--plugin-timeout",
+        type=float,
+        default=PLUGIN_REGISTRATION_TIMEOUT,
+        help="Maximum time (in seconds) allowed to register a single plugin.",
+    )
+    parser.add_argument(
+        "--plugin-cache-ttl",
+        type=float,
+        default=plugin_cache.CACHE_TTL,
+        help="Time (in seconds) during which cached plugin manifests and specifications are used without revalidation.",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        default=False,
+        help="Never access the network to register plugins, use cached manifests and specifications only.",
+    )
+    parser.add_argument(
+        "--spec-verbosity",
+        default=spec_compiler.VERBOSITY,
+        choices=spec_compiler.VERBOSITY_LEVELS,
+        help="Specify how plugins OpenAPI specifications are rendered in the instructions.",
+    )
+    parser.add_argument(
+        "--plugin-connect-timeout",
+        type=float,
+        default=plugin_http.CONNECT_TIMEOUT,
+        help="Time (in seconds) allowed to connect to a plugin API.",
+    )
+    parser.add_argument(
+        "--plugin-read-timeout",
+        type=float,
+        default=plugin_http.READ_TIMEOUT,
+        help="Time (in seconds) allowed to wait for data from a plugin API.",
+    )
+    parser.add_argument(
+        "--plugin-pool-size",
+        type=int,
+        default=plugin_http.POOL_SIZE,
+        help="Maximum number of keep-alive connections per plugin host.",
+    )
+    parser.add_argument(
+        "--plugin-retries",
+        type=int,
+        default=plugin_http.MAX_RETRIES,
+        help="Maximum number of retries (with exponential backoff) of idempotent plugin calls.",
+    )
+    parser.add_argument(
+        "--disable-response-cache",
+        action="store_true",
+        default=False,
+        help="Disable the cache of plugin responses.",
+    )
+    parser.add_argument(
+        "--response-cache-ttl",
+        type=float,
+        default=response_cache.DEFAULT_TTL,
+        help="Time (in seconds) during which plugin responses are cached, unless the plugin sets Cache-Control.",
+    )
+    parser.add_argument(
+        "--response-cache-plugin-ttl",
+        action="append",
+        default=[],
+        metavar="PLUGIN=SECONDS",
+        help="Override the plugin responses cache TTL for a plugin. Can be repeated.",
+    )
+    parser.add_argument(
+        "--response-cache-size",
+        type=int,
+        default=response_cache.MAX_ENTRIES,
+        help="Maximum number of cached plugin responses.",
+    )
+
     parser.add_argument("--prompt", default="", type=str, help="Send a prompt")
     parser.add_argument(
         "--cli",
@@ -833,6 +1650,29 @@ if __name__ == "__main__":
         default=False,
         help="Enable CLI mode (exit after first answer).",
     )  # New argument
+    parser.add_argument(
+        "--batch",
+        default=None,
+        metavar="PROMPTS_JSONL",
+        help="Run the prompts of a JSONL file headlessly and exit.",
+    )
+    parser.add_argument(
+        "--batch-output",
+        default="batch_results.jsonl",
+        help="JSONL file the batch results are appended to.",
+    )
+    parser.add_argument(
+        "--batch-workers",
+        type=int,
+        default=4,
+        help="Number of batch conversations run concurrently.",
+    )
+    parser.add_argument(
+        "--batch-rate-limit",
+        type=float,
+        default=None,
+        help="Maximum number of requests per minute sent to each model in batch mode.",
+    )
     parser.add_argument(
         "--log-level",
         default="INFO",
@@ -845,7 +1685,37 @@ if __name__ == "__main__":
     parser.add_argument(
         "--openai_api_base",
         default=default_openai_api_base,
-        help="Specify the OpenAI API base URL.",
+        help="Specify the OpenAI API base URL. Several comma-separated URLs are used in turn, with failover.",
+    )
+    parser.add_argument(
+        "--llm-connect-timeout",
+        type=float,
+        default=llm_client.CONNECT_TIMEOUT,
+        help="Timeout (in seconds) to connect to the model API.",
+    )
+    parser.add_argument(
+        "--llm-read-timeout",
+        type=float,
+        default=llm_client.READ_TIMEOUT,
+        help="Maximum time (in seconds) waiting for data from the model API.",
+    )
+    parser.add_argument(
+        "--llm-pool-size",
+        type=int,
+        default=llm_client.POOL_SIZE,
+        help="Number of keep-alive connections kept to each model API base.",
+    )
+    parser.add_argument(
+        "--llm-retries",
+        type=int,
+        default=llm_client.MAX_RETRIES,
+        help="Number of retries of a rate limited, overloaded or failed model request.",
+    )
+    parser.add_argument(
+        "--llm-rate-limit",
+        type=float,
+        default=None,
+        help="Maximum number of requests per minute sent to each model.",
     )
     parser.add_argument(
         "--openai_api_key",
@@ -854,5 +1724,140 @@ if __name__ == "__main__":
         help="Specify the OpenAI API key.",
     )
 
+    parser.add_argument(
+        "--serve",
+        type=int,
+        default=None,
+        metavar="PORT",
+        help="Serve conversations over HTTP on this port instead of starting the console dialog (see below).",
+    )
+    parser.add_argument(
+        "--serve-host",
+        default="127.0.0.1",
+        help="Address the HTTP server listens on.",
+    )
+    parser.add_argument(
+        "--session-concurrency",
+        type=int,
+        default=None,
+        help="Maximum number of turns run concurrently by a single session of the HTTP server. Defaults to 1.",
+    )
+    parser.add_argument(
+        "--max-concurrent-turns",
+        type=int,
+        default=None,
+        help="Maximum number of turns run concurrently by the HTTP server, further requests wait for a slot. Defaults to 64.",
+    )
+    parser.add_argument(
+        "--max-sessions",
+        type=int,
+        default=None,
+        help="Maximum number of sessions open on the HTTP server. Defaults to 1000.",
+    )
+    parser.add_argument(
+        "--plugin-response-max-bytes",
+        type=int,
+        default=plugin_http.MAX_RESPONSE_BYTES,
+        help="Maximum number of bytes read from a plugin response, the rest is dropped.",
+    )
+    parser.add_argument(
+        "--plugin-response-max-chars",
+        type=int,
+        default=response_condenser.MAX_CHARS,
+        help="Plugin responses longer than this are condensed before being sent to the model (0 to send them as is). The full responses are shown by /response.",
+    )
+    parser.add_argument(
+        "--speculative-dispatch",
+        default=speculative_dispatch.MODE,
+        choices=speculative_dispatch.MODES,
+        help="Invoke the plugin commands as soon as they are streamed, before the end of the answer: never (off), for safe operations (GET, HEAD...) only (safe) or for every operation (all).",
+    )
+    parser.add_argument(
+        "--stop-stream-on-command",
+        action="store_true",
+        default=False,
+        help="Stop reading the answer of the model once it goes on with text after its plugin commands.",
+    )
+    parser.add_argument(
+        "--plugin-routing-top-k",
+        type=int,
+        default=None,
+        help="Only send the instructions of the K plugins most relevant to the last messages (local BM25 ranking). By default the instructions of every plugin are sent.",
+    )
+    parser.add_argument(
+        "--greeting",
+        default="model",
+        choices=GREETING_MODES,
+        help="Wait for the model greeting before the first prompt (model), request it in the background (defer) or never request it (skip).",
+    )
+    parser.add_argument(
+        "--models",
+        default=None,
+        help="Send each prompt to several models at once: comma-separated models, each optionally followed by @ and its API base (e.g. gpt-3.5-turbo,gpt-4,vicuna-13b@http://localhost:8000/v1).",
+    )
+    parser.add_argument(
+        "--fanout",
+        default=model_fanout.MODE,
+        choices=model_fanout.MODES,
+        help="With --models, keep the first valid answer and cancel the other models (race) or run every model and compare them (compare).",
+    )
+    parser.add_argument(
+        "--fanout-output",
+        default=None,
+        help="With --models, append the result of each model (timings, tokens, plugin calls, answers) to this JSONL file.",
+    )
+    parser.add_argument(
+        "--fanout-unsafe-calls",
+        action="store_true",
+        help="With --fanout compare, let every model invoke operations with side effects (POST...), not only the first one.",
+    )
+    parser.add_argument(
+        "--code-timeout",
+        type=float,
+        default=code_runner.TIMEOUT,
+        help="Time (in seconds) after which a code block run with /! is killed, 0 for no limit.",
+    )
+    parser.add_argument(
+        "--code-max-output-chars",
+        type=int,
+        default=code_runner.MAX_OUTPUT_CHARS,
+        help="Maximum number of characters of the output of a /! run shown and sent to the model.",
+    )
+    parser.add_argument(
+        "--resume",
+        nargs="?",
+        const="last",
+        default=None,
+        metavar="SESSION",
+        help="Resume a saved session (the last one if no session is given): its conversation and plugins are restored without any request.",
+    )
+    parser.add_argument(
+        "--disable-session-store",
+        action="store_true",
+        default=False,
+        help="Do not save the conversation to the sessions directory.",
+    )
+    parser.add_argument(
+        "--disable-preamble-snapshot",
+        action="store_true",
+        default=False,
+        help="Always rebuild the instructions and register the plugins instead of loading the last snapshot.",
+    )
+    parser.add_argument(
+        "--trace-file",
+        default=None,
+        help="Append a JSONL trace of every step (model requests, rendering, command extraction, plugin calls, registrations) to this file.",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=None,
+        help="Write latency, throughput and size metrics in the Prometheus text format to this file.",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve the Prometheus metrics on this local port, at /metrics.",
+    )
     cmdline_args = parser.parse_args()
     main(cmdline_args)
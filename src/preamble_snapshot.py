@@ -0,0 +1,142 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Snapshots of the prebuilt instruction preamble.
+
+Building the preamble means reading the instruction files and registering every
+plugin (parsing its OpenAPI specification, rendering its instructions, creating its
+request stubs). The result is saved in plugins/snapshots/<key>.json, the key being a
+hash of everything it depends on: the instructions model, the instruction files, the
+rendering settings and the cached artifacts of each plugin (see plugin_cache.fingerprint).
+
+On the next start, if the key is unchanged, the preamble is loaded from the snapshot
+instead, and the plugin operations from the operation table saved next to it
+(<key>.ops, see operation_table). No key can be computed while a plugin artifact is
+missing from the cache or due for revalidation, the preamble is then rebuilt.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+import operation_table
+import plugin_cache
+
+logger = logging.getLogger('pluginspartylogger')
+
+# Bump when the snapshot content or the way instructions are rendered changes
+SNAPSHOT_VERSION = 4
+SNAPSHOTS_DIR = os.path.join(plugin_cache.PLUGINS_DIR, "snapshots")
+# Number of snapshots kept, the least recently used ones are removed
+MAX_SNAPSHOTS = 8
+ENABLED = True
+
+
+def compute_key(instructions_model, instruction_files, manifest_urls, settings):
+    """
+    Compute the key of the preamble.
+
+    Args:
+        instructions_model (str): The instructions model.
+        instruction_files (list): The paths of the instruction files making the preamble.
+        manifest_urls (list): The manifest URLs of the plugins, in order.
+        settings (dict): Any other setting affecting the preamble (instruction role, spec verbosity...).
+
+    Returns:
+        str: The key, or None if any plugin cannot be served from the cache.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([SNAPSHOT_VERSION, instructions_model, settings], sort_keys=True).encode("utf-8"))
+    for path in instruction_files:
+        with open(path, "rb") as file:
+            digest.update(path.encode("utf-8") + b"\0" + file.read() + b"\0")
+    for manifest_url in manifest_urls:
+        plugin_fingerprint = plugin_cache.fingerprint(manifest_url)
+        if plugin_fingerprint is None:
+            logger.debug("No preamble snapshot: %s is not fresh in the cache", manifest_url)
+            return None
+        digest.update(plugin_fingerprint.encode("ascii"))
+    return digest.hexdigest()
+
+
+def _snapshot_path(key):
+    return os.path.join(SNAPSHOTS_DIR, f"{key}.json")
+
+
+def _table_path(key):
+    return os.path.join(SNAPSHOTS_DIR, f"{key}.ops")
+
+
+def load(key):
+    """
+    Load the snapshot saved under a key, and its operation table.
+
+    Returns:
+        dict: The snapshot ("instructions", "plugin_instructions" and "registration_stats"),
+        or None.
+    """
+    if not ENABLED or key is None:
+        return None
+    path = _snapshot_path(key)
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            snapshot = json.load(file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as anexception:
+        logger.warning("Ignoring unreadable preamble snapshot %s: %s", path, anexception)
+        return None
+    if not operation_table.load(_table_path(key)):
+        return None
+    # Keep track of the last use, for the eviction
+    os.utime(path)
+    return snapshot
+
+
+def save(key, instructions, plugin_instructions, registration_stats):
+    """
+    Save a snapshot and the operation table under a key, and evict the least recently used snapshots.
+
+    Args:
+        key (str): The key returned by compute_key.
+        instructions (list): The instruction messages.
+        plugin_instructions (dict): The index in instructions of each plugin instruction message.
+        registration_stats (dict): The registration stats of the plugins.
+    """
+    if not ENABLED or key is None:
+        return
+    os.makedirs(SNAPSHOTS_DIR, exist_ok=True)
+    if not operation_table.save(_table_path(key)):
+        return
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "instructions": instructions,
+        "plugin_instructions": plugin_instructions,
+        "registration_stats": registration_stats,
+    }
+    path = _snapshot_path(key)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(snapshot, file, default=str)
+    os.replace(tmp_path, path)
+
+    snapshots = sorted(
+        (entry for entry in os.scandir(SNAPSHOTS_DIR) if entry.name.endswith(".json")),
+        key=lambda entry: entry.stat().st_mtime,
+        reverse=True,
+    )
+    for entry in snapshots[MAX_SNAPSHOTS:]:
+        os.remove(entry.path)
+        table_path = f"{entry.path[:-len('.json')]}.ops"
+        if os.path.exists(table_path):
+            os.remove(table_path)
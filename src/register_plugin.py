@@ -11,12 +11,18 @@
 
 import sys
 import os
+import contextlib
 import json
 import re
 from urllib.parse import urljoin, urlparse
 import logging
-import requests
-import yaml
+import threading
+
+import command_validator
+import context_window
+import operation_table
+import plugin_cache
+import spec_compiler
 
 # Set up basic configuration for logging
 
@@ -24,55 +30,79 @@ logger = logging.getLogger('pluginspartylogger')
 
 plugin_stubs = {}
 
-def get_plugins_stubs ():
-    return plugin_stubs
-
-def fetch_plugin_info(plugin_location):
-    response = requests.get(plugin_location,timeout=10000)
-    if response.status_code != 200:
-        logger.error("Error fetching plugin info: %i", response.status_code)
-        sys.exit(1)
-    return response.json()
+# Number of HTTP requests and parse calls made by the last registration of each plugin,
+# and number of tokens of its specification before and after compilation
+registration_stats = {}
 
-def save_plugin_info(plugin_info, plugin_dir):
-    with open(os.path.join(plugin_dir, "ai-plugin.json"), "w", encoding="utf-8") as f:
-        json.dump(plugin_info, f)
+# Plugins may be registered concurrently: serialize interactive prompts
+_input_lock = threading.Lock()
 
-def fetch_and_save_yaml(api_url, plugin_dir):
-    response = requests.get(api_url, timeout=5000)
-    if response.status_code != 200:
-        logger.error("Error fetching YAML file: %i", response.status_code)
-        sys.exit(1)
-    yaml_file = os.path.join(plugin_dir, "openapi.yaml")
-    with open(yaml_file, "w", encoding="utf-8") as f:
-        f.write(response.text)
+# Last parsed content of each artifact URL: (content, parsed). An artifact served from the cache
+# or revalidated by the server is not parsed again when the plugin is registered again.
+_parsed_artifacts = {}
 
-def create_model_instructions(plugin_location, model_name):
-    plugin_info = fetch_plugin_info(plugin_location)
-    api_url = plugin_info.get("api", {}).get("url")
-    if not api_url:
-        logger.debug("API URL is missing or invalid")
-        sys.exit(1)
+def get_registration_stats():
+    return registration_stats
 
-    # If the api_url is relative, use urljoin to complement the missing information
-    if not api_url.startswith(('http://', 'https://')):
-        api_url = urljoin(plugin_location, api_url)
+def get_plugin_dir(plugin_name):
+    return os.path.join(plugin_cache.PLUGINS_DIR, plugin_name)
 
-    yaml_response = requests.get(api_url, timeout=5000)
-    if yaml_response.status_code != 200:
-        logger.debug("Error fetching YAML file: %i", yaml_response.status_code)
+def fetch_artifact(url, artifact, stats, plugin_dir=None):
+    content, metadata, source = plugin_cache.fetch(url, artifact, plugin_dir)
+    if source != plugin_cache.SOURCE_CACHE:
+        stats["http_requests"] += 1
+    if content is None:
+        logger.error("Error fetching %s from %s", artifact, url)
         sys.exit(1)
-    yaml_content = yaml_response.text
-    plugin_name = plugin_info.get("name_for_model", "unknown")
-    plugin_description = plugin_info.get("description_for_model", "unknown")
-    openapi_spec = yaml.safe_load(yaml_content)
-    yaml_string = yaml.dump(openapi_spec, default_flow_style=False)
-
+    return content, metadata, source
+
+def parse_artifact(url, content, source, parse, stats):
+    if source in (plugin_cache.SOURCE_CACHE, plugin_cache.SOURCE_REVALIDATED):
+        parsed = _parsed_artifacts.get(url)
+        if parsed is not None and parsed[0] == content:
+            return parsed[1]
+    result = parse(content, stats)
+    _parsed_artifacts[url] = (content, result)
+    return result
+
+def parse_plugin_info(content, stats):
+    stats["parses"] += 1
+    return json.loads(content)
+
+def parse_openapi_spec(yaml_content, stats):
+    stats["parses"] += 1
+    # Imported here: yaml is not needed when the plugins are restored from a snapshot
+    import yaml
+
+    # Use the libyaml bindings when available, they are an order of magnitude faster
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    return yaml.load(yaml_content, Loader=loader)
+
+def get_plugin_template_path(model_name):
     # Try to load instructions from the model-specific file
     instructions_file = f"instructions/{model_name}_plugin.txt"
     if not os.path.exists(instructions_file):
         # If the model-specific file is not found, use the generic file
         instructions_file = "instructions/generic_plugin.txt"
+    return instructions_file
+
+def create_model_instructions(plugin_info, openapi_spec, model_name, stats=None, yaml_content=None):
+    plugin_name = plugin_info.get("name_for_model", "unknown")
+    plugin_description = plugin_info.get("description_for_model", "unknown")
+    # Render the specification at the selected verbosity, and measure the tokens it saves
+    yaml_string = spec_compiler.compile_spec(openapi_spec)
+    if stats is not None:
+        # The downloaded text is a close enough measure of the full specification, dumping it again is costly
+        full_spec = yaml_content if yaml_content is not None else spec_compiler.dump_spec(openapi_spec)
+        full_tokens = context_window.count_text_tokens(full_spec)
+        compiled_tokens = context_window.count_text_tokens(yaml_string)
+        stats["spec_tokens"] = {"full": full_tokens, spec_compiler.VERBOSITY: compiled_tokens}
+        logger.info(
+            "Plugin %s specification: %i tokens (full) -> %i tokens (%s)",
+            plugin_name, full_tokens, compiled_tokens, spec_compiler.VERBOSITY,
+        )
+
+    instructions_file = get_plugin_template_path(model_name)
 
     # Log the name of the file being loaded
     logger.debug("Loading instructions template from file: %s", instructions_file)
@@ -84,18 +114,16 @@ def create_model_instructions(plugin_location, model_name):
     # Format the instructions using the context of the associated variables
     instructions = instructions_template.format(plugin_name=plugin_name,plugin_description=plugin_description,yaml_string=yaml_string)
 
-    return instructions, plugin_info, yaml_content
-
-def create_request_stubs(service_name, yaml_content, api_url):
-    openapi_spec = yaml.safe_load(yaml_content)
+    return instructions
 
+def create_request_stubs(service_name, openapi_spec, api_url):
     paths = openapi_spec.get('paths', {})
     servers = openapi_spec.get('servers', [])
     # If 'servers' doesn't exist, build the missing part from the api_url
     if not servers:
         parsed_url = urlparse(api_url)
         server_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
-        servers.append({'url': server_url})
+        servers = [{'url': server_url}]
 
     stubs = {
         service_name: {
@@ -106,45 +134,64 @@ def create_request_stubs(service_name, yaml_content, api_url):
         }
     }
 
-    for path, methods in paths.items():
-        for method, operation in methods.items():
+    for path, path_item in paths.items():
+        path_item, _ = spec_compiler.resolve(path_item, openapi_spec)
+        for method, operation in path_item.items():
+            # Path items also hold path-level "parameters", "summary"...
+            if method not in spec_compiler.HTTP_METHODS or not isinstance(operation, dict):
+                continue
             operation_id = operation.get('operationId')
             if operation_id:
                 stubs[service_name]['operations'][operation_id] = {
                     'path': path,
                     'method': method.upper(),
-                    'parameters': operation.get('parameters', [])
+                    'parameters': operation.get('parameters', []),
+                    # Compiled once here, checked before each invocation
+                    'validator': command_validator.compile_operation(operation_id, path, operation, path_item, openapi_spec),
                 }
     return stubs
 
-def save_bearer_token(plugin_info, plugin_dir):
+def save_bearer_token(plugin_info, plugin_dir, user_input=contextlib.nullcontext):
+    # user_input() wraps the time spent waiting for the user, who may be answering another prompt first
     auth = plugin_info.get("auth")
     if auth and auth.get("type") == "user_http" and auth.get("authorization_type") == "bearer":
         bearer_file = os.path.join(plugin_dir, "bearer.secret")
-        if os.path.exists(bearer_file):
-            logger.info("Bearer token file already existing. Skipping")
-            return
-        token = input("Enter the bearer token: ")
-        with open(bearer_file, "w", encoding="utf-8") as f:
-            f.write(token)
+        with user_input(), _input_lock:
+            if os.path.exists(bearer_file):
+                logger.info("Bearer token file already existing. Skipping")
+                return
+            token = input(f"Enter the bearer token for {plugin_info.get('name_for_model')}: ")
+            with open(bearer_file, "w", encoding="utf-8") as f:
+                f.write(token)
         logger.info("Bearer token saved successfully.")
 
-def register_plugin(plugin_url, model_name):
+def get_manifest_url(plugin_url):
+    # A bare base URL points to the well-known manifest location
     if re.match(r"^https?://[^/]+$", plugin_url):
-        plugin_location = f"{plugin_url}/.well-known/ai-plugin.json"
-    instructions, plugin_info, yaml_content = create_model_instructions(plugin_url, model_name)
+        return f"{plugin_url}/.well-known/ai-plugin.json"
+    return plugin_url
+
+def prepare_plugin(plugin_url, model_name, user_input=contextlib.nullcontext):
+    # Fetch, parse and render a plugin without adding it (see add_plugin), so a registration
+    # abandoned on timeout leaves no trace. Each artifact is fetched once and parsed at most once
+    # (not at all when it is unchanged since the previous registration), the parsed OpenAPI
+    # specification is then shared between instructions rendering and request stubs creation.
+    stats = {"http_requests": 0, "parses": 0}
+
+    plugin_location = get_manifest_url(plugin_url)
+
+    manifest_content, manifest_metadata, manifest_source = fetch_artifact(plugin_location, "manifest", stats)
+    plugin_info = parse_artifact(plugin_location, manifest_content, manifest_source, parse_plugin_info, stats)
     plugin_name = plugin_info.get("name_for_model")
 
     if not plugin_name:
         logger.error("Plugin name_for_model is missing or invalid")
         sys.exit(1)
 
-    plugin_dir = os.path.join("plugins", plugin_name)
-    os.makedirs(plugin_dir, exist_ok=True)
-
-    save_plugin_info(plugin_info, plugin_dir)
+    plugin_dir = get_plugin_dir(plugin_name)
+    plugin_cache.save(plugin_dir, "manifest", manifest_content, manifest_metadata, manifest_source)
     # Save the bearer token if authentication uses a bearer token
-    save_bearer_token(plugin_info, plugin_dir)
+    save_bearer_token(plugin_info, plugin_dir, user_input)
 
     # Extract the api_url from the plugin_info dictionary
     api_url = plugin_info.get("api", {}).get("url")
@@ -152,19 +199,36 @@ def register_plugin(plugin_url, model_name):
         logger.error("API URL is missing or invalid")
         sys.exit(1)
 
-# If the api_url is incomplete, use urljoin to complement the missing information
+    # If the api_url is incomplete, use urljoin to complement the missing information
     if not api_url.startswith(('http://', 'https://')):
-        api_url = urljoin(plugin_url, api_url)
+        api_url = urljoin(plugin_location, api_url)
+
+    yaml_content, yaml_metadata, yaml_source = fetch_artifact(api_url, "openapi", stats, plugin_dir)
+    plugin_cache.save(plugin_dir, "openapi", yaml_content, yaml_metadata, yaml_source)
+    openapi_spec = parse_artifact(api_url, yaml_content, yaml_source, parse_openapi_spec, stats)
 
-    fetch_and_save_yaml(api_url, plugin_dir)
+    instructions = create_model_instructions(plugin_info, openapi_spec, model_name, stats, yaml_content)
 
     # Create request stubs for the plugin
-    stub=plugin_stubs.update(create_request_stubs(plugin_name, yaml_content,api_url))
+    stub = create_request_stubs(plugin_name, openapi_spec, api_url)[plugin_name]
+    return plugin_name, stub, instructions, stats
+
+def add_plugin(plugin_name, stub, stats):
+    plugin_stubs[plugin_name] = stub
+    # Compiled once, with the bearer token, for the invocations
+    operation_table.add_plugin(plugin_name, stub)
 
     setattr(sys.modules[__name__], plugin_name, stub)
 
+    registration_stats[plugin_name] = stats
+
     logger.info("Plugin %s registered successfully", plugin_name)
     logger.debug(" Plugin stubs: %s", plugin_stubs)
+    logger.debug(" Registration stats: %s", stats)
+
+def register_plugin(plugin_url, model_name):
+    plugin_name, stub, instructions, stats = prepare_plugin(plugin_url, model_name)
+    add_plugin(plugin_name, stub, stats)
 
     # Return the created stubs
     return plugin_name, stub, instructions
@@ -0,0 +1,197 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Cache of plugin operation responses.
+
+Responses are keyed by (plugin name, operationId, canonicalised parameters, request
+headers), so a response fetched with one bearer token is never served for another, and
+kept in memory (LRU, at most MAX_ENTRIES entries) and on disk in plugins/<name>/responses/.
+The files on disk are indexed in memory, the index being built from the directory on the
+first write for the plugin.
+Only safe methods are cached by default. The Cache-Control header of the plugin
+response is honoured (no-store, no-cache and max-age); otherwise entries expire after
+the TTL of the plugin (PLUGIN_TTLS) or DEFAULT_TTL.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import plugin_cache
+
+logger = logging.getLogger('pluginspartylogger')
+
+ENABLED = True
+# Time (in seconds) during which a response is reused, unless the plugin sets max-age
+DEFAULT_TTL = 300
+# Per-plugin TTL overrides: name_for_model -> seconds
+PLUGIN_TTLS = {}
+# Maximum number of responses kept in memory and on disk per plugin
+MAX_ENTRIES = 256
+CACHEABLE_METHODS = {"GET", "HEAD"}
+RESPONSES_DIR = "responses"
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+# plugin name -> the keys of its responses on disk, least recently written first
+_disk_index = {}
+_disk_lock = threading.Lock()
+
+
+def get_stats():
+    """
+    Return a copy of the cache hit/miss statistics.
+    """
+    with _lock:
+        return dict(_stats, entries=len(_entries))
+
+
+def _cache_key(plugin_name, operation_id, parameters, headers=None):
+    canonical_parameters = json.dumps(parameters, sort_keys=True, separators=(",", ":"))
+    # The headers carry the auth identity (bearer token...), only their hash ends up in the key
+    canonical_headers = json.dumps(headers or {}, sort_keys=True, separators=(",", ":"))
+    digest = hashlib.sha256(
+        f"{plugin_name}\0{operation_id}\0{canonical_parameters}\0{canonical_headers}".encode("utf-8")
+    )
+    return digest.hexdigest()
+
+
+def _responses_dir(plugin_name):
+    return os.path.join(plugin_cache.PLUGINS_DIR, plugin_name, RESPONSES_DIR)
+
+
+def _ttl_from_cache_control(cache_control, default_ttl):
+    """
+    Return the TTL to apply given a Cache-Control header, 0 meaning the response must not be cached.
+    """
+    if not cache_control:
+        return default_ttl
+    directives = [directive.strip().lower() for directive in cache_control.split(",")]
+    if "no-store" in directives or "no-cache" in directives:
+        return 0
+    for directive in directives:
+        match = re.match(r"max-age\s*=\s*\"?(\d+)\"?", directive)
+        if match:
+            return int(match.group(1))
+    return default_ttl
+
+
+def _remember(key, entry):
+    # Caller holds the lock
+    _entries[key] = entry
+    _entries.move_to_end(key)
+    while len(_entries) > MAX_ENTRIES:
+        _entries.popitem(last=False)
+        _stats["evictions"] += 1
+
+
+def _read_from_disk(plugin_name, key):
+    try:
+        with open(os.path.join(_responses_dir(plugin_name), f"{key}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _get_disk_index(plugin_name, responses_dir):
+    # Caller holds the disk lock
+    index = _disk_index.get(plugin_name)
+    if index is None:
+        files = [entry for entry in os.scandir(responses_dir) if entry.name.endswith(".json")]
+        files.sort(key=lambda file: file.stat().st_mtime)
+        index = _disk_index[plugin_name] = OrderedDict((file.name[:-len(".json")], None) for file in files)
+    return index
+
+
+def _write_to_disk(plugin_name, key, entry):
+    responses_dir = _responses_dir(plugin_name)
+    try:
+        os.makedirs(responses_dir, exist_ok=True)
+        path = os.path.join(responses_dir, f"{key}.json")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(f"{path}.tmp", path)
+
+        with _disk_lock:
+            index = _get_disk_index(plugin_name, responses_dir)
+            index[key] = None
+            index.move_to_end(key)
+            while len(index) > MAX_ENTRIES:
+                old_key, _ = index.popitem(last=False)
+                try:
+                    os.remove(os.path.join(responses_dir, f"{old_key}.json"))
+                except FileNotFoundError:
+                    pass
+    except OSError as anexception:
+        logger.debug("Could not persist plugin response: %s", anexception)
+
+
+def lookup(plugin_name, operation_id, method, parameters, headers=None):
+    """
+    Return the cached response of an operation called with these request headers, or None if
+    there is no valid cached response.
+    """
+    if not ENABLED or method not in CACHEABLE_METHODS:
+        return None
+
+    key = _cache_key(plugin_name, operation_id, parameters, headers)
+    now = time.time()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            entry = _read_from_disk(plugin_name, key)
+            if entry is not None and entry["expires_at"] > now:
+                _remember(key, entry)
+        if entry is not None and entry["expires_at"] > now:
+            _entries.move_to_end(key)
+            _stats["hits"] += 1
+            logger.debug("Plugin response cache hit for %s.%s", plugin_name, operation_id)
+            return entry["response"]
+        _entries.pop(key, None)
+        _stats["misses"] += 1
+        return None
+
+
+def store(plugin_name, operation_id, method, parameters, response, cache_control=None, headers=None):
+    """
+    Cache the response of an operation called with these request headers, if its method and
+    Cache-Control header allow it.
+    """
+    if not ENABLED or method not in CACHEABLE_METHODS:
+        return
+
+    ttl = _ttl_from_cache_control(cache_control, PLUGIN_TTLS.get(plugin_name, DEFAULT_TTL))
+    if ttl <= 0:
+        return
+
+    key = _cache_key(plugin_name, operation_id, parameters, headers)
+    entry = {"expires_at": time.time() + ttl, "response": response}
+    with _lock:
+        _remember(key, entry)
+        _stats["stores"] += 1
+    _write_to_disk(plugin_name, key, entry)
+
+
+def clear():
+    """
+    Empty the in-memory cache and reset the statistics.
+    """
+    with _lock:
+        _entries.clear()
+        for stat in _stats:
+            _stats[stat] = 0
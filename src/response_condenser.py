@@ -0,0 +1,218 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Condensing of plugin responses.
+
+A plugin response is sent to the model, and then with every later request of the
+conversation: a response longer than MAX_CHARS is condensed first.
+
+- JSON responses keep all their top-level keys. Arrays are cut to a few items, long
+  strings are shortened and HTML is stripped from them. The limits are tightened until
+  the response fits.
+- HTML responses are reduced to their text.
+- Anything still too long is cut.
+
+A response cut by the plugin HTTP client (see truncation_note) is condensed without its
+note, the note being added back after: a truncated JSON document is closed after its last
+complete value, so it is condensed as JSON too.
+
+The full response is kept in a small in-memory store: the condensed response refers to
+it by number, and the user can display it with the /response command.
+"""
+
+import html
+import itertools
+import json
+import re
+import threading
+from collections import OrderedDict
+
+# Maximum size (in characters) of a response sent to the model, None to send responses as is
+MAX_CHARS = 4000
+# Number of full responses kept for the /response command
+STORE_SIZE = 32
+# Successive (array items, string characters) limits applied to JSON responses
+JSON_LIMITS = ((10, 500), (5, 200), (3, 100), (1, 40))
+# Nesting depth below which objects and arrays are summarized
+MAX_DEPTH = 6
+
+_HTML_TAG = re.compile(r"<[a-zA-Z/!][^>]*>")
+_HTML_HIDDEN = re.compile(r"<(script|style|head|noscript)\b.*?</\1\s*>", re.IGNORECASE | re.DOTALL)
+_HTML_BREAK = re.compile(r"<(?:br|/p|/div|/li|/tr|/h\d)\b[^>]*>", re.IGNORECASE)
+_SPACES = re.compile(r"[ \t\r\f\v]+")
+_BLANK_LINES = re.compile(r"\s*\n\s*")
+# JSON strings (possibly unterminated) and structural characters
+_JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"?|[\[\]{},]')
+_TRUNCATION_NOTE = re.compile(r"\n\[response truncated after \d+ bytes\]\Z")
+
+_lock = threading.Lock()
+_store = OrderedDict()
+_store_ids = itertools.count(1)
+
+
+def looks_like_html(text):
+    return bool(_HTML_TAG.search(text[:2000])) and "</" in text
+
+
+def strip_html(text):
+    """
+    Reduce HTML to its text: hidden elements and tags removed, entities decoded, blanks collapsed.
+    """
+    text = _HTML_HIDDEN.sub(" ", text)
+    text = _HTML_BREAK.sub("\n", text)
+    text = html.unescape(_HTML_TAG.sub(" ", text))
+    text = _SPACES.sub(" ", text)
+    return _BLANK_LINES.sub("\n", text).strip()
+
+
+def truncation_note(size):
+    """
+    Return the note appended to a response cut after size bytes.
+    """
+    return f"\n[response truncated after {size} bytes]"
+
+
+def repair_truncated_json(text):
+    """
+    Parse the beginning of a truncated JSON document: the value being written when it was cut
+    is dropped and the open arrays and objects are closed.
+
+    Returns:
+        The parsed value, or None if the beginning of the text cannot be parsed.
+    """
+    closers = []
+    cut = None
+    for token in _JSON_TOKEN.finditer(text):
+        char = token.group()
+        if char in "[{":
+            closers.append("]" if char == "[" else "}")
+        elif char in "]}":
+            if not closers:
+                return None
+            closers.pop()
+        elif char != ",":
+            continue
+        # The document can be closed right after an opening, a closing or before a comma
+        cut = (token.end() if char != "," else token.start(), "".join(reversed(closers)))
+    if cut is None:
+        return None
+    try:
+        return json.loads(text[:cut[0]] + cut[1])
+    except ValueError:
+        return None
+
+
+def _truncate(text, max_chars):
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}... [{len(text) - max_chars} more characters]"
+
+
+def _condense_value(value, max_items, max_string_chars, depth=0):
+    if isinstance(value, dict):
+        if depth >= MAX_DEPTH:
+            return f"{{{len(value)} keys}}"
+        return {
+            key: _condense_value(item, max_items, max_string_chars, depth + 1)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        if depth >= MAX_DEPTH:
+            return f"[{len(value)} items]"
+        condensed = [_condense_value(item, max_items, max_string_chars, depth + 1) for item in value[:max_items]]
+        if len(value) > max_items:
+            condensed.append(f"... {len(value) - max_items} more items")
+        return condensed
+    if isinstance(value, str):
+        if "<" in value and looks_like_html(value):
+            value = strip_html(value)
+        return _truncate(value, max_string_chars)
+    return value
+
+
+def condense(text, max_chars=None, truncated=False):
+    """
+    Condense a response to at most about max_chars characters.
+
+    Args:
+        text (str): The response.
+        max_chars (int): The maximum size, MAX_CHARS by default.
+        truncated (bool): Whether the response was cut, a JSON response is then repaired first.
+
+    Returns:
+        str: The condensed response, or the response itself if it is short enough.
+    """
+    max_chars = MAX_CHARS if max_chars is None else max_chars
+    if max_chars is None or len(text) <= max_chars:
+        return text
+
+    stripped = text.lstrip()
+    if stripped[:1] in ("{", "["):
+        try:
+            value = json.loads(stripped)
+        except ValueError:
+            value = repair_truncated_json(stripped) if truncated else None
+        if value is not None:
+            for max_items, max_string_chars in JSON_LIMITS:
+                condensed = json.dumps(
+                    _condense_value(value, max_items, max_string_chars), ensure_ascii=False, separators=(",", ":")
+                )
+                if len(condensed) <= max_chars:
+                    return condensed
+            return _truncate(condensed, max_chars)
+
+    if looks_like_html(text):
+        text = strip_html(text)
+    return _truncate(text, max_chars)
+
+
+def store(text):
+    """
+    Keep a full response, the oldest ones being dropped.
+
+    Returns:
+        int: The number of the response.
+    """
+    with _lock:
+        response_id = next(_store_ids)
+        _store[response_id] = text
+        while len(_store) > STORE_SIZE:
+            _store.popitem(last=False)
+    return response_id
+
+
+def get(response_id=None):
+    """
+    Return a full response kept by store(), the last one by default, or None.
+    """
+    with _lock:
+        if response_id is None:
+            return next(reversed(_store.values()), None)
+        return _store.get(response_id)
+
+
+def condense_response(text):
+    """
+    Condense a plugin response for the model, keeping the full response in the store.
+
+    Returns:
+        str: The response as is if it is short enough, otherwise the condensed response followed
+        by a note giving its original size and its number in the store.
+    """
+    note = _TRUNCATION_NOTE.search(text)
+    body = text[:note.start()] if note is not None else text
+    condensed = condense(body, truncated=note is not None)
+    if condensed is body:
+        return text
+    response_id = store(text)
+    condensed = f"{condensed}\n[condensed from {len(body)} characters, full response #{response_id}]"
+    return condensed + note.group() if note is not None else condensed
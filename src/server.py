@@ -0,0 +1,320 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Multi-session HTTP server.
+
+Plugins are registered once. Their instructions and request stubs are then shared,
+read-only, by every session, while each session owns its conversation. Sessions are
+served concurrently by a single asyncio event loop: model completions are awaited
+(and streamed) without blocking, plugin invocations run on a thread pool.
+
+    POST   /sessions                       create a session -> {"session_id": ...}
+    POST   /sessions/<id>/messages         send a prompt: {"content": "...", "stream": true}
+    GET    /sessions/<id>                  the conversation (without the instructions)
+    DELETE /sessions/<id>                  close the session
+    GET    /health
+
+With "stream": true, the answer is sent as server-sent events:
+
+    event: delta             {"content": "..."}            a piece of the answer
+    event: commands          [{"plugin", "operation", "parameters"}...]
+    event: plugin_responses  ["...", ...]
+    event: answer            {"content": "..."}            a complete answer
+    event: done              {}
+    event: error             {"error": "..."}
+
+Otherwise the answers, commands and plugin responses are returned as a single JSON object.
+
+Each session handles SESSION_CONCURRENCY turns at a time (further requests get a 429),
+and at most MAX_CONCURRENT_TURNS turns run at once: requests wait up to QUEUE_TIMEOUT
+seconds for a slot, then get a 503. Streamed events are written as fast as the client
+reads them, a slow client only slows down its own completion.
+"""
+
+import asyncio
+import json
+import logging
+import secrets
+import time
+
+from aiohttp import ClientSession, web
+
+import context_window
+import llm_client
+import plugin_router
+from command_scanner import CommandScanner, InvalidCommandFormatError, scan_commands
+
+logger = logging.getLogger('pluginspartylogger')
+
+# Turns run concurrently by a single session
+SESSION_CONCURRENCY = 1
+# Turns run concurrently by the whole server
+MAX_CONCURRENT_TURNS = 64
+# Time (in seconds) a request waits for a turn slot before being rejected
+QUEUE_TIMEOUT = 10
+# Maximum number of open sessions
+MAX_SESSIONS = 1000
+# Sessions idle for longer than this (in seconds) are closed
+SESSION_TTL = 3600
+# Attempts given to the model to correct an invalid plugin command
+MAX_COMMAND_RETRIES = 3
+
+INVALID_COMMAND_MESSAGE = (
+    "<RESPONSE FROM plugin> {error} "
+    "</RESPONSE> analyse the error and try to correct the command. Make sure it respects the format and "
+    "that the syntax is valid. (ex: matching opening and closing brackets and parenthesis are mandatory)"
+)
+GENERIC_COMMAND_ERROR = "Invalid Plugin function call. Check the parameter is a well-formed JSON Object."
+
+
+class Session:
+    """
+    A conversation, starting with the shared instructions.
+    """
+
+    def __init__(self, instructions):
+        self.session_id = secrets.token_urlsafe(16)
+        self.instructions_count = len(instructions)
+        # The instruction messages themselves are shared, only the list is owned
+        self.messages = list(instructions)
+        self.semaphore = asyncio.Semaphore(SESSION_CONCURRENCY)
+        self.last_used = time.monotonic()
+
+    def history(self):
+        return self.messages[self.instructions_count:]
+
+
+class PluginsPartyServer:
+    """
+    Serve conversations over HTTP.
+
+    Args:
+        instructions (list): The instruction messages, as returned by `build_instructions`.
+        completion_args (dict): The chat completion arguments (model, temperature...), not modified.
+        invoke_commands (callable): Called with a list of commands, returns their responses.
+        build_response_message (callable): Called with (commands, responses), returns the message
+            sending the responses back to the model.
+        invoke_plugins (bool): Whether plugin commands are invoked.
+    """
+
+    def __init__(self, instructions, completion_args, invoke_commands, build_response_message, invoke_plugins=True):
+        self.instructions = instructions
+        self.completion_args = dict(completion_args)
+        self.invoke_commands = invoke_commands
+        self.build_response_message = build_response_message
+        self.invoke_plugins = invoke_plugins
+        self.sessions = {}
+        self.turns = None
+        self.llm_session = None
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post("/sessions", self.create_session)
+        app.router.add_post("/sessions/{session_id}/messages", self.post_message)
+        app.router.add_get("/sessions/{session_id}", self.get_session)
+        app.router.add_delete("/sessions/{session_id}", self.delete_session)
+        app.router.add_get("/health", self.health)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    async def _on_startup(self, app):
+        self.turns = asyncio.Semaphore(MAX_CONCURRENT_TURNS)
+        # A single connection pool to the model API, shared by all the sessions
+        self.llm_session = ClientSession()
+        app["expire_sessions"] = asyncio.create_task(self._expire_sessions())
+
+    async def _on_cleanup(self, app):
+        app["expire_sessions"].cancel()
+        await self.llm_session.close()
+
+    async def _expire_sessions(self):
+        while True:
+            await asyncio.sleep(min(60, SESSION_TTL))
+            now = time.monotonic()
+            for session_id, session in list(self.sessions.items()):
+                if now - session.last_used > SESSION_TTL and not session.semaphore.locked():
+                    logger.info("Session %s expired", session_id)
+                    del self.sessions[session_id]
+
+    def _get_session(self, request):
+        session = self.sessions.get(request.match_info["session_id"])
+        if session is None:
+            raise web.HTTPNotFound(text="Unknown session")
+        session.last_used = time.monotonic()
+        return session
+
+    async def health(self, request):
+        return web.json_response({"sessions": len(self.sessions)})
+
+    async def create_session(self, request):
+        if len(self.sessions) >= MAX_SESSIONS:
+            raise web.HTTPServiceUnavailable(text="Too many sessions")
+        session = Session(self.instructions)
+        self.sessions[session.session_id] = session
+        logger.info("Session %s created", session.session_id)
+        return web.json_response({"session_id": session.session_id}, status=201)
+
+    async def get_session(self, request):
+        session = self._get_session(request)
+        return web.json_response({"session_id": session.session_id, "messages": session.history()})
+
+    async def delete_session(self, request):
+        session = self._get_session(request)
+        del self.sessions[session.session_id]
+        return web.Response(status=204)
+
+    async def post_message(self, request):
+        session = self._get_session(request)
+        try:
+            body = await request.json()
+            content = body["content"]
+        except (ValueError, KeyError, TypeError):
+            raise web.HTTPBadRequest(text='Expected a JSON object with a "content" string')
+        stream = bool(body.get("stream", False))
+
+        if session.semaphore.locked():
+            raise web.HTTPTooManyRequests(text="A turn is already running for this session")
+        async with session.semaphore:
+            try:
+                await asyncio.wait_for(self.turns.acquire(), QUEUE_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise web.HTTPServiceUnavailable(text="Server busy", headers={"Retry-After": str(QUEUE_TIMEOUT)})
+            try:
+                if stream:
+                    return await self._stream_turn(request, session, content)
+                events = []
+
+                async def collect(event, data):
+                    if event != "delta":
+                        events.append((event, data))
+
+                try:
+                    await self.run_turn(session, content, collect, stream=False)
+                except Exception as anexception:
+                    logger.info("Session %s: turn failed: %s", session.session_id, anexception)
+                    events.append(("error", {"error": str(anexception)}))
+                    return web.json_response(self._summarize(events), status=502)
+                return web.json_response(self._summarize(events))
+            finally:
+                self.turns.release()
+                session.last_used = time.monotonic()
+
+    async def _stream_turn(self, request, session, content):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        async def send(event, data):
+            # write() waits for the client to read: a slow client slows its own turn only
+            await response.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+
+        try:
+            await self.run_turn(session, content, send, stream=True)
+            await send("done", {})
+        except ConnectionResetError:
+            logger.info("Session %s: client disconnected", session.session_id)
+        except Exception as anexception:
+            logger.info("Session %s: turn failed: %s", session.session_id, anexception)
+            await send("error", {"error": str(anexception)})
+        return response
+
+    @staticmethod
+    def _summarize(events):
+        result = {"answers": [], "commands": [], "plugin_responses": [], "error": None}
+        for event, data in events:
+            if event == "answer":
+                result["answers"].append(data["content"])
+            elif event == "commands":
+                result["commands"].extend(data)
+            elif event == "plugin_responses":
+                result["plugin_responses"].extend(data)
+            elif event == "error":
+                result["error"] = data["error"]
+        result["final_answer"] = result["answers"][-1] if result["answers"] else None
+        return result
+
+    async def complete(self, session, emit, stream):
+        """
+        Send the session conversation to the model and append its answer.
+
+        Returns:
+            str: The answer.
+        """
+        llm_client.get_openai().aiosession.set(self.llm_session)
+        completion_args = dict(
+            self.completion_args,
+            messages=context_window.fit(plugin_router.route(session.messages)),
+            stream=stream,
+        )
+        response = await llm_client.acreate(**completion_args)
+        if stream:
+            scanner = CommandScanner()
+            async for chunk in response:
+                delta = chunk["choices"][0]["delta"]
+                if "content" in delta:
+                    scanner.feed(delta["content"])
+                    await emit("delta", {"content": delta["content"]})
+            content = scanner.text
+        else:
+            content = response["choices"][0]["message"]["content"]
+        session.messages.append({"role": "assistant", "content": content})
+        await emit("answer", {"content": content})
+        return content
+
+    async def run_turn(self, session, content, emit, stream=True):
+        """
+        Run a conversation turn: answer the prompt, invoke the plugin commands of the answer and
+        get the final answer. Events are reported through emit(event, data).
+        """
+        session.messages.append({"role": "user", "content": content})
+        answer = await self.complete(session, emit, stream)
+
+        for attempt in range(MAX_COMMAND_RETRIES + 1):
+            try:
+                commands = scan_commands(answer)
+            except InvalidCommandFormatError as anexception:
+                error = anexception
+            else:
+                if not commands or not self.invoke_plugins:
+                    return
+                await emit("commands", [
+                    {"plugin": plugin_name, "operation": operation_id, "parameters": parameters}
+                    for (plugin_name, operation_id), parameters in commands
+                ])
+                try:
+                    # Plugin requests are blocking, they run on the default thread pool
+                    loop = asyncio.get_running_loop()
+                    responses = await loop.run_in_executor(None, self.invoke_commands, commands)
+                except Exception as anexception:
+                    error = anexception
+                else:
+                    await emit("plugin_responses", responses)
+                    session.messages.append(self.build_response_message(commands, responses))
+                    await self.complete(session, emit, stream)
+                    return
+
+            logger.info("Session %s: plugin invocation failed: %s", session.session_id, error)
+            if attempt == MAX_COMMAND_RETRIES:
+                logger.info("Session %s: reached maximum number of allowed exceptions - aborting", session.session_id)
+                return
+            if not isinstance(error, InvalidCommandFormatError):
+                error = GENERIC_COMMAND_ERROR
+            session.messages.append({"role": "user", "content": INVALID_COMMAND_MESSAGE.format(error=error)})
+            answer = await self.complete(session, emit, stream)
+
+
+def run_server(server, host="127.0.0.1", port=8080):
+    """
+    Serve until interrupted.
+    """
+    logger.info("Serving PluginsParty on http://%s:%i", host, port)
+    web.run_app(server.create_app(), host=host, port=port, print=None)
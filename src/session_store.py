@@ -0,0 +1,208 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Persistent conversation sessions.
+
+Each session is an append-only log, sessions/<id>.jsonl: a header line, then one line
+per message of the conversation, instructions included. Messages are appended (and
+flushed to disk) as the conversation goes, so a crash loses at most the turn in
+progress: an incomplete last line is dropped when the session is opened again.
+
+The plugin operations registered in the session are saved next to it (<id>.ops, see
+operation_table). Resuming a session restores the conversation, the pinned instructions
+and the plugin routing from the log and the operations from the table, without any
+network request.
+
+The byte offset of each message is kept, so long histories are paged through by reading
+only the lines of the page.
+"""
+
+import json
+import logging
+import os
+import secrets
+import time
+
+import context_window
+import operation_table
+import plugin_router
+
+logger = logging.getLogger('pluginspartylogger')
+
+# Bump when the layout of the log changes
+SESSION_VERSION = 1
+SESSIONS_DIR = "sessions"
+ENABLED = True
+# Number of messages shown per page by /m
+PAGE_SIZE = 20
+
+
+def new_session_id():
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(2)}"
+
+
+def get_session_path(session_id):
+    return os.path.join(SESSIONS_DIR, f"{session_id}.jsonl")
+
+
+def latest_session_id():
+    """
+    Return the id of the last updated session, or None if there is none.
+    """
+    try:
+        entries = [entry for entry in os.scandir(SESSIONS_DIR) if entry.name.endswith(".jsonl")]
+    except FileNotFoundError:
+        return None
+    if not entries:
+        return None
+    return max(entries, key=lambda entry: entry.stat().st_mtime).name[:-len(".jsonl")]
+
+
+def _encode(record):
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8") + b"\n"
+
+
+class SessionStore:
+    """
+    The log of a session.
+
+    Use SessionStore.create to start a session, SessionStore.open to resume one.
+
+    Args:
+        session_id (str): The id of the session.
+        header (dict): The first record of the log.
+        offsets (list): The byte offset of each message line.
+    """
+
+    def __init__(self, session_id, header, offsets):
+        self.session_id = session_id
+        self.header = header
+        self.path = get_session_path(session_id)
+        self.table_path = os.path.join(SESSIONS_DIR, f"{session_id}.ops")
+        self._offsets = offsets
+
+    @classmethod
+    def create(cls, session_id=None, **metadata):
+        """
+        Start a new session log, metadata (model...) being saved in its header.
+        """
+        session_id = session_id or new_session_id()
+        header = dict(metadata, type="session", version=SESSION_VERSION, session_id=session_id, created=time.time())
+        os.makedirs(SESSIONS_DIR, exist_ok=True)
+        with open(get_session_path(session_id), "xb") as file:
+            file.write(_encode(header))
+            file.flush()
+            os.fsync(file.fileno())
+        return cls(session_id, header, [])
+
+    @classmethod
+    def open(cls, session_id):
+        """
+        Open a session log and restore the state it holds.
+
+        The instruction messages are pinned (see context_window), the plugin instructions
+        indexed (see plugin_router) and the operation table loaded.
+
+        Returns:
+            tuple: The SessionStore and the messages of the conversation, or (None, None) if
+            the session does not exist or cannot be read.
+        """
+        path = get_session_path(session_id)
+        messages = []
+        offsets = []
+        header = None
+        try:
+            with open(path, "r+b") as file:
+                offset = 0
+                for line in file:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("incomplete line")
+                        record = json.loads(line)
+                    except ValueError:
+                        # Only the last line can be incomplete, after a crash while it was written
+                        logger.warning("Session %s: dropping an incomplete record at offset %i", session_id, offset)
+                        file.truncate(offset)
+                        break
+                    if header is None:
+                        header = record
+                    elif record.get("type") == "message":
+                        message = record["message"]
+                        if record.get("pinned"):
+                            context_window.pin(message)
+                        if record.get("plugin"):
+                            plugin_router.add(record["plugin"], message)
+                        messages.append(message)
+                        offsets.append(offset)
+                    offset += len(line)
+        except FileNotFoundError:
+            return None, None
+        except OSError as anexception:
+            logger.error("Session %s cannot be read: %s", session_id, anexception)
+            return None, None
+        if header is None or header.get("version") != SESSION_VERSION:
+            logger.error("Session %s: unknown format", session_id)
+            return None, None
+
+        store = cls(session_id, header, offsets)
+        if not operation_table.load(store.table_path):
+            logger.warning("Session %s: no plugin operations could be restored, use /register again", session_id)
+        return store, messages
+
+    @property
+    def count(self):
+        """
+        The number of messages saved.
+        """
+        return len(self._offsets)
+
+    def sync(self, messages):
+        """
+        Append the messages not saved yet, messages being the whole conversation.
+        """
+        new_messages = messages[len(self._offsets):]
+        if not new_messages:
+            return
+        with open(self.path, "ab") as file:
+            offset = file.tell()
+            chunks = []
+            for message in new_messages:
+                record = {"type": "message", "message": message}
+                if context_window.is_pinned(message):
+                    record["pinned"] = True
+                plugin_name = plugin_router.get_plugin_name(message)
+                if plugin_name is not None:
+                    record["plugin"] = plugin_name
+                chunk = _encode(record)
+                self._offsets.append(offset)
+                offset += len(chunk)
+                chunks.append(chunk)
+            file.write(b"".join(chunks))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def save_operations(self):
+        """
+        Save the operation table, to be called whenever plugins are registered.
+        """
+        operation_table.save(self.table_path)
+
+    def read(self, start, stop):
+        """
+        Read messages start to stop (excluded) back from the log.
+        """
+        messages = []
+        with open(self.path, "rb") as file:
+            for offset in self._offsets[start:stop]:
+                file.seek(offset)
+                messages.append(json.loads(file.readline())["message"])
+        return messages
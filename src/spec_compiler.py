@@ -0,0 +1,250 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compiler turning OpenAPI specifications into compact operation signatures.
+
+The full YAML dump of a plugin specification is the largest part of the prompt. Models
+only need, for each operation, its operationId, its arguments with their types and a
+short description. Verbosity levels:
+
+    full     the YAML dump of the whole specification (historical behaviour)
+    compact  one signature per operation with its summary and one-line argument descriptions
+    minimal  one signature per operation with its summary
+
+Example of compact output:
+
+    getWeather({"city": string, "units"?: "metric"|"imperial"}) - Get the weather for a city
+        city: City name
+
+Local $ref are resolved; examples, responses and verbose schema details are dropped.
+"""
+
+import datetime
+import json
+import logging
+
+logger = logging.getLogger('pluginspartylogger')
+
+VERBOSITY_FULL = "full"
+VERBOSITY_COMPACT = "compact"
+VERBOSITY_MINIMAL = "minimal"
+VERBOSITY_LEVELS = (VERBOSITY_FULL, VERBOSITY_COMPACT, VERBOSITY_MINIMAL)
+
+VERBOSITY = VERBOSITY_COMPACT
+
+# Nesting depth up to which object schemas are expanded
+MAX_SCHEMA_DEPTH = 2
+MAX_ENUM_VALUES = 8
+MAX_DESCRIPTION_LENGTH = 120
+
+HTTP_METHODS = ("get", "put", "post", "delete", "options", "head", "patch", "trace")
+
+
+def dump_spec(openapi_spec):
+    """
+    Return the full YAML dump of a specification.
+    """
+    # Imported here: yaml is only needed when plugins are registered
+    import yaml
+
+    dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+    return yaml.dump(openapi_spec, Dumper=dumper, default_flow_style=False)
+
+
+def resolve(node, openapi_spec, seen=()):
+    """
+    Resolve a local $ref ("#/components/schemas/Name"). Returns (node, seen) where seen holds
+    the references followed so far, to stop on recursive schemas.
+    """
+    while isinstance(node, dict) and "$ref" in node:
+        ref = node["$ref"]
+        if not isinstance(ref, str) or not ref.startswith("#/") or ref in seen:
+            return {}, seen
+        seen = seen + (ref,)
+        target = openapi_spec
+        for part in ref[2:].split("/"):
+            part = part.replace("~1", "/").replace("~0", "~")
+            target = target.get(part, {}) if isinstance(target, dict) else {}
+        node = target
+    return node if isinstance(node, dict) else {}, seen
+
+
+def _one_line(text):
+    text = " ".join(str(text).split())
+    if len(text) > MAX_DESCRIPTION_LENGTH:
+        text = text[: MAX_DESCRIPTION_LENGTH - 3].rstrip() + "..."
+    return text
+
+
+def json_value(value):
+    """
+    Return a value of the specification as the model sees it in JSON: YAML parses unquoted
+    dates and timestamps (e.g. enum: [2023-01-01]) into date and datetime objects.
+    """
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def render_type(schema, openapi_spec, depth=0, seen=()):
+    """
+    Render a schema as a short type expression, e.g. string, integer[], "a"|"b" or {"key": string}.
+    """
+    schema, seen = resolve(schema, openapi_spec, seen)
+
+    if "enum" in schema:
+        values = [json.dumps(json_value(value), default=str) for value in schema["enum"][:MAX_ENUM_VALUES]]
+        if len(schema["enum"]) > MAX_ENUM_VALUES:
+            values.append("...")
+        return "|".join(values)
+
+    for combinator in ("oneOf", "anyOf"):
+        if combinator in schema:
+            return "|".join(
+                render_type(option, openapi_spec, depth, seen) for option in schema[combinator]
+            )
+    if "allOf" in schema:
+        merged = {"type": "object", "properties": {}, "required": []}
+        for part in schema["allOf"]:
+            part, _ = resolve(part, openapi_spec, seen)
+            merged["properties"].update(part.get("properties", {}))
+            merged["required"].extend(part.get("required", []))
+        schema = merged
+
+    schema_type = schema.get("type")
+    if schema_type == "array" or "items" in schema:
+        return render_type(schema.get("items", {}), openapi_spec, depth + 1, seen) + "[]"
+    if schema_type == "object" or "properties" in schema:
+        properties = schema.get("properties")
+        if not properties or depth >= MAX_SCHEMA_DEPTH:
+            return "object"
+        required = set(schema.get("required", []))
+        fields = [
+            f"{json.dumps(name)}{'' if name in required else '?'}: "
+            f"{render_type(property_schema, openapi_spec, depth + 1, seen)}"
+            for name, property_schema in properties.items()
+        ]
+        return "{" + ", ".join(fields) + "}"
+    if isinstance(schema_type, list):
+        return "|".join(str(item) for item in schema_type)
+    return schema_type or "any"
+
+
+def collect_arguments(operation, path_item, openapi_spec):
+    """
+    Return the arguments of an operation as a list of (name, required, type, description),
+    merging path-level parameters, operation parameters and the JSON request body properties.
+    """
+    arguments = {}
+
+    parameters = list(path_item.get("parameters", [])) + list(operation.get("parameters", []))
+    for parameter in parameters:
+        parameter, _ = resolve(parameter, openapi_spec)
+        name = parameter.get("name")
+        if not name:
+            continue
+        if parameter.get("in") == "body":
+            # Swagger 2 body parameter: its properties are the arguments
+            arguments.update(_body_arguments(parameter.get("schema", {}), openapi_spec))
+            continue
+        schema = parameter.get("schema", parameter)
+        arguments[name] = (
+            name,
+            bool(parameter.get("required")) or parameter.get("in") == "path",
+            render_type(schema, openapi_spec, 1),
+            parameter.get("description") or schema.get("description", ""),
+        )
+
+    request_body, _ = resolve(operation.get("requestBody", {}), openapi_spec)
+    content = request_body.get("content", {})
+    media = content.get("application/json") or next(iter(content.values()), {})
+    if media.get("schema"):
+        arguments.update(_body_arguments(media["schema"], openapi_spec))
+
+    return list(arguments.values())
+
+
+def _body_arguments(schema, openapi_spec):
+    schema, seen = resolve(schema, openapi_spec)
+    required = set(schema.get("required", []))
+    properties = schema.get("properties")
+    if not properties:
+        return {"body": ("body", True, render_type(schema, openapi_spec, 1, seen), "")}
+    arguments = {}
+    for name, property_schema in properties.items():
+        property_schema, property_seen = resolve(property_schema, openapi_spec, seen)
+        arguments[name] = (
+            name,
+            name in required,
+            render_type(property_schema, openapi_spec, 1, property_seen),
+            property_schema.get("description", ""),
+        )
+    return arguments
+
+
+def render_signature(operation_id, arguments):
+    """
+    Render the call of an operation, e.g. getWeather({"city": string, "units"?: "c"|"f"}).
+
+    Args:
+        operation_id (str): The operation id.
+        arguments (list): The arguments, as returned by collect_arguments.
+    """
+    signature = ", ".join(
+        f"{json.dumps(name)}{'' if required else '?'}: {argument_type}"
+        for name, required, argument_type, _ in arguments
+    )
+    return f"{operation_id}({{{signature}}})"
+
+
+def compile_operations(openapi_spec, verbosity):
+    lines = []
+    for path, path_item in openapi_spec.get("paths", {}).items():
+        path_item, _ = resolve(path_item, openapi_spec)
+        for method, operation in path_item.items():
+            if method not in HTTP_METHODS or not isinstance(operation, dict):
+                continue
+            operation_id = operation.get("operationId")
+            if not operation_id:
+                continue
+
+            arguments = collect_arguments(operation, path_item, openapi_spec)
+            summary = operation.get("summary") or operation.get("description", "")
+            line = render_signature(operation_id, arguments)
+            if summary:
+                line += f" - {_one_line(summary)}"
+            lines.append(line)
+
+            if verbosity == VERBOSITY_COMPACT:
+                lines.extend(
+                    f"    {name}: {_one_line(description)}"
+                    for name, _, _, description in arguments
+                    if description
+                )
+    return "\n".join(lines)
+
+
+def compile_spec(openapi_spec, verbosity=None):
+    """
+    Render an OpenAPI specification for the model at the given verbosity level.
+
+    Args:
+        openapi_spec (dict): The parsed OpenAPI specification.
+        verbosity (str): One of VERBOSITY_LEVELS. Defaults to VERBOSITY.
+
+    Returns:
+        str: The rendered specification.
+    """
+    verbosity = verbosity or VERBOSITY
+    if verbosity == VERBOSITY_FULL:
+        return dump_spec(openapi_spec)
+    return compile_operations(openapi_spec, verbosity)
@@ -0,0 +1,134 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Speculative dispatch of plugin commands.
+
+While the answer of the model is streamed, each command reported by the CommandScanner
+is submitted right away, so the plugin request runs while the model is still generating.
+Once the answer is complete, its commands are extracted as usual and collect() matches
+them with the submitted ones: their responses are only waited for, and any other command
+is invoked then. Responses of submitted commands that are not part of the final answer
+are discarded.
+
+In "safe" mode (the default) only operations with a safe method are submitted early,
+as an invalid command further in the answer aborts the turn: the others are invoked
+once the answer is complete, as without speculation.
+"""
+
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+logger = logging.getLogger('pluginspartylogger')
+
+MODES = ("off", "safe", "all")
+MODE = "safe"
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+# Plugin requests run concurrently, shared by all the dispatchers
+MAX_WORKERS = 8
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="speculative")
+        return _executor
+
+
+def is_safe_method(method):
+    """
+    Return True if an operation with this HTTP method has no side effects.
+    """
+    return method in SAFE_METHODS
+
+
+def _command_key(plugin_operation, parameters):
+    return tuple(plugin_operation), json.dumps(parameters, sort_keys=True, separators=(",", ":"))
+
+
+class SpeculativeDispatcher:
+    """
+    Plugin commands submitted while an answer is streamed.
+
+    Args:
+        invoke (callable): Called with (plugin_operation, parameters), returns the response.
+        get_method (callable): Called with plugin_operation, returns the HTTP method of the
+            operation, or None if it is unknown.
+    """
+
+    def __init__(self, invoke, get_method):
+        self.invoke = invoke
+        self.get_method = get_method
+        # command key -> futures, a command may be sent several times in an answer
+        self._pending = {}
+
+    def submit(self, plugin_operation, parameters):
+        """
+        Start the request of a command received while streaming, if speculation allows it.
+
+        Meant to be used as the on_command hook of send_messages.
+        """
+        if MODE == "off":
+            return
+        method = self.get_method(plugin_operation)
+        if method is None or MODE == "safe" and not is_safe_method(method):
+            logger.debug("Not dispatching %s %s before the end of the answer", method, plugin_operation)
+            return
+        logger.debug("Dispatching %s while the answer is streamed", plugin_operation)
+        future = _get_executor().submit(self.invoke, plugin_operation, parameters)
+        self._pending.setdefault(_command_key(plugin_operation, parameters), []).append(future)
+
+    def collect(self, commands):
+        """
+        Get the responses of the commands of the complete answer.
+
+        Args:
+            commands (list): A list of (plugin_operation, parameters) tuples.
+
+        Returns:
+            list: The responses, in the order of the commands. A failed call is reported as
+            the exception it raised.
+        """
+        futures = []
+        for plugin_operation, parameters in commands:
+            submitted = self._pending.get(_command_key(plugin_operation, parameters))
+            if submitted:
+                futures.append(submitted.pop(0))
+                tracing.current().add("speculative_hits")
+            else:
+                futures.append(_get_executor().submit(self.invoke, plugin_operation, parameters))
+        self.discard()
+
+        responses = []
+        for future in futures:
+            try:
+                responses.append(future.result())
+            except Exception as anexception:
+                responses.append(anexception)
+        return responses
+
+    def discard(self):
+        """
+        Drop the commands submitted but not collected, cancelling those not started yet.
+        """
+        for futures in self._pending.values():
+            for future in futures:
+                if future.cancel():
+                    logger.debug("Cancelled a speculative plugin request")
+        self._pending.clear()
@@ -0,0 +1,140 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Incremental renderer of streamed model answers.
+
+Text outside <mrkdwn>...</mrkdwn> blocks is printed as it arrives. Markdown blocks are
+rendered progressively with a single rich Live display, refreshed at most
+REFRESH_PER_SECOND times per second. Each delta is scanned once: a tag split across
+two deltas is detected by keeping the few trailing characters that may start a tag.
+rich is only imported when something is rendered with it.
+"""
+
+import time
+
+OPENING_TAG = "<mrkdwn>"
+CLOSING_TAG = "</mrkdwn>"
+
+# Maximum number of markdown re-renderings per second while a block is streamed
+REFRESH_PER_SECOND = 8
+
+_console = None
+
+
+def get_console():
+    """
+    Return the console shared by all renderings.
+    """
+    global _console
+    if _console is None:
+        from rich.console import Console
+
+        _console = Console()
+    return _console
+
+
+def _partial_tag_length(data, tag, start):
+    """
+    Return the length of the longest suffix of data[start:] that is a prefix of tag.
+    """
+    for length in range(min(len(tag) - 1, len(data) - start), 0, -1):
+        if data.endswith(tag[:length]):
+            return length
+    return 0
+
+
+class MarkdownStreamRenderer:
+    """
+    State machine rendering a stream of text deltas containing <mrkdwn> blocks.
+
+    Usage:
+        renderer = MarkdownStreamRenderer()
+        for delta in deltas:
+            renderer.feed(delta)
+        renderer.close()
+    """
+
+    def __init__(self, console=None, refresh_per_second=None):
+        self.console = console or get_console()
+        self.refresh_interval = 1 / (refresh_per_second or REFRESH_PER_SECOND)
+        self._pending = ""
+        self._in_markdown = False
+        self._markdown_chunks = []
+        self._live = None
+        self._last_refresh = 0
+
+    def feed(self, delta):
+        """
+        Render a new delta of the answer.
+        """
+        data = self._pending + delta if self._pending else delta
+        self._pending = ""
+        position = 0
+        while position < len(data):
+            tag = CLOSING_TAG if self._in_markdown else OPENING_TAG
+            index = data.find(tag, position)
+            if index == -1:
+                # Keep what may be the beginning of a tag until the next delta
+                end = len(data) - _partial_tag_length(data, tag, position)
+                self._emit(data[position:end])
+                self._pending = data[end:]
+                return
+            self._emit(data[position:index])
+            position = index + len(tag)
+            if self._in_markdown:
+                self._end_markdown()
+            else:
+                self._start_markdown()
+
+    def close(self):
+        """
+        Flush the text not rendered yet.
+        """
+        if self._pending:
+            self._emit(self._pending)
+            self._pending = ""
+        if self._in_markdown:
+            self._end_markdown()
+
+    def _emit(self, text):
+        if not text:
+            return
+        if not self._in_markdown:
+            print(text, end="", flush=True)
+            return
+        self._markdown_chunks.append(text)
+        now = time.monotonic()
+        if now - self._last_refresh >= self.refresh_interval:
+            self._refresh()
+            self._last_refresh = now
+
+    def _refresh(self):
+        from rich.markdown import Markdown
+
+        self._live.update(Markdown("".join(self._markdown_chunks)), refresh=True)
+
+    def _start_markdown(self):
+        self._in_markdown = True
+        self._markdown_chunks = []
+        from rich.live import Live
+
+        self._live = Live(console=self.console, auto_refresh=False, transient=False)
+        self._live.start()
+        self._last_refresh = time.monotonic()
+
+    def _end_markdown(self):
+        if self._markdown_chunks:
+            self._refresh()
+        self._live.stop()
+        self._live = None
+        self._markdown_chunks = []
+        self._in_markdown = False
@@ -0,0 +1,300 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Lightweight tracing and metrics.
+
+Spans time the main steps of a turn (send_messages, extract_command, invoke_plugin_stub,
+register_plugin, render...) and carry attributes such as the time to first token,
+tokens per second, bytes in/out or retry counts:
+
+    with tracing.span("invoke_plugin_stub", plugin=plugin_name) as trace:
+        ...
+        trace.set("status", response.status_code)
+
+Finished spans are appended to a JSONL trace file and aggregated into Prometheus
+metrics (a duration histogram per span, and a sum/count pair per METRIC_ATTRIBUTES
+attribute), which can be served over HTTP or written to a text file. The file is rewritten
+by a background thread every METRICS_FLUSH_INTERVAL seconds (if any span finished) and at
+exit, never on the path of the traced steps.
+
+When tracing is disabled (the default), span() returns a shared no-op span.
+"""
+
+import atexit
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('pluginspartylogger')
+
+ENABLED = False
+TRACE_FILE = None
+METRICS_FILE = None
+
+METRICS_PREFIX = "pluginsparty"
+# Interval (in seconds) at which the metrics file is rewritten
+METRICS_FLUSH_INTERVAL = 5
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Numeric span attributes exported as metrics, the others are only written to the trace file
+METRIC_ATTRIBUTES = (
+    "ttft_seconds",
+    "tokens",
+    "tokens_per_second",
+    "render_seconds",
+    "bytes_in",
+    "bytes_out",
+    "retries",
+    "commands",
+    "http_requests",
+    "parses",
+    "speculative_hits",
+)
+
+_lock = threading.Lock()
+_metrics_file_lock = threading.Lock()
+_local = threading.local()
+_ids = itertools.count(1)
+_trace_file = None
+# Set when spans finished since the metrics file was last written
+_metrics_changed = threading.Event()
+_metrics_flusher = None
+# span name -> [bucket counts..., count, sum]
+_durations = {}
+# (span name, attribute) -> [count, sum]
+_attributes = {}
+
+
+class _NoopSpan:
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, key, value):
+        pass
+
+    def add(self, key, value=1):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """
+    A timed step. Use it through span().
+    """
+    enabled = True
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.span_id = next(_ids)
+        self.parent_id = None
+        self.start = None
+        self.duration = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def add(self, key, value=1):
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        if stack:
+            self.parent_id = stack[-1].span_id
+        stack.append(self)
+        self.start = time.time()
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self._started_at
+        _local.stack.pop()
+        if exc_type is not None:
+            self.attributes["error"] = f"{exc_type.__name__}: {exc_value}"
+        _record(self)
+        return False
+
+
+def span(name, **attributes):
+    """
+    Return a span timing the enclosed block, or a no-op span if tracing is disabled.
+    """
+    if not ENABLED:
+        return _NOOP_SPAN
+    return Span(name, attributes)
+
+
+def current():
+    """
+    Return the innermost span open in this thread, or a no-op span.
+    """
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else _NOOP_SPAN
+
+
+def configure(trace_file=None, metrics_file=None, metrics_port=None):
+    """
+    Enable tracing if any export is requested.
+
+    Args:
+        trace_file (str): JSONL file finished spans are appended to.
+        metrics_file (str): File the Prometheus metrics are periodically written to.
+        metrics_port (int): Port of the HTTP endpoint serving the Prometheus metrics at /metrics.
+    """
+    global ENABLED, TRACE_FILE, METRICS_FILE, _trace_file, _metrics_flusher
+    TRACE_FILE = trace_file
+    METRICS_FILE = metrics_file
+    ENABLED = bool(trace_file or metrics_file or metrics_port)
+    if trace_file:
+        _trace_file = open(trace_file, "a", encoding="utf-8")
+    if metrics_file and _metrics_flusher is None:
+        _metrics_flusher = threading.Thread(target=_flush_metrics_periodically, name="metrics-flush", daemon=True)
+        _metrics_flusher.start()
+        atexit.register(flush_metrics)
+    if metrics_port:
+        start_metrics_server(metrics_port)
+
+
+def _record(finished_span):
+    numeric_attributes = [
+        (key, finished_span.attributes[key]) for key in METRIC_ATTRIBUTES
+        if isinstance(finished_span.attributes.get(key), (int, float))
+    ]
+    with _lock:
+        histogram = _durations.get(finished_span.name)
+        if histogram is None:
+            histogram = _durations[finished_span.name] = [0] * (len(DURATION_BUCKETS) + 2)
+        for index, bound in enumerate(DURATION_BUCKETS):
+            if finished_span.duration <= bound:
+                histogram[index] += 1
+        histogram[-2] += 1
+        histogram[-1] += finished_span.duration
+
+        for key, value in numeric_attributes:
+            aggregate = _attributes.setdefault((finished_span.name, key), [0, 0])
+            aggregate[0] += 1
+            aggregate[1] += value
+
+        if _trace_file is not None:
+            _trace_file.write(json.dumps({
+                "span": finished_span.name,
+                "id": finished_span.span_id,
+                "parent": finished_span.parent_id,
+                "thread": threading.current_thread().name,
+                "start": finished_span.start,
+                "duration": finished_span.duration,
+                "attributes": finished_span.attributes,
+            }, default=str) + "\n")
+            _trace_file.flush()
+
+    if METRICS_FILE:
+        _metrics_changed.set()
+
+
+def flush_metrics():
+    """
+    Write the metrics to METRICS_FILE if any span finished since they were last written.
+    """
+    if not METRICS_FILE or not _metrics_changed.is_set():
+        return
+    _metrics_changed.clear()
+    try:
+        write_prometheus(METRICS_FILE)
+    except OSError as anexception:
+        logger.warning("Unable to write the metrics to %s: %s", METRICS_FILE, anexception)
+
+
+def _flush_metrics_periodically():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        flush_metrics()
+
+
+def render_prometheus():
+    """
+    Return the metrics in the Prometheus text exposition format.
+    """
+    lines = [
+        f"# HELP {METRICS_PREFIX}_span_duration_seconds Duration of the traced steps.",
+        f"# TYPE {METRICS_PREFIX}_span_duration_seconds histogram",
+    ]
+    with _lock:
+        durations = {name: list(histogram) for name, histogram in _durations.items()}
+        attributes = {key: list(aggregate) for key, aggregate in _attributes.items()}
+
+    for name, histogram in sorted(durations.items()):
+        for index, bound in enumerate(DURATION_BUCKETS):
+            lines.append(f'{METRICS_PREFIX}_span_duration_seconds_bucket{{span="{name}",le="{bound}"}} {histogram[index]}')
+        lines.append(f'{METRICS_PREFIX}_span_duration_seconds_bucket{{span="{name}",le="+Inf"}} {histogram[-2]}')
+        lines.append(f'{METRICS_PREFIX}_span_duration_seconds_count{{span="{name}"}} {histogram[-2]}')
+        lines.append(f'{METRICS_PREFIX}_span_duration_seconds_sum{{span="{name}"}} {histogram[-1]}')
+
+    for attribute in sorted({key for _, key in attributes}):
+        metric = f"{METRICS_PREFIX}_{attribute}"
+        lines.append(f"# TYPE {metric} summary")
+        for (name, key), (count, total) in sorted(attributes.items()):
+            if key == attribute:
+                lines.append(f'{metric}_count{{span="{name}"}} {count}')
+                lines.append(f'{metric}_sum{{span="{name}"}} {total}')
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path):
+    """
+    Write the metrics to a file in the Prometheus text format (e.g. for the node exporter textfile collector).
+    """
+    content = render_prometheus()
+    tmp_path = f"{path}.tmp"
+    with _metrics_file_lock:
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(content)
+        # Rename so a scraper never reads a partially written file
+        os.replace(tmp_path, path)
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """
+    Serve the Prometheus metrics at http://host:port/metrics from a background thread.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            data = render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics at http://%s:%i/metrics", host, port)
+    return server
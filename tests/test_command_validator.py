@@ -0,0 +1,30 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import yaml
+
+import command_validator
+from test_spec_compiler import DATE_ENUM_SPEC
+
+
+def compile_get_events():
+    openapi_spec = yaml.safe_load(DATE_ENUM_SPEC)
+    path_item = openapi_spec["paths"]["/events"]
+    return command_validator.compile_operation("getEvents", "/events", path_item["get"], path_item, openapi_spec)
+
+
+def test_date_enum_accepts_the_string_the_model_sees():
+    validator = compile_get_events()
+
+    assert command_validator.validate(validator, {"day": "2023-01-01"}) == []
+    errors = command_validator.validate(validator, {"day": "2024-12-31"})
+    assert len(errors) == 1
+    assert "'2023-01-01', '2023-01-02'" in errors[0]
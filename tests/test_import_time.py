@@ -0,0 +1,20 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import run_benchmarks
+
+
+def test_importing_pluginsparty_imports_no_heavy_module():
+    # python -X importtime -c "import pluginsparty", in a new interpreter
+    benchmark, = run_benchmarks.bench_import_time(rounds=1)
+
+    assert benchmark["extra_info"]["heavy_modules"] == []
+    assert not run_benchmarks.check_import_time({"benchmarks": [benchmark]}, max_import_ms=0)
@@ -0,0 +1,38 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import operation_table
+import plugin_cache
+import register_plugin
+from fake_servers import FakePluginHost
+
+
+def test_each_artifact_is_fetched_and_parsed_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(plugin_cache, "PLUGINS_DIR", str(tmp_path))
+    monkeypatch.setattr(plugin_cache, "_index", None)
+    monkeypatch.setattr(register_plugin, "_parsed_artifacts", {})
+    monkeypatch.setattr(register_plugin, "plugin_stubs", {})
+    monkeypatch.setattr(register_plugin, "registration_stats", {})
+
+    try:
+        with FakePluginHost(plugins=1) as host:
+            register_plugin.register_plugin(host.manifest_url(0), "gpt-3.5-turbo")
+            stats = register_plugin.registration_stats["plugin0"]
+            assert (stats["http_requests"], stats["parses"]) == (2, 2)
+
+            # Expired cache: both artifacts are revalidated with their ETag, the server answers 304
+            monkeypatch.setattr(plugin_cache, "CACHE_TTL", 0)
+            register_plugin.register_plugin(host.manifest_url(0), "gpt-3.5-turbo")
+            stats = register_plugin.registration_stats["plugin0"]
+            assert (stats["http_requests"], stats["parses"]) == (2, 0)
+            assert host.requests == 4
+    finally:
+        operation_table.clear()
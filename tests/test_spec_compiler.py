@@ -0,0 +1,39 @@
+# Copyright 2019-2023 Xavier Rey-Robert
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import yaml
+
+import spec_compiler
+
+# Unquoted dates are parsed by YAML into datetime.date objects
+DATE_ENUM_SPEC = """
+openapi: 3.0.1
+info: {title: Events, version: "1.0"}
+paths:
+  /events:
+    get:
+      operationId: getEvents
+      summary: List the events of a day
+      parameters:
+        - name: day
+          in: query
+          required: true
+          schema: {type: string, enum: [2023-01-01, 2023-01-02]}
+"""
+
+
+def test_date_enum_is_rendered_as_strings():
+    openapi_spec = yaml.safe_load(DATE_ENUM_SPEC)
+
+    for verbosity in spec_compiler.VERBOSITY_LEVELS:
+        assert "getEvents" in spec_compiler.compile_spec(openapi_spec, verbosity)
+    compact = spec_compiler.compile_spec(openapi_spec, spec_compiler.VERBOSITY_COMPACT)
+    assert '"day": "2023-01-01"|"2023-01-02"' in compact